@@ -8,6 +8,15 @@ import micropython
 import time
 
 
+# Files are read and written in chunks of no more than this many bytes, so that
+# we don't run out of memory
+CHUNK = 1024
+chunk_buffer = bytearray(CHUNK)
+# Every command response ends with this line, so that the controlling program
+# knows that the response is complete without waiting for the serial port to go
+# quiet
+RESPONSE_END = '\x04'
+
 pins = {
     'pico_led'    : Pin(25, Pin.OUT),           # the led on the Pico
     'reset_adc'   : Pin(5, Pin.OUT, value=1),   # hardware reset* of ADC commanded from Pico (active low)
@@ -51,7 +60,8 @@ def process_command(command_string):
     '''Implements the following commands: RESET, SAVE [filename] [length],
     SHA256 [filename], RENAME [from_name] [to_name], REMOVE [filename],
     LISTDIR, START [filename] [args], CAT [filename], MACHINE, VERSION,
-    BOOTLOADER'''
+    BOOTLOADER. The response ends with the RESPONSE_END line, except for
+    commands that reset the Pico.'''
 
     # make an array of words
     words = command_string.split()
@@ -80,9 +90,6 @@ def process_command(command_string):
             # disable CTRL-C handling on stdin during binary read
             micropython.kbd_intr(-1)
             remaining = int(length)
-            # we read in chunks of no more than 1024 bytes, so that we
-            # don't run out of memory
-            CHUNK = 1024
             with open(filename, 'wb') as f:
                 while remaining > 0:
                     if remaining > CHUNK:
@@ -98,8 +105,16 @@ def process_command(command_string):
     elif command == 'SHA256' and len(arguments) == 1:
         filename = arguments[0]
         try:
+            # the file is hashed in chunks, re-using the same buffer, so that
+            # large files don't need to fit in memory
+            sha = hashlib.sha256()
+            chunk_mv = memoryview(chunk_buffer)
             with open(filename, 'rb') as f:
-                sha = hashlib.sha256(f.read())
+                while True:
+                    n = f.readinto(chunk_buffer)
+                    if not n:
+                        break
+                    sha.update(chunk_mv[:n])
             bs = sha.digest()
             # result is a string containing the hex representation
             command_status = binascii.hexlify(bs).decode('utf-8')
@@ -154,12 +169,14 @@ def process_command(command_string):
     else:
         command_status = f'Error: failed to parse {words}.'
     print(command_status)
+    print(RESPONSE_END)
 
    
 # Run from here
 try:
     configure_reset_interrupt('enable')
     print('Control program main.py started on Pico.')
+    print(RESPONSE_END)
     while True:
         command_string = read_command()
         process_command(command_string)
@@ -2,7 +2,23 @@
 # 4-channel ADC via SPI serial interface, and host computer via USB serial
 # interface. The code provides a circular buffer for precisely timed incoming
 # measurements signalled by the ADC (via the data ready, DR* pin), and sends
-# output from the buffer in blocks of 64x4x16 bit integer values.
+# output from the buffer in pages of (by default) 64x4x16 bit integer values.
+# With the 'framed' option, each block is sent as a page with a header that
+# holds magic bytes, a page sequence number and a CRC16, so that the host can
+# detect lost or corrupted data and resynchronise. The page format is described
+# in pqm/block_io.py. With the 'delta' option, pages are also compressed by
+# sending the difference between successive samples of each channel as a
+# variable length integer, which reduces the USB data rate at high sample rates.
+# The number of pages in the buffer and the number of samples in each page can
+# be set with the 'pages=N' and 'page_size=N' options. If writing to USB stalls
+# for so long that the buffer is nearly full, the unsent pages are skipped and
+# counted as an overrun. In the framed formats, the next page sent has the
+# overrun flag set, and the skipped pages show as a jump in page sequence.
+# With the 'reduce=N' option, for long timebases and low power logging, each
+# block of N samples is reduced to a single framed record of the minimum,
+# maximum, sum and sum of squares of each channel, and the sums of the products
+# of voltage with the other channels. The record format is described in
+# pqm/reduction.py.
 
 # BE VERY CAREFUL WITH EDITING! GARBAGE COLLECTOR IS SWITCHED OFF IN INNER
 # LOOPS TO MAINTAIN PERFORMANCE. MEMORYVIEW OBJECTS ARE USED TO AVOID NEW
@@ -46,15 +62,49 @@ DEBUG = const(False)
 DEFAULT_ADC_SETTINGS = { 'gains':       ['1x', '1x', '1x', '1x'],
                          'sample_rate': '7.812k' }
 
-# Buffer memory -- number of samples cached in Pico memory.
-# Buffer size is a power of two, to allow divide by two and bit masks to work
-# easily. The buffer size is measured in 'samples' or number of cells.
-# However note the underlying memory size in bytes is BUFFER_SIZE * 8 because
-# we have 4 measurement channels and 2 bytes per channel.
-BUFFER_SIZE = const(256)
-BUFFER_MEMORY_SIZE = const(2048)
-PENULTIMATE_CELL = const(BUFFER_SIZE - 2)
-FINAL_CELL = const(BUFFER_SIZE - 1)
+# Framed page header: magic (2 bytes), page type, flags, page sequence number
+# (16 bits), payload length (16 bits), CRC16, all big-endian. The CRC is
+# CRC-16/CCITT with initial value 0xffff, over the header from the page type to
+# the payload length, then the payload. Must match pqm/block_io.py.
+PAGE_MAGIC = b'\xa5\x5a'
+PAGE_HEADER_SIZE = const(10)
+PAGE_SAMPLES = const(0)              # page type for raw sample records
+PAGE_DELTA = const(1)                # page type for delta encoded samples
+PAGE_REDUCED = const(2)              # page type for a reduced record
+PAGE_OVERRUN = const(0b00000001)     # flag: pages were skipped before this one
+# A delta encoded page starts from zero for each channel, and each reading is
+# the zigzag encoded difference from the previous reading of that channel as a
+# little-endian base 128 varint, 1 to 3 bytes. If that isn't shorter than the
+# raw page, the raw page is sent instead.
+CRC_POLYNOMIAL = const(0x1021)
+# A reduced record holds the sample count, then for each channel the minimum,
+# maximum, sum and sum of squares, then the sum of the products of voltage with
+# each of the other channels, all big-endian, 90 bytes in all. While a record is
+# accumulated, the 64 bit sums are kept as pairs of 32 bit words, low word first.
+REDUCED_RECORD_SIZE = const(90)
+ALLOWED_REDUCTIONS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+ACC_MIN = const(0)                   # word offsets into the record accumulator
+ACC_MAX = const(4)
+ACC_SUM = const(8)
+ACC_SUM_SQ = const(12)
+ACC_SUM_VI = const(20)
+ACC_COUNT = const(26)
+ACC_RECORD = const(27)
+ACC_WORDS = const(28)
+
+# Buffer memory -- the buffer is divided into pages, which are sent to the
+# host in turn. The number of pages and the page size are powers of two, to
+# allow bit masks to work easily. Page size is measured in 'samples' or number
+# of cells. However note the underlying memory size in bytes is 8 times the
+# number of cells because we have 4 measurement channels and 2 bytes per
+# channel. Larger pages make fewer, more efficient USB writes, more pages give
+# more time for a slow write to complete before the buffer overruns, and both
+# use more memory and add latency. Every cell has its own memoryview object, so
+# the largest buffer is limited to 2048 cells.
+DEFAULT_PAGES = const(4)
+DEFAULT_PAGE_SIZE = const(64)
+ALLOWED_PAGES = (4, 8, 16)
+ALLOWED_PAGE_SIZES = (16, 32, 64, 128)
 
 # flags: operation flags used to control program flow on both CPU cores.
 STOP: int        = const(0b0001)       # tells both cores to exit
@@ -62,20 +112,11 @@ RESET: int       = const(0b0010)       # initiate a machine reset
 RESYNC: int      = const(0b0100)       # perform a soft reset on the ADC
 STREAMING: int   = const(0b1000)       # fast ADC streaming using both cores
 
-# cell:  sample pointer 0 to 255.
-# Bit-and the cell variable with WRAP_MASK after incrementing it, to make the
-# pointer circular. Increment from 255 & WRAP_MASK wraps round to 0.
-WRAP_MASK: int   = const(0b11111111)
-
-# The following constants are used to test whether a page boundary has
-# been crossed, and therefore time to output the next page of sample buffer.
-# The cell variable is bit-anded with the PAGE_BITS bit mask and the result
-# checked against PAGEn constants.
-PAGE_BITS: int   = const(0b11000000)   # test page number
-PAGE0: int       = const(0b00000000)   # bit76==00: in range 0-63, ie page 0
-PAGE1: int       = const(0b01000000)   # bit76==01: in range 64-127, ie page 1
-PAGE2: int       = const(0b10000000)   # bit76==10: in range 128-191, ie page 2
-PAGE3: int       = const(0b11000000)   # bit76==11: in range 192-255, ie page 3
+# sample_count: free running count of samples, incremented by the interrupt
+# handler. Bit-and with COUNT_MASK after incrementing, so that the count stays
+# a small integer and never allocates memory. The cell pointer is the sample
+# count bit-anded with wrap_mask, which is set when the buffer is configured.
+COUNT_MASK: int  = const(0x3fffffff)
 
 # ADC register addresses
 PHASE = 0x0a
@@ -97,12 +138,22 @@ pins: dict                   # pin configuration for the Pico
 spi_adc_interface: object    # object holding SPI interface configuration
 flags: int                   # bit field with flags to control operation
 cell: int                    # pointer to current cell in the buffer
+sample_count: int            # number of samples signalled by the ADC
+wrap_mask: int               # bit mask that makes the cell pointer circular
+buffer_size: int             # number of cells in the buffer
+page_size: int               # number of cells in each page
+page_shift: int              # page number of a cell is cell >> page_shift
 acq: bytearray               # underlying storage for the sample buffer
-p0_mv: bytearray             # page 0 of the storage buffer
-p1_mv: bytearray             # page 1 of the storage buffer
-p2_mv: bytearray             # page 2 of the storage buffer
-p3_mv: bytearray             # page 3 of the storage buffer
+pages_mv: tuple              # the pages of the storage buffer, in order
 cells_mv: tuple              # index to the individual cells of the buffer
+overruns: int                # number of times that core 1 overtook core 0
+page_header: bytearray       # header for framed pages, re-used for every page
+page_fields_mv: memoryview   # the part of the page header covered by the CRC
+crc_table: bytearray         # lookup table for the CRC calculation
+delta_page: bytearray        # output memory for a delta encoded page
+delta_previous: bytearray    # previous reading of each channel while encoding
+reduce_acc: bytearray        # accumulator for the reduced record
+reduced_record: bytearray    # output memory for a reduced record
 
 
 ########################################################
@@ -296,12 +347,13 @@ def configure_interrupts(command: str ='enable'):
     # Use viper native optimiser to minimise response time.
     @micropython.viper
     def adc_read_handler(_):
-        global cell
+        global cell, sample_count
         # 'anding' the pointer with a bit mask that has binary '0' in the bit
         # above the largest buffer pointer makes the buffer pointer circulate
         # to zero without needing an 'if' conditional: this means the
         # instruction executes in constant time
-        cell = (int(cell) + 1) & int(WRAP_MASK)
+        cell = (int(cell) + 1) & int(wrap_mask)
+        sample_count = (int(sample_count) + 1) & int(COUNT_MASK)
 
     # we need this helper function, because we can't easily assign to global
     # variable within a lambda expression
@@ -419,7 +471,7 @@ def get_unstriped_regions(bs: bytearray):
     return (p0_mv, p1_mv, p2_mv, p3_mv)
 
 
-def configure_buffer_memory():
+def configure_buffer_memory(n_pages: int, cells_per_page: int):
     '''Buffer memory is allocated for retaining a cache of samples received from
     the ADC. The memory is referenced by various memoryview objects that point
     to different portions of it. By default, buffer memory allocated from global
@@ -430,26 +482,210 @@ def configure_buffer_memory():
     Consequently, we re-map the allocated bytearray into bytearray objects that
     are in contigous memory regions, using the unstriped memory mapping.
     This memory layout means that at a hardware level, reading and writing from
-    different pages can occur in the same clock cycle.
+    different pages can occur in the same clock cycle. Successive pages are
+    taken from each region in turn, so that neighbouring pages are always in
+    different regions.
     '''
     global acq
-    global p0_mv, p1_mv, p2_mv, p3_mv
-    global cells_mv
-
+    global pages_mv, cells_mv
+    global buffer_size, page_size, page_shift, wrap_mask
+
+    buffer_size = n_pages * cells_per_page
+    page_size = cells_per_page
+    page_shift = 0
+    while (1 << page_shift) < page_size:
+        page_shift += 1
+    wrap_mask = buffer_size - 1
     # 2 bytes per channel, 4 channels
     # acq is a global variable to prevent it being garbage collected
-    acq = bytearray(BUFFER_MEMORY_SIZE)
-    # Create memoryviews for each unstriped region of the buffer (ie four pages).
-    p0_mv, p1_mv, p2_mv, p3_mv = get_unstriped_regions(acq)
+    acq = bytearray(buffer_size * 8)
+    # Create memoryviews for each unstriped region of the buffer, and divide
+    # them into pages.
+    regions = get_unstriped_regions(acq)
+    page_bytes = page_size * 8
+    pages_mv = tuple(regions[j % 4][(j // 4) * page_bytes:(j // 4 + 1) * page_bytes]
+                     for j in range(n_pages))
     # Create an array of memoryviews for each storage cell of the buffer.
-    cells_list =      [ memoryview(p0_mv[i:i+8]) for i in range(0, len(p0_mv), 8) ]
-    cells_list.extend([ memoryview(p1_mv[i:i+8]) for i in range(0, len(p1_mv), 8) ])
-    cells_list.extend([ memoryview(p2_mv[i:i+8]) for i in range(0, len(p2_mv), 8) ])
-    cells_list.extend([ memoryview(p3_mv[i:i+8]) for i in range(0, len(p3_mv), 8) ])
+    cells_list = []
+    for page in pages_mv:
+        cells_list.extend([ memoryview(page[i:i+8]) for i in range(0, page_bytes, 8) ])
     # Convert to a tuple for slight performance gain
     cells_mv = tuple(cells_list)
 
 
+def configure_page_header():
+    '''Allocates the header for framed pages, the CRC lookup table and memory
+    for encoding pages once, so that no memory is allocated while streaming.'''
+    global page_header, page_fields_mv, crc_table
+    global delta_page, delta_previous, reduce_acc, reduced_record
+    page_header = bytearray(PAGE_HEADER_SIZE)
+    page_header[0:2] = PAGE_MAGIC
+    page_header[2] = PAGE_SAMPLES
+    page_header[3] = 0
+    page_fields_mv = memoryview(page_header)[2:8]
+    # 256 entries of 16 bits, stored in native byte order for viper ptr16 access
+    crc_table = bytearray(512)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ CRC_POLYNOMIAL) if crc & 0x8000 else (crc << 1)
+        crc &= 0xffff
+        crc_table[2*i] = crc & 0xff
+        crc_table[2*i+1] = crc >> 8
+    # up to 3 bytes for each reading of the largest page
+    delta_page = bytearray(ALLOWED_PAGE_SIZES[-1] * 4 * 3)
+    delta_previous = bytearray(8)
+    reduce_acc = bytearray(ACC_WORDS * 4)
+    reduced_record = bytearray(REDUCED_RECORD_SIZE)
+
+
+@micropython.viper
+def crc16(crc: int, bs, n: int) -> int:
+    '''Updates the CRC with the first n bytes of bs, using the lookup table.'''
+    table = ptr16(crc_table)
+    p = ptr8(bs)
+    i: int = 0
+    while i < n:
+        crc = ((crc << 8) & 0xff00) ^ table[((crc >> 8) ^ p[i]) & 0xff]
+        i += 1
+    return crc
+
+
+@micropython.viper
+def delta_encode(bs, n_values: int) -> int:
+    '''Delta encodes n_values big-endian readings from bs into delta_page, and
+    returns the number of bytes used.'''
+    src = ptr8(bs)
+    dest = ptr8(delta_page)
+    previous = ptr16(delta_previous)
+    previous[0] = 0
+    previous[1] = 0
+    previous[2] = 0
+    previous[3] = 0
+    j: int = 0
+    i: int = 0
+    while i < n_values:
+        x: int = (src[2*i] << 8) | src[2*i+1]
+        d: int = (x - previous[i & 3]) & 0xffff
+        previous[i & 3] = x
+        # zigzag encoding of the 16 bit signed difference, so that small
+        # negative differences are also small numbers
+        z: int = (d << 1) if d < 0x8000 else ((0x10000 - d) << 1) - 1
+        while z >= 0x80:
+            dest[j] = (z & 0x7f) | 0x80
+            z = z >> 7
+            j += 1
+        dest[j] = z
+        j += 1
+        i += 1
+    return j
+
+
+@micropython.viper
+def reduce_page(bs, n_samples: int, sent: int, record_shift: int) -> bool:
+    '''Adds n_samples samples from bs to the reduced record that they belong
+    to, where sent is the sample number of the first sample and each record
+    holds 1 << record_shift samples. Returns True when the record is complete
+    and has been written to reduced_record. A record that missed its first
+    samples, because pages were skipped after an overrun, is never completed.'''
+    acc = ptr32(reduce_acc)
+    src = ptr8(bs)
+    record: int = sent >> record_shift
+    position: int = sent & ((1 << record_shift) - 1)
+    c: int = 0
+    if position == 0:
+        # start a new record
+        while c < 4:
+            acc[ACC_MIN + c] = 32767
+            acc[ACC_MAX + c] = -32768
+            acc[ACC_SUM + c] = 0
+            acc[ACC_SUM_SQ + 2*c] = 0
+            acc[ACC_SUM_SQ + 2*c + 1] = 0
+            c += 1
+        c = 0
+        while c < 3:
+            acc[ACC_SUM_VI + 2*c] = 0
+            acc[ACC_SUM_VI + 2*c + 1] = 0
+            c += 1
+        acc[ACC_COUNT] = 0
+        acc[ACC_RECORD] = record
+    elif acc[ACC_RECORD] != record or acc[ACC_COUNT] != position:
+        return False
+    lo: uint = uint(0)
+    i: int = 0
+    while i < n_samples:
+        j: int = i << 3
+        v: int = (src[j+6] << 8) | src[j+7]
+        if v >= 0x8000:
+            v = v - 0x10000
+        c = 0
+        while c < 4:
+            x: int = (src[j+2*c] << 8) | src[j+2*c+1]
+            if x >= 0x8000:
+                x = x - 0x10000
+            if x < acc[ACC_MIN + c]:
+                acc[ACC_MIN + c] = x
+            if x > acc[ACC_MAX + c]:
+                acc[ACC_MAX + c] = x
+            acc[ACC_SUM + c] = acc[ACC_SUM + c] + x
+            # the unsigned low word carries into the high word when it wraps
+            # round, and a negative product also subtracts one from the high
+            # word, because it is added with its sign extended to 64 bits
+            sq: uint = uint(x * x)
+            lo = uint(acc[ACC_SUM_SQ + 2*c]) + sq
+            acc[ACC_SUM_SQ + 2*c] = int(lo)
+            if lo < sq:
+                acc[ACC_SUM_SQ + 2*c + 1] = acc[ACC_SUM_SQ + 2*c + 1] + 1
+            if c < 3:
+                p: int = v * x
+                lo = uint(acc[ACC_SUM_VI + 2*c]) + uint(p)
+                acc[ACC_SUM_VI + 2*c] = int(lo)
+                if lo < uint(p):
+                    acc[ACC_SUM_VI + 2*c + 1] = acc[ACC_SUM_VI + 2*c + 1] + 1
+                if p < 0:
+                    acc[ACC_SUM_VI + 2*c + 1] = acc[ACC_SUM_VI + 2*c + 1] - 1
+            c += 1
+        i += 1
+    acc[ACC_COUNT] = acc[ACC_COUNT] + n_samples
+    n: int = acc[ACC_COUNT]
+    if n != (1 << record_shift):
+        return False
+    # write out the record, big-endian
+    out = ptr8(reduced_record)
+    out[0] = (n >> 8) & 0xff
+    out[1] = n & 0xff
+    k: int = 0
+    w: int = 0
+    c = 0
+    while c < 4:
+        w = acc[ACC_MIN + c]
+        out[2 + 2*c] = (w >> 8) & 0xff
+        out[3 + 2*c] = w & 0xff
+        w = acc[ACC_MAX + c]
+        out[10 + 2*c] = (w >> 8) & 0xff
+        out[11 + 2*c] = w & 0xff
+        w = acc[ACC_SUM + c]
+        k = 0
+        while k < 4:
+            out[18 + 4*c + k] = (w >> (24 - 8*k)) & 0xff
+            k += 1
+        k = 0
+        while k < 4:
+            out[34 + 8*c + k] = (acc[ACC_SUM_SQ + 2*c + 1] >> (24 - 8*k)) & 0xff
+            out[38 + 8*c + k] = (acc[ACC_SUM_SQ + 2*c] >> (24 - 8*k)) & 0xff
+            k += 1
+        c += 1
+    c = 0
+    while c < 3:
+        k = 0
+        while k < 4:
+            out[66 + 8*c + k] = (acc[ACC_SUM_VI + 2*c + 1] >> (24 - 8*k)) & 0xff
+            out[70 + 8*c + k] = (acc[ACC_SUM_VI + 2*c] >> (24 - 8*k)) & 0xff
+            k += 1
+        c += 1
+    return True
+
+
 ########################################################
 ######### STREAMING LOOP FOR CORE 1 STARTS HERE
 ########################################################
@@ -498,9 +734,25 @@ def streaming_loop_core_1():
 ########################################################
 # Debug cache for memorising a few sampling loops
 debug_cache = Debug_cache()
-def streaming_loop_core_0():
-    '''Prints data from memory to stdout in chunks.'''
-    global debug_cache
+def streaming_loop_core_0(page_format: str, record_samples: int):
+    '''Prints data from memory to stdout in chunks. page_format is 'raw',
+    'framed', 'delta' or 'reduced', when records of record_samples samples
+    are sent. Counts an overrun if core 1 is about to overwrite the next page
+    before it has been sent.'''
+    global debug_cache, overruns
+    # local copies of the buffer layout, for speed
+    n_values = page_size * 4
+    page_bytes = page_size * 8
+    # a page is ready to send when core 1 has filled it, and is skipped if core
+    # 1 has come round the buffer to the page before it
+    overrun_lag = buffer_size - page_size
+    page_start_mask = COUNT_MASK & ~(page_size - 1)
+    last_page = len(pages_mv) - 1
+    # reduced records are numbered in sequence, instead of pages
+    record_shift = 0
+    while (1 << record_shift) < record_samples:
+        record_shift += 1
+    sequence_shift = record_shift if page_format == 'reduced' else page_shift
 
     def _transfer_buffer_normal(bs):
         pins['buffer_led'].on()
@@ -508,6 +760,42 @@ def streaming_loop_core_0():
         sys.stdout.buffer.write(bs)
         pins['buffer_led'].off()
 
+    def _write_page(page_type, bs, n):
+        # fill in the header, then write out the header and the first n bytes
+        # of bs. The length argument to write() avoids allocating a slice. The
+        # page sequence number and any overrun flag were filled in by the
+        # streaming loop, and the flag is cleared once it has been sent.
+        page_header[2] = page_type
+        page_header[6] = n >> 8
+        page_header[7] = n & 0xff
+        crc = crc16(crc16(0xffff, page_fields_mv, 6), bs, n)
+        page_header[8] = crc >> 8
+        page_header[9] = crc & 0xff
+        sys.stdout.buffer.write(page_header)
+        sys.stdout.buffer.write(bs, n)
+        page_header[3] = 0
+
+    def _transfer_buffer_framed(bs):
+        pins['buffer_led'].on()
+        _write_page(PAGE_SAMPLES, bs, page_bytes)
+        pins['buffer_led'].off()
+
+    def _transfer_buffer_delta(bs):
+        pins['buffer_led'].on()
+        n = delta_encode(bs, n_values)
+        if n < page_bytes:
+            _write_page(PAGE_DELTA, delta_page, n)
+        else:
+            _write_page(PAGE_SAMPLES, bs, page_bytes)
+        pins['buffer_led'].off()
+
+    def _transfer_buffer_reduced(bs):
+        pins['buffer_led'].on()
+        # sent is the sample number of the first sample in the page
+        if reduce_page(bs, page_size, sent, record_shift):
+            _write_page(PAGE_REDUCED, reduced_record, REDUCED_RECORD_SIZE)
+        pins['buffer_led'].off()
+
     def _transfer_buffer_debug(bs):
         global flags
         pins['buffer_led'].on()
@@ -519,6 +807,12 @@ def streaming_loop_core_0():
     # select the transfer function we are going to use from now on
     if DEBUG:
         transfer_buffer = _transfer_buffer_debug
+    elif page_format == 'framed':
+        transfer_buffer = _transfer_buffer_framed
+    elif page_format == 'delta':
+        transfer_buffer = _transfer_buffer_delta
+    elif page_format == 'reduced':
+        transfer_buffer = _transfer_buffer_reduced
     else:
         transfer_buffer = _transfer_buffer_normal
 
@@ -547,31 +841,39 @@ def streaming_loop_core_0():
             # raise RESYNC flag
             flags = flags | RESYNC
 
-    # Now transfer buffers in turn and loop...
+    # sent is the sample number of the first sample in the next page to send,
+    # starting with the page that core 1 is filling now
+    sent = sample_count & page_start_mask
+    # Now transfer pages in turn and loop...
     while flags & STREAMING:
-        # Wait while we fill page 0, then transfer it
-        while (cell & PAGE_BITS) == PAGE0:
+        # Wait while core 1 fills the page
+        while ((sample_count - sent) & COUNT_MASK) < page_size:
             continue
-        transfer_buffer(p0_mv)
-        # Wait while we fill page 1, then transfer it
-        while (cell & PAGE_BITS) == PAGE1:
-            continue
-        transfer_buffer(p1_mv)
-        # Wait while we fill page 2, then transfer it
-        while (cell & PAGE_BITS) == PAGE2:
-            continue
-        transfer_buffer(p2_mv)
-        # Wait while we fill page 3. then transfer it
-        while (cell & PAGE_BITS) == PAGE3:
-            continue
-        transfer_buffer(p3_mv)
-        # Check to see if ADC readouts have latched to a constant value.
-        # This function will raise a flag if necessary and the other CPU
-        # core will reset ADC comms.
-        latch_test(cells_mv[FINAL_CELL], cells_mv[PENULTIMATE_CELL])
+        # If the previous transfers took so long that core 1 is about to
+        # overwrite this page, skip forward to the last page that was filled,
+        # and flag the overrun in the header of the next framed page. The page
+        # sequence number jumps by the number of pages that were skipped. If a
+        # single transfer stalled for longer than the whole buffer, the page
+        # before the flagged page may have been partly overwritten.
+        if ((sample_count - sent) & COUNT_MASK) >= overrun_lag:
+            overruns += 1
+            page_header[3] = PAGE_OVERRUN
+            sent = ((sample_count & page_start_mask) - page_size) & COUNT_MASK
+        page = (sent & wrap_mask) >> page_shift
+        page_sequence = (sent >> sequence_shift) & 0xffff
+        page_header[4] = page_sequence >> 8
+        page_header[5] = page_sequence & 0xff
+        transfer_buffer(pages_mv[page])
+        sent = (sent + page_size) & COUNT_MASK
+        if page == last_page:
+            # Check to see if ADC readouts have latched to a constant value.
+            # This function will raise a flag if necessary and the other CPU
+            # core will reset ADC comms.
+            latch_test(cells_mv[wrap_mask], cells_mv[wrap_mask - 1])
 
     if DEBUG:
         print('Streaming_loop_core_0() exited.')
+        print(f'There were {overruns} buffer overruns.')
         print('Here are the contents of debug buffer memory:')
         gc.collect()
         print(debug_cache.as_text())
@@ -595,7 +897,7 @@ def reset_pin_held_high() -> bool:
     return reset_status
 
 
-def prepare_to_stream(adc_settings: dict):
+def prepare_to_stream(adc_settings: dict, n_pages: int, cells_per_page: int):
     '''Configures all the pre-requisities: pins, SPI interface, ADC settings
     circular buffer memory, interrupts and garbage collection.'''
 
@@ -606,7 +908,7 @@ def prepare_to_stream(adc_settings: dict):
     # an underlying bytearray that holds a buffer of ADC samples. These
     # objects are declared global so that the memory can be reached by both
     # CPU cores.
-    configure_buffer_memory()
+    configure_buffer_memory(n_pages, cells_per_page)
 
     if DEBUG:
         print('Configuring ADC and interrupts.')
@@ -626,16 +928,16 @@ def prepare_to_stream(adc_settings: dict):
     gc.disable()
 
 
-def stream():
+def stream(page_format: str, record_samples: int):
     '''Start the streaming loops on the two CPU cores, both accessing
     the same buffer memory. Core 1 captures samples from the ADC, triggered
-    by the DR* pin. Core 0 prints blocks of samples from the capture buffer
-    in two pages.'''
+    by the DR* pin. Core 0 prints pages of samples from the capture buffer
+    in turn, in the selected page format.'''
     if DEBUG:
         print('Starting streaming loops on both cores.')
     # These loops will both stay running while the STREAMING flag is raised.
     _thread.start_new_thread(streaming_loop_core_1, ())
-    streaming_loop_core_0()
+    streaming_loop_core_0(page_format, record_samples)
     # runs forever, unless:
     #     CTRL-C:             STOP flag raised.
     #     reset_me pin:       RESET flag raised.
@@ -648,30 +950,70 @@ def cleanup():
     gc.enable()
     configure_interrupts('disable')
 
+def get_option_value(option: str, allowed: tuple, default: int) -> int:
+    '''Returns the value of a 'name=N' option, or the default if the value is
+    not one of the allowed values.'''
+    try:
+        value = int(option.split('=')[1])
+    except ValueError:
+        return default
+    return value if value in allowed else default
+
+
 def main():
-    global flags, cell
+    global flags, cell, sample_count, overruns
 
     # We can pass configuration variables into the program from main.py
     # via the sys.argv variable.
-    # sys.argv = [ 'stream.py', '1x', '1x', '1x', '1x', '7.812k' ]
-    # The variables are loaded into the adc_settings dictionary.
+    # sys.argv = [ 'stream.py', '1x', '1x', '1x', '1x', '7.812k', 'framed',
+    #              'pages=8', 'page_size=64' ]
+    # or with 'delta' instead of 'framed' for delta encoded pages, or with
+    # 'reduce=N' for reduced records of N samples
+    # The variables are loaded into the adc_settings dictionary. Options after
+    # the sample rate are optional, in any order.
     # adc_settings = { 'gains':       ['1x', '1x', '1x', '1x'],
     #                  'sample_rate': '7.812k' }
-    if len(sys.argv) == 6:
-        _, g0, g1, g2, g3, sample_rate = sys.argv
+    if len(sys.argv) >= 6:
+        _, g0, g1, g2, g3, sample_rate = sys.argv[:6]
         adc_settings = { 'gains': [g0, g1, g2, g3],
                          'sample_rate': sample_rate }
     else:
         adc_settings = DEFAULT_ADC_SETTINGS
+    page_format = 'raw'
+    n_pages = DEFAULT_PAGES
+    cells_per_page = DEFAULT_PAGE_SIZE
+    record_samples = 0
+    for option in sys.argv[6:]:
+        if option in ('framed', 'delta'):
+            page_format = option
+        elif option.startswith('pages='):
+            n_pages = get_option_value(option, ALLOWED_PAGES, DEFAULT_PAGES)
+        elif option.startswith('page_size='):
+            cells_per_page = get_option_value(option, ALLOWED_PAGE_SIZES, DEFAULT_PAGE_SIZE)
+        elif option.startswith('reduce='):
+            record_samples = get_option_value(option, ALLOWED_REDUCTIONS, 0)
+    # reduced records are always framed, and each record is made from one or
+    # more whole pages
+    if record_samples:
+        page_format = 'reduced'
+        cells_per_page = min(cells_per_page, record_samples)
     if DEBUG:
-        print(f'stream.py started with parameters {adc_settings}.')
+        print(f'stream.py started with parameters {adc_settings}, {page_format} pages, '
+              f'{n_pages} pages of {cells_per_page} samples, '
+              f'{record_samples} samples per reduced record.')
     try:
         configure_pins()
+        configure_page_header()
         flags = STREAMING
+        # the sample count, and so the page sequence, carries on across
+        # restarts of the streaming loops, so that the host can count the
+        # pages that were lost
         cell = 0
+        sample_count = 0
+        overruns = 0
         while flags == STREAMING:
-            prepare_to_stream(adc_settings)
-            stream()
+            prepare_to_stream(adc_settings, n_pages, cells_per_page)
+            stream(page_format, record_samples)
             # Inner sampling loops will exit if a rising edge pulse is detected
             # on the 'reset_me' pin. This is to make it possible to restart the
             # Pico via software, toggling this pin. However, this outer loop
@@ -7,6 +7,10 @@
 #  \__,_|_| |_|\__,_|_|\__, |___/\___|_|(_) .__/ \__, |
 #                      |___/              |_|    |___/ 
 # 
+# Reduced records from scaler.py (see reduction.py) are analysed in the same
+# way as samples, with the averages weighted by the number of samples in each
+# record. Frequency and harmonics can't be found from reduced records, and are
+# reported as zero.
 
 import math
 import numpy as np
@@ -14,12 +18,20 @@ import sys
 import json
 import csv
 import time
+import argparse
 
 # local
 from settings import Settings
+from shm_ring import Ring_reader
+from stats import Stats
+from reduction import (REDUCED_MARKER, SCALED_COLUMNS, TIME, COUNT, V_MIN, V_MAX, V_RMS,
+                       I_MIN, I_MAX, I_RMS, P_MIN, P_MAX, P_MEAN, L_MIN, L_MAX, L_RMS)
 
 ROOT2 = math.sqrt(2)
 
+# runtime counters, published to the stats directory
+stats = Stats('analyser.py')
+
 class Analyser:
     """Create an instance with the sample rate, then call load_data_frame, calculate,
     get_results in that order.""" 
@@ -28,6 +40,8 @@ class Analyser:
         self.st = None                    # NB set a reference to settings object asap
         self.data_frame = None
         self.size = 0
+        self.reduced = False              # the data frame holds reduced records
+        self.last_count = 1               # number of samples in the last row
         self.fft_window = np.blackman(0)  # empty to begin with
         self.results = {}
         self.analysis_max_min_reset = 0
@@ -77,6 +91,10 @@ class Analyser:
 
     def apply_filters(self):
         """Filter the multi-column data frame into single column array slices of the data."""
+        if self.reduced:
+            self.timestamps = self.data_frame[:,TIME]
+            self.counts = self.data_frame[:,COUNT]
+            return
         self.timestamps = self.data_frame[:,0]
         self.voltages = self.data_frame[:,1]
         self.currents = self.data_frame[:,2]
@@ -131,6 +149,9 @@ class Analyser:
 
     def frequency(self):
         """Determines the fundamental frequency in Hz to three decimal places."""
+        if self.reduced:
+            self.results['frequency'] = 0.0
+            return
         try:
             # look for instances where voltage crosses from negative to positive
             # and count how many occurred.
@@ -167,21 +188,45 @@ class Analyser:
             result = round(value*shift)/shift 
         return result
 
+    def record_averages(self):
+        """Returns the RMS and maximum absolute values of voltage, current and leakage
+        current, and the mean and maximum absolute power, of a data frame of reduced
+        records. The mean squares and mean power of each record are weighted by its
+        sample count."""
+        df = self.data_frame
+        filled = self.counts > 0
+        total = np.sum(self.counts)
+        if total == 0:
+            return (0.0,) * 8
+        weighted_mean = lambda column: np.sum(self.counts * df[:,column]) / total
+        weighted_rms = lambda column: math.sqrt(np.sum(self.counts * np.square(df[:,column])) / total)
+        max_abs = lambda low, high: max(np.max(np.abs(df[filled,low])), np.max(np.abs(df[filled,high])))
+        return (weighted_rms(V_RMS), max_abs(V_MIN, V_MAX),
+                weighted_rms(I_RMS), max_abs(I_MIN, I_MAX),
+                weighted_rms(L_RMS), max_abs(L_MIN, L_MAX),
+                weighted_mean(P_MEAN), max_abs(P_MIN, P_MAX))
+
     def averages(self):
         """Calculate average and RMS values of the dataset."""
-        rms_v                                        = self.rms(self.voltages)
+        if self.reduced:
+            rms_v, maxabs_v, rms_i, maxabs_i, rms_l, maxabs_l, mean_p, maxabs_p = self.record_averages()
+        else:
+            rms_v                                    = self.rms(self.voltages)
+            maxabs_v                                 = np.max(np.abs(self.voltages))
+            rms_i                                    = self.rms(self.currents)
+            maxabs_i                                 = np.max(np.abs(self.currents))
+            rms_l                                    = self.rms(self.leakage_currents)
+            maxabs_l                                 = np.max(np.abs(self.leakage_currents))
+            mean_p                                   = np.mean(self.powers)
+            maxabs_p                                 = np.max(np.abs(self.powers))
         self.results['rms_voltage']                  = self.round_to(rms_v, 3)
-        maxabs_v                                     = np.max(np.abs(self.voltages))
         self.results['max_abs_voltage']              = self.round_to(maxabs_v, 3)
-        rms_i                                        = self.rms(self.currents)
         self.results['rms_current']                  = self.round_to(rms_i, 5)
-        maxabs_i                                     = np.max(np.abs(self.currents))
         self.results['max_abs_current']              = self.round_to(maxabs_i, 5)
-        self.results['rms_leakage_current']          = self.round_to(self.rms(self.leakage_currents), 7)
-        self.results['max_abs_leakage_current']      = self.round_to(np.max(np.abs(self.leakage_currents)), 7)
-        mean_p                                       = np.mean(self.powers)
+        self.results['rms_leakage_current']          = self.round_to(rms_l, 7)
+        self.results['max_abs_leakage_current']      = self.round_to(maxabs_l, 7)
         self.results['mean_power']                   = self.round_to(mean_p, 3)
-        self.results['max_abs_power']                = self.round_to(np.max(np.abs(self.powers)), 3)
+        self.results['max_abs_power']                = self.round_to(maxabs_p, 3)
         mean_va                                      = self.round_to(rms_v * rms_i, 3)
         self.results['mean_volt_ampere']             = mean_va
         try:
@@ -204,6 +249,13 @@ class Analyser:
 
     def power_quality(self):
         """Power quality calcuation relies on other results: call after averages and frequency."""
+        if self.reduced:
+            # the harmonics can't be found without the individual samples
+            self.results['total_harmonic_distortion_voltage_percentage'] = 0.0
+            self.results['harmonic_voltage_percentages'] = [ 0.0 for h in range(0,51) ]
+            self.results['total_harmonic_distortion_current_percentage'] = 0.0
+            self.results['harmonic_current_percentages'] = [ 0.0 for h in range(0,51) ]
+            return
         n_samples = math.floor(self.st.sample_rate)
         base_frequency = self.results['frequency']
         try:
@@ -244,17 +296,33 @@ class Analyser:
             self.results['total_harmonic_distortion_current_percentage'] = 0.0
             self.results['harmonic_current_percentages'] = [0.0 for m in fft_currents ]
 
+    def check_continuity(self):
+        """Compares the time span of the data frame with the number of samples in it,
+        to find how many samples are missing from the window because of gaps upstream.
+        If the sample times go backwards, the source has restarted and the window isn't
+        flagged. The time of a reduced record is the time of its first sample."""
+        span = self.timestamps[-1] - self.timestamps[0]
+        missing = max(round(span / self.st.interval) + self.last_count - self.size, 0)
+        self.results['missing_samples_in_window'] = missing
+        self.results['gap_in_window'] = missing > 0
+
     def clear_accumulators(self):
         """set integer accumulators to zero: time in milliseconds, and energy transfer in
-        milli-watt-seconds etc."""
-        self.accs = { 'time': 0.0, 'mws': 0.0, 'mvas': 0.0, 'mvars': 0.0 }
+        milli-watt-seconds etc. gap_time is the part of the time that was bridged over
+        missing samples."""
+        self.accs = { 'time': 0.0, 'mws': 0.0, 'mvas': 0.0, 'mvars': 0.0, 'gap_time': 0.0 }
 
     def update_accumulators(self):
-        """Wh, VARh and VAh accumulators."""
+        """Wh, VARh and VAh accumulators. Call check_continuity() first."""
         # delta_t in milliseconds
         # divide by two because the sample data overlaps each calculation (ie each sample participates
         # twice, so we add half of the contribution each time)
         delta_t = int(self.size / self.st.sample_rate / 2 * 1000)
+        # The time of any samples missing from the window is added in the same way, so
+        # that the energy over a gap is estimated from the mean values of the window.
+        gap_t = round(self.results['missing_samples_in_window'] * self.st.interval / 2)
+        delta_t += gap_t
+        self.accs['gap_time'] += gap_t
         # Keep the accumulators in high resolution integer form, ie 'milliwatt-seconds'.
         self.accs['time'] += delta_t
         self.accs['mws'] += round(self.results['mean_power'] * delta_t)
@@ -265,6 +333,7 @@ class Analyser:
         self.results['watt_hour'] = self.round_to(self.accs['mws'] / 1000 / 3600, 3)
         self.results['volt_ampere_hour'] = self.round_to(self.accs['mvas'] / 1000 / 3600, 3)
         self.results['volt_ampere_reactive_hour'] = self.round_to(self.accs['mvars'] / 1000 / 3600, 3)
+        self.results['gap_hours'] = self.round_to(self.accs['gap_time'] / 1000 / 3600, 3)
 
 
     def clear_analysis_bounds(self):
@@ -307,9 +376,15 @@ class Analyser:
 
     def load_data_frame(self, data_frame):
         """Load a data frame into memory, and slice into separate sets for voltage, current
-        etc."""
+        etc. For reduced records, the size is the number of samples in the records."""
         self.data_frame = data_frame
-        self.size = data_frame.shape[0]
+        self.reduced = data_frame.shape[1] == len(SCALED_COLUMNS)
+        if self.reduced:
+            self.size = int(np.sum(data_frame[:,COUNT]))
+            self.last_count = int(data_frame[-1,COUNT])
+        else:
+            self.size = data_frame.shape[0]
+            self.last_count = 1
         self.apply_filters()
 
     def get_results(self):
@@ -327,13 +402,30 @@ class Sample_cache:
         self.front_ptr = 0
         
     def put(self, line):
-        """Increment the pointer and store a line in the cache."""
+        """Increment the pointer and store a line in the cache. Returns False if the
+        line couldn't be read."""
         self.front_ptr = (self.front_ptr + 1) % self.size
         try:
             self.input_array[self.front_ptr] = line.split()
+            return True
         except ValueError:
-            # empty input lines etc
-            self.input_array[self.front_ptr] = (0.0,0.0,0.0,0.0,0.0) 
+            # empty input lines etc, the time is copied from the previous sample so that
+            # the line isn't mistaken for a gap in the sample times
+            self.input_array[self.front_ptr] = (self.input_array[self.front_ptr-1,0],0.0,0.0,0.0,0.0)
+            return False
+
+    def put_samples(self, times, values):
+        """Store a block of sample times and an (n, 4) array of sample values in the
+        cache, advancing the pointer by n."""
+        n = times.shape[0]
+        start = (self.front_ptr + 1) % self.size
+        first = min(n, self.size - start)
+        self.input_array[start:start+first,0] = times[:first]
+        self.input_array[start:start+first,1:] = values[:first]
+        if first < n:
+            self.input_array[:n-first,0] = times[first:]
+            self.input_array[:n-first,1:] = values[first:]
+        self.front_ptr = (self.front_ptr + n) % self.size
 
     def get_output_array(self):
         """Convert the circular input cache into an output array ordered from rear_ptr to front_ptr."""
@@ -341,48 +433,126 @@ class Sample_cache:
         np.concatenate((self.input_array[self.rear_ptr:], self.input_array[:self.rear_ptr]), out=self.output_array)
         return self.output_array
 
+class Record_cache(Sample_cache):
+    """Cache for scaled reduced records, one row per record in the order of
+    SCALED_COLUMNS."""
+
+    def __init__ (self, size):
+        """The size is the number of records in the cache"""
+        self.input_array = np.zeros((size,len(SCALED_COLUMNS)))
+        self.output_array = np.zeros((size,len(SCALED_COLUMNS)))
+        self.size = size
+        self.front_ptr = 0
+
+    def put(self, line):
+        """Increment the pointer and store a record line in the cache. Returns False if
+        the line couldn't be read."""
+        self.front_ptr = (self.front_ptr + 1) % self.size
+        try:
+            words = line.split()
+            if words[0] != REDUCED_MARKER:
+                raise ValueError
+            self.input_array[self.front_ptr] = words[1:]
+            return True
+        except (ValueError, IndexError):
+            # as for samples, with a sample count of zero so that the row doesn't
+            # count towards the averages
+            row = np.zeros(len(SCALED_COLUMNS))
+            row[TIME] = self.input_array[self.front_ptr-1,TIME]
+            self.input_array[self.front_ptr] = row
+            return False
+
+
 def read_lines(n, cache):
     """Reads n lines from stdin, and stores in the cache."""
+    read_wait = 0.0
     for i in range(n):
+        t0 = time.perf_counter()
         line = sys.stdin.readline().rstrip()
-        cache.put(line)
+        read_wait += time.perf_counter() - t0
+        if not cache.put(line) and line != '':
+            stats.parse_failure(f"analyser.py, read_lines(): Couldn't interpret '{line}'.")
+    stats.add_read_wait(read_wait)
+    stats.count_in(n)
     # Test for end of input stream
     if line == '':
         return False
     else:
         return True
 
-
-
-
-def read_analyse_output(cache, analyser, output_interval):
-    """Loop through analysis and output processes until read_lines fails."""
+def read_blocks(n, cache, source):
+    """Reads n samples from a block source, such as the shared memory ring, and
+    stores in the cache. source.read(max_samples) must return a tuple of sample
+    times and values, or None at the end of the input."""
+    while n > 0:
+        t0 = time.perf_counter()
+        block = source.read(n)
+        stats.add_read_wait(time.perf_counter() - t0)
+        # Test for end of input stream
+        if block is None:
+            return False
+        cache.put_samples(*block)
+        stats.count_in(block[0].shape[0])
+        n -= block[0].shape[0]
+    return True
+
+
+def print_results(results):
+    """Output the results as a line of JSON."""
+    print(json.dumps(results))
+    sys.stdout.flush()
+
+
+def read_analyse_output(cache, analyser, output_interval, read_fn=read_lines,
+                        output_fn=print_results):
+    """Loop through analysis and output processes until the read function fails."""
     # While doing calculations, we read new data in two gulps to keep the
     # sample pipeline moving
     gulp1 = output_interval // 2
     gulp2 = output_interval - gulp1
     while True:
+        t0 = time.perf_counter()
+        read_wait = stats.read_wait
         # Transfer the cache into the analyser
         analyser.load_data_frame(cache.get_output_array()) 
         # first new data gulp into cache
-        if not read_lines(gulp1, cache):
+        if not read_fn(gulp1, cache):
             break
         # Do some calculations
         analyser.averages()
         analyser.frequency()
+        analyser.check_continuity()
         analyser.update_accumulators()
         # second new data gulp into cache
-        if not read_lines(gulp2, cache):
+        if not read_fn(gulp2, cache):
             break
         # Do some more calculations
         analyser.power_quality()
         analyser.update_analysis_bounds()
         # Generate the output
-        print(json.dumps(analyser.get_results()))
-        sys.stdout.flush()
+        t1 = time.perf_counter()
+        output_fn(analyser.get_results())
+        stats.add_write_wait(time.perf_counter() - t1)
+        stats.count_out(1)
+        # the loop time is the calculation time, without waiting for input
+        stats.loop_time(t1 - t0 - (stats.read_wait - read_wait))
+    # final update of the stats file at the end of the input
+    stats.publish()
+
+
+def get_command_args():
+    """Process command line argument for the input source."""
+    cmd_parser = argparse.ArgumentParser(description='Analyses scaled samples and outputs '
+        'power and power quality results once per second.')
+    cmd_parser.add_argument('--shm', default=False, action=argparse.BooleanOptionalAction,
+        help='Read samples from the shared memory ring in $TEMP instead of stdin.')
+    program_name = cmd_parser.prog
+    args = cmd_parser.parse_args()
+    return (program_name, args)
 
 
 def main():
+    program_name, args = get_command_args()
     analyser = Analyser()
     st = Settings(lambda: analyser.check_updated_settings())
     # analyser needs a reference to the newly created settings object
@@ -393,10 +563,29 @@ def main():
     cache_size = int(st.sample_rate*2)
     # The cache is a circular buffer, we can keep pushing data into it.
     cache = Sample_cache(cache_size)
-    # Before actually analysing, seed the cache with data
-    read_lines(cache.size, cache)
+    # Incoming data is either text lines on stdin, or the shared memory ring
+    if args.shm:
+        ring = Ring_reader(program_name=program_name, gap_fn=stats.gap)
+        read_fn = lambda n, cache: read_blocks(n, cache, ring)
+        # Before actually analysing, seed the cache with data
+        read_fn(cache.size, cache)
+    else:
+        read_fn = read_lines
+        # The first line shows whether the input is samples or reduced records. For
+        # records, the cache and output interval are counted in records instead.
+        line = sys.stdin.readline().rstrip()
+        if line.startswith(REDUCED_MARKER):
+            try:
+                samples_per_record = max(int(float(line.split()[1 + COUNT])), 1)
+            except (ValueError, IndexError):
+                samples_per_record = 1
+            output_interval = max(output_interval // samples_per_record, 2)
+            cache = Record_cache(max(cache_size // samples_per_record, 2))
+        cache.put(line)
+        # Before actually analysing, seed the cache with data
+        read_fn(cache.size - 1, cache)
     # Read, analyse, output loop
-    read_analyse_output(cache, analyser, output_interval)
+    read_analyse_output(cache, analyser, output_interval, read_fn)
 
 
 if __name__ == '__main__':
@@ -15,6 +15,10 @@ import math
 import json
 from datetime import datetime, timezone
 from settings import Settings
+from stats import Stats
+
+# runtime counters, published to the stats directory
+stats = Stats('analysis_to_csv.py')
 
 
 def string_to_dict(line):
@@ -24,7 +28,8 @@ def string_to_dict(line):
                    'mean_volt_ampere','watt_hour','volt_ampere_reactive_hour',\
                    'volt_ampere_hour','hours','power_factor','crest_factor_current','frequency',\
                    'rms_leakage_current','total_harmonic_distortion_voltage_percentage',\
-                   'total_harmonic_distortion_current_percentage']
+                   'total_harmonic_distortion_current_percentage','missing_samples_in_window',\
+                   'gap_hours']
     try:
         analysis = json.loads(line)
         # insert timestamp, rounded down to nearest second
@@ -40,34 +45,47 @@ def string_to_dict(line):
         raise ValueError
     return filtered_analysis
 
-def main():
-    # The only purpose we create st object is to to trap CTRL-C (SIGINT) signal.
-    # This signal is used to control reload of settings in other programs 
-    # in the project but unavoidably also received by this program.
-    st=Settings(reload_on_signal=False)
-
-    program_name = sys.argv[0]
-    # open up a csv object to write to stdout
+def write_csv(lines, output, program_name=sys.argv[0]):
+    """Converts each line of analysis results from the lines iterable and writes it
+    to the output file as a CSV row. The first row written contains the headers."""
+    # open up a csv object to write to the output
     # We use \n rather than os.linesep because the stdout stream object already
     # converts \n to \r\n on Windows.
-    csv_writer = csv.writer(sys.stdout, lineterminator='\n') 
+    csv_writer = csv.writer(output, lineterminator='\n') 
+    lines = stats.timed(lines)
+    line = ''
     try:
         # skip the first two lines, to allow averages to be established
-        line = sys.stdin.readline()
-        line = sys.stdin.readline()
+        line = next(lines)
+        line = next(lines)
         # for the third line, we push out both headers and data
-        line = sys.stdin.readline()
+        line = next(lines)
         analysis = string_to_dict(line)
         csv_writer.writerow(analysis.keys())
         csv_writer.writerow(analysis.values())
+        stats.count_in(3)
+        stats.count_out(1)
         # for the subsequent lines, we write data only
-        for line in sys.stdin:
+        for line in lines:
             analysis = string_to_dict(line)
             csv_writer.writerow(analysis.values())
+            stats.count_in(1)
+            stats.count_out(1)
+    except StopIteration:
+        pass
     except (OSError, IOError, ValueError):
-        print(f"{program_name}, main(): Failed to process '{line.strip()}', quitting.",\
+        print(f"{program_name}, write_csv(): Failed to process '{line.strip()}', quitting.",\
                   file=sys.stderr) 
 
+def main():
+    # The only purpose we create st object is to to trap CTRL-C (SIGINT) signal.
+    # This signal is used to control reload of settings in other programs 
+    # in the project but unavoidably also received by this program.
+    st=Settings(reload_on_signal=False)
+
+    program_name = sys.argv[0]
+    write_csv(sys.stdin, sys.stdout, program_name)
+
 
 if __name__ == '__main__':
     main()
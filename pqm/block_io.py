@@ -0,0 +1,315 @@
+#  _     _            _        _
+# | |__ | | ___   ___| | __   (_) ___   _ __  _   _
+# | '_ \| |/ _ \ / __| |/ /   | |/ _ \ | '_ \| | | |
+# | |_) | | (_) | (__|   <    | | (_) || |_) | |_| |
+# |_.__/|_|\___/ \___|_|\_\___|_|\___(_) .__/ \__, |
+#                        |_____|       |_|    |___/
+#
+# Block-oriented sample stream formats shared by the pipeline programs.
+#
+# The binary sample stream is an alternative to the hexadecimal text lines
+# output by reader.py. Each block consists of a small header followed by the
+# sample records exactly as they are received from the Pico:
+#
+#   header:  magic (2 bytes), sample count (uint16), sequence number of the
+#            first sample in the block (uint32), all big-endian
+#   records: sample count * 8 bytes, four channels of big-endian 16 bit two's
+#            complement readings per sample
+#
+# The magic bytes allow a reader to resynchronise if the stream is corrupted.
+#
+# The Pico can also frame each page of samples that it sends over USB, when
+# stream.py is started with the 'framed' option (see pico/stream.py):
+#
+#   header:  magic (2 bytes), page type (uint8), flags (uint8), page sequence
+#            number (uint16), payload length in bytes (uint16), CRC16 (uint16),
+#            all big-endian
+#   flags:   bit 0 is set on the first page sent after a buffer overrun on the
+#            Pico, when unsent pages were skipped
+#   payload: for page type 0, sample records as in the binary block format
+#            for page type 1, delta encoded sample records: starting from zero,
+#            the difference between each reading and the previous reading of
+#            the same channel, modulo 2**16, zigzag encoded as an unsigned
+#            little-endian base 128 varint
+#            for page type 2, one reduced record (see reduction.py), and the
+#            page sequence number counts records instead of pages
+#
+# The CRC is CRC-16/CCITT with initial value 0xffff, calculated over the header
+# fields from the page type to the payload length, then the payload. Lost or
+# extra bytes, or corrupted data, are detected, and the decoder scans for the
+# next good page.
+#
+# The waveform frames from framer.py to hellebores.py are text lines, with a line
+# of dots at the end of each frame. With the --binary_frames option, each frame is
+# sent in one piece instead:
+#
+#   header:  magic (2 bytes), flags (uint16), frame number (uint32), sample
+#            count (uint32), all little-endian
+#   flags:   bit 0 is set if the framer is stopped, so that no more frames will
+#            follow until it runs again, bit 1 if the inrush trigger fired
+#   points:  sample count rows of five little-endian int16 pixel coordinates, x
+#            then y for voltage, current, power and earth leakage current
+#
+# Frames only pass between programs on the same computer, so there is no CRC, and
+# the points can be loaded directly with numpy.frombuffer().
+#
+# Text streams can also be read in blocks of lines. A latency bound makes sure
+# that a partial block is passed on if the input stalls.
+
+import os
+import sys
+import time
+import select
+import struct
+import binascii
+import numpy as np
+
+
+BINARY_MAGIC = b'PQ'
+BINARY_HEADER = struct.Struct('>2sHI')
+RECORD_SIZE = 8                      # bytes per sample, 4 channels * 16 bits
+MAX_BLOCK_SAMPLES = 4096             # larger sample counts are treated as corruption
+
+PAGE_MAGIC = b'\xa5\x5a'
+PAGE_HEADER = struct.Struct('>2sBBHHH')
+PAGE_SAMPLES = 0                     # page type for raw sample records
+PAGE_DELTA = 1                       # page type for delta encoded sample records
+PAGE_REDUCED = 2                     # page type for a reduced record
+PAGE_OVERRUN = 0x01                  # flag: the Pico skipped pages before this one
+MAX_PAGE_PAYLOAD = MAX_BLOCK_SAMPLES * RECORD_SIZE
+
+FRAME_MAGIC = b'WF'
+FRAME_HEADER = struct.Struct('<2sHII')
+FRAME_COLUMNS = 5                    # x, then y for each of the four channels
+FRAME_DTYPE = '<i2'                  # numpy type of the pixel coordinates
+FRAME_ROW_SIZE = FRAME_COLUMNS * 2   # bytes per sample
+FRAME_STOPPED = 0x01                 # flag: the framer is stopped
+FRAME_INRUSH = 0x02                  # flag: the inrush trigger fired
+MAX_FRAME_SAMPLES = 1 << 20          # larger sample counts are treated as corruption
+
+
+def unwrap_sequence(sequence, expected, bits=32):
+    """Stream headers hold the low bits of a sequence number. Returns the full
+    sequence number that is nearest to the expected one."""
+    modulus = 1 << bits
+    delta = (sequence - expected) & (modulus - 1)
+    if delta >= modulus // 2:
+        delta -= modulus
+    return expected + delta
+
+
+def binary_block(bs, sequence):
+    """Returns the header and records for bytes-like object bs as a single bytes object."""
+    return BINARY_HEADER.pack(BINARY_MAGIC, len(bs) // RECORD_SIZE, sequence & 0xffffffff) + bs
+
+
+def read_binary_blocks(stream, program_name='block_io.py'):
+    """Generator that reads binary blocks from a binary stream and yields tuples of
+    (sequence, records), where records is a bytes object containing a whole number of
+    samples. If the header is not recognised, the stream is scanned byte by byte until
+    the magic bytes are found again. The generator returns at end of stream."""
+    header = stream.read(BINARY_HEADER.size)
+    while len(header) == BINARY_HEADER.size:
+        magic, count, sequence = BINARY_HEADER.unpack(header)
+        if magic != BINARY_MAGIC or count > MAX_BLOCK_SAMPLES:
+            print(f'{program_name}, read_binary_blocks(): Lost synchronisation, '
+                  'scanning for next block.', file=sys.stderr)
+            # shift along by one byte and try again
+            header = header[1:] + stream.read(1)
+            continue
+        records = stream.read(count * RECORD_SIZE)
+        if len(records) < count * RECORD_SIZE:
+            break
+        yield (sequence, records)
+        header = stream.read(BINARY_HEADER.size)
+
+
+def page_crc(fields, payload):
+    """CRC16 of the header fields after the magic bytes, followed by the payload."""
+    return binascii.crc_hqx(payload, binascii.crc_hqx(fields, 0xffff))
+
+
+def encode_page(page_type, flags, sequence, payload):
+    """Returns a framed page in the same format as the Pico sends, as a bytes object."""
+    fields = PAGE_HEADER.pack(PAGE_MAGIC, page_type, flags, sequence & 0xffff, len(payload), 0)[2:8]
+    return PAGE_MAGIC + fields + struct.pack('>H', page_crc(fields, payload)) + payload
+
+
+def delta_encode(records):
+    """Delta encodes sample records in the same way as pico/stream.py, with array
+    operations. The inverse of reader.delta_decode()."""
+    readings = np.frombuffer(records, dtype='>u2').astype(np.int64).reshape(-1, 4)
+    # differences from the previous reading of the same channel, as 16 bit signed
+    deltas = (np.diff(readings, axis=0, prepend=0) + 0x8000) % 0x10000 - 0x8000
+    z = np.where(deltas >= 0, deltas << 1, ((-deltas) << 1) - 1).ravel()
+    n_bytes = 1 + (z >= 0x80) + (z >= 0x4000)
+    starts = np.cumsum(n_bytes) - n_bytes
+    bs = np.empty(n_bytes.sum(), dtype=np.uint8)
+    for k in range(3):
+        m = n_bytes > k
+        bs[starts[m] + k] = ((z[m] >> (7 * k)) & 0x7f) | np.where(n_bytes[m] > k + 1, 0x80, 0)
+    return bs.tobytes()
+
+
+def encode_sample_page(sequence, records, delta, flags=0):
+    """Returns a framed page of sample records, as stream.py sends with the 'framed'
+    or 'delta' option. A delta page falls back to a raw page if delta encoding
+    doesn't make it shorter."""
+    if delta:
+        encoded = delta_encode(records)
+        if len(encoded) < len(records):
+            return encode_page(PAGE_DELTA, flags, sequence, encoded)
+    return encode_page(PAGE_SAMPLES, flags, sequence, records)
+
+
+class Page_decoder:
+    """Splits a byte stream from the Pico back into framed pages. Bytes that are not
+    part of a page with a valid header and CRC are skipped, and the decoder scans
+    for the magic bytes of the next page. report(message) is called when the
+    decoder loses synchronisation or finds a corrupted page."""
+
+    def __init__(self, report=None):
+        self.buffer = bytearray()
+        self.report = report or (lambda message: None)
+        self.in_sync = True
+        self.first_sequence = None        # header sequence number of the first page
+        self.expected = None              # unwrapped sequence number expected next
+        self.pages = 0
+        self.corrupt_pages = 0
+        self.skipped_bytes = 0
+
+    def _skip(self, n):
+        if n > 0:
+            self.skipped_bytes += n
+            if self.in_sync:
+                self.report(f'block_io.py, Page_decoder.decode(): Lost synchronisation, '
+                            f'scanning for next page.')
+                self.in_sync = False
+
+    def decode(self, data):
+        """Adds data from the stream, and returns a list of tuples of (page_type, flags,
+        page_number, payload) for the complete pages found. page_number counts from the
+        first page received, unwrapped from the 16 bit number in the header, so that
+        lost pages show as a jump."""
+        buffer = self.buffer
+        buffer += data
+        pages = []
+        start = 0
+        while True:
+            i = buffer.find(PAGE_MAGIC, start)
+            if i < 0:
+                # keep the last byte, in case it is the first of the magic bytes
+                end = max(start, len(buffer) - 1)
+                self._skip(end - start)
+                start = end
+                break
+            self._skip(i - start)
+            start = i
+            if len(buffer) - start < PAGE_HEADER.size:
+                break
+            _, page_type, flags, sequence, length, crc = PAGE_HEADER.unpack_from(buffer, start)
+            end = start + PAGE_HEADER.size + length
+            if length <= MAX_PAGE_PAYLOAD and len(buffer) < end:
+                break
+            if (length > MAX_PAGE_PAYLOAD
+                or page_crc(buffer[start+2:start+8], buffer[start+PAGE_HEADER.size:end]) != crc):
+                # a corrupted page, or a false match of the magic bytes while scanning
+                if self.in_sync:
+                    self.corrupt_pages += 1
+                    self.report(f'block_io.py, Page_decoder.decode(): Corrupted page, '
+                                f'scanning for next page.')
+                    self.in_sync = False
+                self.skipped_bytes += 1
+                start += 1
+                continue
+            self.in_sync = True
+            if self.first_sequence is None:
+                self.first_sequence = self.expected = sequence
+            sequence = unwrap_sequence(sequence, self.expected, 16)
+            self.expected = sequence + 1
+            pages.append((page_type, flags, sequence - self.first_sequence,
+                          bytes(buffer[start+PAGE_HEADER.size:end])))
+            self.pages += 1
+            start = end
+        del buffer[:start]
+        return pages
+
+
+def encode_frame(frame_number, flags, points):
+    """Returns a binary waveform frame as a bytes object. points is a bytes-like
+    object holding the pixel coordinates, FRAME_ROW_SIZE bytes for each sample."""
+    return (FRAME_HEADER.pack(FRAME_MAGIC, flags, frame_number & 0xffffffff,
+                              len(points) // FRAME_ROW_SIZE) + points)
+
+
+class Frame_decoder:
+    """Splits a byte stream of binary waveform frames back into frames. If a header is
+    not recognised, the decoder scans for the magic bytes of the next frame."""
+
+    def __init__(self, program_name='block_io.py'):
+        self.buffer = bytearray()
+        self.program_name = program_name
+        self.in_sync = True
+
+    def decode(self, data):
+        """Adds data from the stream, and returns a list of tuples of (frame_number,
+        flags, points) for the complete frames found."""
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        start = 0
+        while len(buffer) - start >= FRAME_HEADER.size:
+            magic, flags, frame_number, count = FRAME_HEADER.unpack_from(buffer, start)
+            if magic != FRAME_MAGIC or count > MAX_FRAME_SAMPLES:
+                i = buffer.find(FRAME_MAGIC, start + 1)
+                if self.in_sync:
+                    print(f'{self.program_name}, Frame_decoder.decode(): Lost synchronisation, '
+                          'scanning for next frame.', file=sys.stderr)
+                    self.in_sync = False
+                start = i if i >= 0 else len(buffer) - 1
+                continue
+            end = start + FRAME_HEADER.size + count * FRAME_ROW_SIZE
+            if len(buffer) < end:
+                break
+            self.in_sync = True
+            frames.append((frame_number, flags, bytes(buffer[start+FRAME_HEADER.size:end])))
+            start = end
+        del buffer[:start]
+        return frames
+
+
+def read_text_blocks(stream, block_size, max_latency=None):
+    """Generator that reads lines of text from a stream and yields them in lists of
+    block_size lines, without line endings. If max_latency (seconds) is set, a partial
+    block is yielded when that time has passed since its first line was received,
+    even if the input has stalled. The latency bound depends on select(), so it only
+    applies on posix systems. Remaining lines are yielded at end of stream."""
+    fd = stream.fileno()
+    use_deadline = max_latency is not None and os.name == 'posix'
+    lines = []
+    remainder = b''
+    deadline = None
+    while True:
+        if use_deadline and lines:
+            timeout = max(deadline - time.monotonic(), 0.0)
+            if not select.select([fd], [], [], timeout)[0]:
+                yield lines
+                lines = []
+                continue
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        if not lines:
+            deadline = time.monotonic() + (max_latency or 0.0)
+        parts = (remainder + chunk).split(b'\n')
+        # the last part is an incomplete line, or empty if the chunk ended with a newline
+        remainder = parts.pop()
+        lines.extend(p.rstrip(b'\r').decode('utf-8', errors='replace') for p in parts)
+        while len(lines) >= block_size:
+            yield lines[:block_size]
+            lines = lines[block_size:]
+            deadline = time.monotonic() + (max_latency or 0.0)
+    if remainder:
+        lines.append(remainder.rstrip(b'\r').decode('utf-8', errors='replace'))
+    if lines:
+        yield lines
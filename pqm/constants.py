@@ -55,6 +55,7 @@ SETTINGS_BOX_SIZE = (500,400)        # 'dialog' boxes
 SETTINGS_BOX_POSITION = (690,100)    # top right corner
 DATETIME_POSITION = (0,0)
 WFS_POSITION = (640,0)
+PIPELINE_HEALTH_POSITION = (0,360)
 METER_POSITION = (0,32)
 BUTTON_SIZE = (86,50)
 BUTTON_WIDE_SIZE = (180,50)
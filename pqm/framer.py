@@ -16,43 +16,102 @@
 # sync trigger. The logic is inter-twined and edits are liable to have unintended
 # consequences. So edit with care!
 #
+# Reduced records from scaler.py (see reduction.py) are stored as two buffer
+# entries, the minimum then the maximum of each quantity, so that the waveform
+# is drawn as an envelope. Each entry then stands for half of the samples in
+# the record, and the frame is sized in entries instead of samples.
+#
+# The buffer is a preallocated numpy array, and incoming samples are stored a
+# block at a time. Frames are taken from the buffer as array slices. Each block is
+# searched for trigger crossings and inrush currents in one go, and only the
+# samples where a trigger could fire or a frame is ready go through the per-sample
+# trigger logic below.
+#
+# With the --binary_frames option, each frame is sent to hellebores.py as a binary
+# frame of pixel coordinates (see block_io.py) instead of text lines.
+#
+# When the framer stops, it reads on for MAX_FORWARD_READ samples after the
+# trigger, then freezes a copy of the buffer into a Capture. While stopped, frames
+# are re-framed from the capture as soon as the settings change, and the buffer
+# carries on storing samples so that it has fresh ones when the framer runs again.
+#
+# With the --history_seconds option, the buffer entries are also recorded in a
+# deep memory ring (see history.py). While stopped, the history_offset setting
+# then selects an earlier frame to show instead of the stopped one.
+#
+# The sync trigger can be set in settings.json to any of the four channels, at any
+# level, and to an edge, window or pulse width condition (see trigger_candidates()
+# below). The inrush trigger can be set to any channel too.
+#
+# At slow timebases there are many more samples in a frame than pixel columns on
+# screen. Mapped frames are then decimated to the minimum and maximum of each
+# channel in each column, in the order they occurred, so that peaks and glitches
+# are still drawn with a fraction of the points.
+#
 
 import sys
+import time
 import signal
 import argparse
 import math
+import numpy as np
 
 # local
 from constants import *
 from settings import Settings
+from shm_ring import Ring_reader
+from history import Capture, History
+from block_io import read_text_blocks, encode_frame, FRAME_DTYPE, FRAME_STOPPED, FRAME_INRUSH
+from reduction import (REDUCED_MARKER, SCALED_COLUMNS, TIME, COUNT, V_MIN, V_MAX, I_MIN, I_MAX,
+                       P_MIN, P_MAX, L_MIN, L_MAX)
+from stats import Stats
 
 
 BUFFER_SIZE = 65536                  # size of circular sample buffer
-MAX_FORWARD_READ = 8192              # maximum reads, post trigger after stopping
-SHORT_DOTS = '.' * 32                # used in running mode to mark end of frame
-LONG_DOTS = '.' * 8192               # a longer line of dots is used in stopped mode
-                                     # to make sure all data is flushed through
+# float32 isn't precise enough for the last digit of power in values output at
+# full load, about 2e4 W
+BUFFER_DTYPE = np.float64            # each buffer entry is four values of this type
+MAX_FORWARD_READ = 8192              # reads post trigger after stopping, before the
+                                     # capture is frozen
+SHORT_DOTS = '.' * 32                # used to mark end of frame
+PIXELS_LINE = '%4d %4d %4d %4d %4d\n'                  # output line formats, a whole
+VALUES_LINE = '%12.4f %10.3f %10.5f %10.3f %12.7f\n'  # frame is formatted in one go
+TEXT_BLOCK_SIZE = 128                # text input is read in blocks of lines, or
+MAX_LATENCY = 0.05                   # fewer if the input stalls for this long (s)
+DECIMATE_SAMPLES_PER_PIXEL = 2       # mapped frames are decimated when there are more
+                                     # samples than this in each pixel column
+
+# runtime counters, published to the stats directory
+stats = Stats('framer.py')
 
 VOLTAGE_INDEX = 0                    # Indices for fields in the incoming data
 CURRENT_INDEX = 1                    # are defined here
 POWER_INDEX = 2
 EARTH_LEAKAGE_INDEX = 3
+TRIGGER_CHANNELS = { 'voltage': VOLTAGE_INDEX, 'current': CURRENT_INDEX,
+                     'power': POWER_INDEX, 'earth_leakage': EARTH_LEAKAGE_INDEX }
+TRIGGER_TYPES = [ 'edge', 'window', 'pulse' ]
 
 
 class Mapper:
-    """Converts SI units into pixel coordinates."""
+    """Converts SI units into pixel coordinates. A whole frame is mapped at once, with
+    array operations."""
     st = None
     # these parameters are set up on initialisation
     output_function = lambda: None
     x_zero = 0
     y_zero = Y_MAX // 2
 
-    def __init__(self, st, output_format):
+    def __init__(self, st, output_format, decimate=True):
         self.st = st
+        self.output_format = output_format
+        self.decimate = decimate
         self.configure_for_new_settings()
         # select an appropriate output transformation function
         if output_format == 'pixels':
             self.output_function = self._pixels_out
+        elif output_format == 'binary':
+            self.output_function = self._binary_out
         else:
             self.output_function = self._values_out
 
@@ -61,28 +120,65 @@ class Mapper:
         self.x_zero    = (self.st.time_axis_pre_trigger_divisions
                           * self.st.horizontal_pixels_per_division)
 
-    def _pixels_out(self, timestamp, sample):
-        """Prepare a line of stored buffer for output with pixel scaling."""
-        # Clamping function to avoid exception errors in plotting.
-        y_clamp = lambda v: min(max(Y_MIN, v), Y_MAX)
-
-        c0, c1, c2, c3 = sample
-        x  = int(timestamp * self.st.horizontal_pixels_per_division
-                  / self.st.time_axis_per_division) + self.x_zero
-        y0 = y_clamp(int(- float(c0) * self.st.vertical_pixels_per_division
-                  / self.st.voltage_axis_per_division) + self.y_zero)
-        y1 = y_clamp(int(- float(c1) * self.st.vertical_pixels_per_division
-                  / self.st.current_axis_per_division) + self.y_zero)
-        y2 = y_clamp(int(- float(c2) * self.st.vertical_pixels_per_division
-                  / self.st.power_axis_per_division) + self.y_zero)
-        y3 = y_clamp(int(- float(c3) * self.st.vertical_pixels_per_division
-                  / self.st.earth_leakage_current_axis_per_division) + self.y_zero)
-        return f'{x :4d} {y0 :4d} {y1 :4d} {y2 :4d} {y3 :4d}'
-
-    def _values_out(self, timestamp, sample):
-        """Prepare a line of stored buffer for output with raw values."""
-        c0, c1, c2, c3 = sample
-        return f'{timestamp:12.4f} {c0:10.3f} {c1:10.5f} {c2:10.3f} {c3:12.7f}'
+    def map_pixels(self, timestamps, samples):
+        """Returns an integer array of pixel coordinates for a frame of stored buffer,
+        with a row of x, y0, y1, y2, y3 for each sample."""
+        axes_per_division = np.array([ self.st.voltage_axis_per_division,
+                                       self.st.current_axis_per_division,
+                                       self.st.power_axis_per_division,
+                                       self.st.earth_leakage_current_axis_per_division ])
+        # conversion to integer truncates towards zero
+        x  = (timestamps * self.st.horizontal_pixels_per_division
+                  / self.st.time_axis_per_division).astype(np.int64) + self.x_zero
+        ys = (- np.asarray(samples, dtype=np.float64) * self.st.vertical_pixels_per_division
+                  / axes_per_division).astype(np.int64) + self.y_zero
+        # Clamp to avoid exception errors in plotting.
+        ys = np.clip(ys, Y_MIN, Y_MAX)
+        points = np.column_stack((x, ys))
+        if self.decimate:
+            points = self.min_max_decimate(points)
+        return points
+
+    def min_max_decimate(self, points):
+        """If there are more than DECIMATE_SAMPLES_PER_PIXEL samples in each pixel
+        column on average, returns two rows for each column with the minimum and
+        maximum of each channel, in the order that they occurred. Otherwise the points
+        are returned unchanged, so fast timebases are not affected."""
+        x = points[:,0]
+        # x doesn't decrease through the frame, so each column is a run of rows
+        starts = np.flatnonzero(np.diff(x, prepend=x[:1] - 1))
+        if len(points) <= DECIMATE_SAMPLES_PER_PIXEL * len(starts):
+            return points
+        counts = np.diff(starts, append=len(points))
+        rows = np.arange(len(points))
+        decimated = np.empty((2 * len(starts), points.shape[1]), dtype=points.dtype)
+        decimated[:,0] = np.repeat(x[starts], 2)
+        for c in range(1, points.shape[1]):
+            ys = points[:,c]
+            extremes = (np.minimum.reduceat(ys, starts), np.maximum.reduceat(ys, starts))
+            # the first row in each column where the lowest and highest values occur
+            lowest, highest = (np.minimum.reduceat(np.where(ys == np.repeat(e, counts), rows, len(ys)),
+                                                   starts) for e in extremes)
+            decimated[0::2,c] = ys[np.minimum(lowest, highest)]
+            decimated[1::2,c] = ys[np.maximum(lowest, highest)]
+        return decimated
+
+    def _pixels_out(self, timestamps, samples):
+        """Prepare a frame of stored buffer for output with pixel scaling, and return
+        it as text with a line for each sample."""
+        points = self.map_pixels(timestamps, samples)
+        return (PIXELS_LINE * len(points)) % tuple(points.ravel().tolist())
+
+    def _binary_out(self, timestamps, samples):
+        """Prepare a frame of stored buffer for output with pixel scaling, and return
+        the pixel coordinates as bytes in the binary frame format."""
+        return self.map_pixels(timestamps, samples).astype(FRAME_DTYPE).tobytes()
+
+    def _values_out(self, timestamps, samples):
+        """Prepare a frame of stored buffer for output with raw values, and return it
+        as text with a line for each sample."""
+        values = np.column_stack((timestamps, np.asarray(samples, dtype=np.float64)))
+        return (VALUES_LINE * len(values)) % tuple(values.ravel().tolist())
 
 
 
@@ -90,7 +186,8 @@ class Buffer:
     """Local buffer memory for samples. Enables framing of data to be constructed while
     searching for a trigger. Also allows data frame to be modified in stopped mode."""
     st = None                   # will hold settings object
-    buf = []                    # will be array of 5*float vectors, ie BUFFER_SIZE * 5
+    output_file = None          # frames are printed here, stdout unless set otherwise
+    buf = None                  # will be array of BUFFER_SIZE * 4 values
     # Frame pointers are set after trigger pointer is set, in sync/inrush mode,
     # immediately after frame output in free-run mode, and when settings are changed,
     # including in stopped mode.
@@ -103,6 +200,7 @@ class Buffer:
     sp = 0                      # storage pointer (advances by 1 for every new sample)
     tp = 0                      # trigger pointer (in running mode, this is moved
                                 # forward when trigger condition is next satisfied)
+    frame_number = 0            # counts the frames output
     sync_holdoff_counter = 0    # inhibits the sync trigger for N samples
     inrush_holdoff_counter = 0  # inhibits the inrush trigger for N samples
     frame_samples = 0           # the total number of samples in a frame, derived from
@@ -112,6 +210,9 @@ class Buffer:
     post_trigger_samples = 0    # the number of samples displayed after the trigger
     sync_holdoff_samples = 0    # the next sync trigger is inhibited for this number of
                                 # samples
+    entry_samples = 1.0         # the number of samples that each buffer entry stands
+                                # for, more than one for reduced records. The frame
+                                # pointers and counters above count entries.
     # freerun_interpolation_increment corrects for creeping time error in freerun mode
     # it's set up when new settings are applied
     freerun_interpolation_increment = 0
@@ -122,6 +223,12 @@ class Buffer:
     frame_triggered = False
     inrush_triggered = False
     stop_flag = False
+    # capture holds the stopped frame, once the forward read after stopping is complete
+    capture = None
+    # history, if there is one, records the entries and the frame triggers, and
+    # history_capture holds an earlier frame taken from it while stopped
+    history = None
+    history_capture = None
     # When there is a successful trigger, the trigger_test_fn will calculate an estimate
     # of the fractional time offset between samples when the trigger took place.
     # The interpolation fraction is used to create an accurate time offset which helps
@@ -129,36 +236,103 @@ class Buffer:
     # In freerun mode, we use the same parameter to correct for framing time errors so
     # that framing drift is compensated.
     interpolation_fraction = 0.0
-    # trigger_test_fn once defined takes two arguments, previous and current samples
+    # trigger_test_fn once defined takes three arguments, the results of the block
+    # trigger search for the current sample: whether it meets the sync trigger
+    # condition, the interpolation fraction, and whether the inrush level was exceeded
     # returns True or False depending on whether a trigger criterion (defined
     # inside the function) is met. This function is dynamically redefined for mode-specific
     # logic when settings are changed
-    trigger_test_fn = lambda self, s1, s2: False
-
-
-    def __init__(self, st):
+    trigger_test_fn = lambda self, crossing, fraction, exceedance: False
+    # The block trigger search is set up at the same time, from the trigger settings.
+    # sync_trigger_slope is None in freerun mode.
+    sync_trigger_slope = None
+    sync_trigger_channel = VOLTAGE_INDEX
+    sync_trigger_level = 0.0
+    sync_trigger_type = 'edge'
+    sync_trigger_window = 0.0   # half width of the window around the level
+    pulse_width_samples = 0.0   # minimum pulse width, in buffer entries
+    pulse_run = 0               # entries beyond the level, up to the last one searched
+    inrush_trigger_enabled = False
+    inrush_trigger_channel = CURRENT_INDEX
+
+
+    def __init__(self, st, output_file=None, history=None):
         """Set up the buffer with settings read from st object."""
         self.st = st
+        self.output_file = output_file or sys.stdout
+        self.history = history
         self.clear_buffer()
         self.configure_for_new_settings()
 
     def clear_buffer(self):
         """Buffer memory initialised with empty data"""
-        # *** Performance optimisation: could consider memoryview object and tuples here ***
-        # Consider whether we need to store time data at all
-        self.buf = [ [0.0, 0.0, 0.0, 0.0] for i in range(BUFFER_SIZE) ]
-
-    def store_line(self, line):
-        """Store a line of new data into the next buffer location"""
-        # The storage location is determined by the input pointer sp, which is not intended
-        # to be manipulated other than here.
-        self.sp += 1
-        try:
-            self.buf[self.sp % BUFFER_SIZE] = [ float(w) for w in line.split()[1:] ]
-        except ValueError:
-            self.buf[self.sp % BUFFER_SIZE] = [0.0, 0.0, 0.0, 0.0]
-            print(f"trigger.py, store_line(): Couldn't interpret '{line}'.",
-                file=sys.stderr)
+        self.buf = np.zeros((BUFFER_SIZE, 4), dtype=BUFFER_DTYPE)
+
+    def latest_sample(self):
+        """Returns the most recently stored sample as a list of four values."""
+        return self.buf[self.sp % BUFFER_SIZE].tolist()
+
+    def store_block(self, block):
+        """Store a block of new data into the buffer locations following the storage
+        pointer. The storage pointer sp is then moved on by advance(), as the samples
+        are tested for triggers. In stopped mode, the capture is frozen when the block
+        reaches MAX_FORWARD_READ samples after the trigger."""
+        n = len(block)
+        forward = n
+        if self.st.run_mode == 'stopped' and not self.capture:
+            forward = max(0, min(n, self.tp + MAX_FORWARD_READ + 1 - self.sp))
+        self.write_entries(self.sp + 1, block[:forward])
+        if forward < n:
+            self.freeze_capture(self.sp + forward)
+            self.write_entries(self.sp + forward + 1, block[forward:])
+
+    def write_entries(self, pointer, entries):
+        """Write entries into the buffer from pointer, splitting them in two if they
+        wrap round the end of the buffer. They are also recorded in the history, until
+        the capture is frozen."""
+        if self.history and not self.capture:
+            self.history.write(pointer, entries)
+        n = len(entries)
+        start = pointer % BUFFER_SIZE
+        first = min(n, BUFFER_SIZE - start)
+        self.buf[start:start+first] = entries[:first]
+        self.buf[:n-first] = entries[first:]
+
+    def freeze_capture(self, last):
+        """Copy the whole buffer, up to and including the entry at pointer last, into
+        a capture that holds the stopped frame."""
+        positions = np.arange(last - BUFFER_SIZE + 1, last + 1)
+        self.capture = Capture(self.buf[positions % BUFFER_SIZE], positions[0], self.tp,
+                               self.interpolation_fraction, self.st.interval * self.entry_samples)
+        self.select_history_capture()
+
+    def select_history_capture(self):
+        """While stopped, takes the frame selected by the history_offset setting from
+        the history, sized for the current timebase. It is taken again whenever the
+        settings change. The stopped frame is shown if the offset is zero, or if there
+        is no history or it doesn't go back that far."""
+        self.history_capture = None
+        if self.capture and self.history and self.st.history_offset > 0:
+            self.history_capture = self.history.capture(self.st.history_offset, self.tp,
+                                                        self.pre_trigger_samples,
+                                                        self.frame_samples)
+
+    def advance(self, n=1):
+        """Move the storage pointer on by n samples stored by store_block(). The
+        storage pointer is not intended to be manipulated other than here."""
+        self.sp += n
+
+    def count_down_holdoff(self, n=1):
+        """Decrement the holdoff counters for n samples."""
+        self.sync_holdoff_counter -= n
+        self.inrush_holdoff_counter -= n
+
+    def set_entry_samples(self, entry_samples):
+        """Sets the number of samples that each buffer entry stands for, and resizes
+        the frame if it has changed."""
+        if entry_samples != self.entry_samples:
+            self.entry_samples = entry_samples
+            self.configure_for_new_settings()
 
     def update_frame_markers(self):
         """Call this after frame is re-primed or a new trigger is detected, to set the frame
@@ -181,79 +355,170 @@ class Buffer:
         self.frame_triggered = False
         self.inrush_triggered = False
 
-    def trigger_test(self):
-        """Call this to check if current sample causes a trigger"""
-        self.trigger_test_fn(
-            # Take the channel reading for two successive samples and compare
-            # against the trigger criteria
-            self.buf[(self.sp - 1) % BUFFER_SIZE],
-            self.buf[self.sp % BUFFER_SIZE])
+    def trigger_test(self, candidates, j):
+        """Call this to check if current sample causes a trigger. It is sample j of the
+        block that trigger_candidates() returned candidates for."""
+        # Take the results of the block trigger search for the sample and check them
+        # against the trigger state
+        crossings, fractions, exceedances = candidates
+        self.trigger_test_fn(bool(crossings[j]), float(fractions[j]), bool(exceedances[j]))
         # We only update frame markers and set holdoff if this is a 'new' trigger
         if (self.frame_triggered and not self.reframed) or self.inrush_triggered:
             self.sync_holdoff_counter = self.sync_holdoff_samples
             self.update_frame_markers()
 
+    def trigger_candidates(self, block, previous):
+        """Searches a block of samples for the trigger conditions, without regard to
+        the holdoff counters or trigger flags. Returns three arrays: the samples that
+        meet the sync trigger condition, the interpolation fraction between each sample
+        and the one before it where the trigger level was crossed, and the samples that
+        follow one exceeding the inrush trigger level. previous is the sample before
+        the block. Every block must be searched, in order, because a pulse can carry
+        on from one block into the next."""
+        values = np.vstack((previous, block))
+        crossings = np.zeros(len(block), dtype=bool)
+        fractions = np.zeros(len(block))
+        exceedances = np.zeros(len(block), dtype=bool)
+        if self.sync_trigger_slope:
+            v = values[:, self.sync_trigger_channel]
+            crossings, levels = self.sync_trigger_crossings(v)
+            v1 = v[:-1]
+            v2 = v[1:]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fractions = np.where(v1 != v2, (levels - v1) / (v2 - v1), 0.0)
+        if self.inrush_trigger_enabled:
+            # the inrush test looks at the previous sample of each pair
+            exceedances = (np.abs(values[:-1, self.inrush_trigger_channel])
+                           >= self.st.inrush_trigger_level)
+        return (crossings, fractions, exceedances)
+
+    def sync_trigger_crossings(self, v):
+        """v holds the trigger channel values of the sample before a block and of the
+        block. Returns a boolean array marking the samples of the block that meet the
+        sync trigger condition, and an array of the level crossed at each sample.
+          edge:   the level is crossed in the direction of the slope.
+          window: rising leaves, falling enters the window of sync_trigger_window
+                  either side of the level.
+          pulse:  the level is crossed back at the end of a pulse beyond it, in the
+                  direction of the slope, that lasted at least pulse_width_samples."""
+        v1 = v[:-1]
+        v2 = v[1:]
+        level = self.sync_trigger_level
+        rising = self.sync_trigger_slope == 'rising'
+        if self.sync_trigger_type == 'window':
+            inside1 = np.abs(v1 - level) <= self.sync_trigger_window
+            inside2 = np.abs(v2 - level) <= self.sync_trigger_window
+            crossings = inside1 & ~inside2 if rising else ~inside1 & inside2
+            # the edge of the window that is crossed is on the side of the sample
+            # outside it
+            outside = v2 if rising else v1
+            levels = np.where(outside > level, level + self.sync_trigger_window,
+                              level - self.sync_trigger_window)
+            return (crossings, levels)
+        if self.sync_trigger_type == 'pulse':
+            beyond = v > level if rising else v < level
+            # count the entries in each run beyond the level, carrying on the run at
+            # the end of the last block
+            positions = np.arange(len(v))
+            last_inside = np.maximum.accumulate(np.where(beyond, -1, positions))
+            runs = np.where(last_inside < 0, positions + (self.pulse_run if beyond[0] else 0),
+                            positions - last_inside)
+            self.pulse_run = int(runs[-1])
+            crossings = beyond[:-1] & ~beyond[1:] & (runs[:-1] >= self.pulse_width_samples)
+        elif rising:
+            crossings = (v1 <= level) & (v2 >= level)
+        else:
+            crossings = (v1 >= level) & (v2 <= level)
+        return (crossings, np.full(len(v1), level))
+
+    def next_event(self, candidates, k, n):
+        """Returns the index of the first sample from k in a block of n samples at which
+        a trigger can fire or a frame is ready for output, or n if there is none. The
+        storage pointer is at the sample before sample k. candidates are the arrays
+        returned by trigger_candidates()."""
+        crossings, _, exceedances = candidates
+        events = [ n ]
+        if self.reframed and self.capture:
+            # the stopped frame is re-framed from the capture straight away
+            events.append(k)
+        elif self.reframed:
+            # the frame is output after the sample that moves sp beyond frame_endp
+            events.append(k + max(0, self.frame_endp - self.sp))
+        if self.st.run_mode == 'running' and not self.inrush_triggered:
+            if self.frame_triggered and not self.reframed:
+                # a trigger that hasn't been framed yet, eg after stopped mode
+                events.append(k)
+            if not self.frame_triggered and self.sync_trigger_slope is None:
+                # freerun retriggers at the first test
+                events.append(k)
+            # the holdoff counters are decremented once for every sample, and a
+            # trigger can fire when they have reached zero
+            if not self.frame_triggered and self.sync_trigger_slope:
+                start = k + max(0, self.sync_holdoff_counter)
+                hits = np.flatnonzero(crossings[start:n])
+                if hits.size:
+                    events.append(start + hits[0])
+            if self.inrush_trigger_enabled:
+                start = k + max(0, self.inrush_holdoff_counter)
+                hits = np.flatnonzero(exceedances[start:n])
+                if hits.size:
+                    events.append(start + hits[0])
+        return min(events)
+
     def ready_for_output(self):
-        """Check if we have a new frame and we have stored enough samples to commence output"""
-        return True if self.reframed and self.sp > self.frame_endp else False
+        """Check if we have a new frame and we have stored enough samples to commence output,
+        or we are stopped with a capture to take it from."""
+        return self.reframed and (self.capture is not None or self.sp > self.frame_endp)
 
     def output_frame(self, mapper):
         """Output the array slice with xy shifts to show up in the correct position on screen."""
-        # Exact trigger position occurred between the sample self.tp - 1 and self.tp
-        precise_trigger_position = self.tp - 1 + self.interpolation_fraction
-        for s in range(self.frame_startp, self.frame_endp):
+        capture = self.history_capture or self.capture
+        if capture:
+            timestamps, samples = capture.frame(self.pre_trigger_samples, self.frame_samples)
+        else:
+            # Exact trigger position occurred between the sample self.tp - 1 and self.tp
+            precise_trigger_position = self.tp - 1 + self.interpolation_fraction
+            entry_interval = self.st.interval * self.entry_samples
+            positions = np.arange(self.frame_startp, self.frame_endp)
             # timestamp = 0.0ms at the trigger position
-            timestamp = self.st.interval * (s - precise_trigger_position)
-            sample = self.buf[s % BUFFER_SIZE]
-            print(mapper.output_function(timestamp, sample))
-        # Some frame data will be held in the kernel pipe buffer
+            timestamps = entry_interval * (positions - precise_trigger_position)
+            samples = self.buf[positions % BUFFER_SIZE]
+            if self.history:
+                self.history.add_trigger(self.tp, self.interpolation_fraction, entry_interval)
         # If we're in stopped mode or inrush trigger occurred (which will be followed by
-        # stopped mode), flush it through with a longer line of dots
-        if self.st.run_mode == 'stopped' or self.stop_flag:
-            print(LONG_DOTS)
-            sys.stdout.flush()
+        # stopped mode), no more frames will follow to push this one along, so it is
+        # flushed straight away
+        stopping = self.st.run_mode == 'stopped' or self.stop_flag
+        if mapper.output_format == 'binary':
+            # the flags tell the reader why the frame was sent
+            flags = ((FRAME_STOPPED if stopping else 0)
+                     | (FRAME_INRUSH if self.inrush_triggered else 0))
+            data = encode_frame(self.frame_number, flags, mapper.output_function(timestamps, samples))
         else:
-            print(SHORT_DOTS)
-
-    def build_frame(self, line):
-        """Store samples, except in stopped mode beyond MAX_FORWARD_READ"""
-        if self.st.run_mode == 'stopped' and self.sp - self.tp > MAX_FORWARD_READ:
-            return False
-        else:
-            self.store_line(line)
-            return True
-
-    def i_frac(self, v1, v2, trigger_level):
-        """linear interpolation fraction between two samples"""
-        return (trigger_level - v1) / (v2 - v1) if v1 != v2 else 0.0
-
-    def rising_trigger_test(self, s1, s2, channel_index, trigger_level):
-        """s1 and s2 contain two sample lines. Detect whether the trigger_level is
-        crossed in the rising direction."""
-        v1 = s1[channel_index]
-        v2 = s2[channel_index]
-        if self.sync_holdoff_counter <= 0 and v1 <= trigger_level and v2 >= trigger_level:
+            data = mapper.output_function(timestamps, samples) + SHORT_DOTS + '\n'
+        self.frame_number += 1
+        # the frame is written in one go, so that the time spent blocked on the pipe
+        # can be measured
+        t0 = time.perf_counter()
+        self.output_file.write(data)
+        if stopping or mapper.output_format == 'binary':
+            self.output_file.flush()
+        stats.add_write_wait(time.perf_counter() - t0)
+        stats.count_out(len(timestamps) + 1)
+
+    def sync_trigger_test(self, crossing, fraction):
+        """crossing is True if the current sample meets the sync trigger condition,
+        and fraction is the interpolation fraction where the level was crossed."""
+        if self.sync_holdoff_counter <= 0 and crossing:
             self.frame_triggered = True
             self.tp = self.sp
-            self.interpolation_fraction = self.i_frac(v1, v2, trigger_level)
+            self.interpolation_fraction = fraction
         return self.frame_triggered
 
-    def falling_trigger_test(self, s1, s2, channel_index, trigger_level):
-        """s1 and s2 contain two sample lines. Detect whether the trigger_level is
-        crossed in the falling direction."""
-        v1 = s1[channel_index]
-        v2 = s2[channel_index]
-        if self.sync_holdoff_counter <= 0 and v1 >= trigger_level and v2 <= trigger_level:
-            self.frame_triggered = True
-            self.tp = self.sp
-            self.interpolation_fraction = self.i_frac(v1, v2, trigger_level)
-        return self.frame_triggered
-
-    def inrush_trigger_test(self, s1, channel_index, trigger_level):
-        """s1 contains a single sample line. Detect whether the trigger_level is
-        exceeded."""
-        v1 = s1[channel_index]
-        if self.inrush_holdoff_counter <= 0 and abs(v1) >= trigger_level:
+    def inrush_trigger_test(self, exceedance):
+        """exceedance is True if the sample before the current one exceeded the inrush
+        trigger level."""
+        if self.inrush_holdoff_counter <= 0 and exceedance:
             self.inrush_triggered = True
             self.tp = self.sp
             # raise a flag to stop at this frame
@@ -276,61 +541,226 @@ class Buffer:
             self.tp += 1
         return self.frame_triggered
 
+    def trigger_channel_index(self, channel, default_index):
+        """Returns the index of a trigger channel named in the settings."""
+        if channel in TRIGGER_CHANNELS:
+            return TRIGGER_CHANNELS[channel]
+        print(f"framer.py, trigger_channel_index(): trigger channel '{channel}' isn't one of "
+              f"{list(TRIGGER_CHANNELS)}, using channel {default_index}.", file=sys.stderr)
+        return default_index
+
     def configure_for_new_settings(self):
         """We don't want to process 'mode' logic every time we read a sample. Therefore we create
         a trigger test function dynamically, but do it only when settings are changed."""
-        # Calculate dimensional parameters for the frame
+        # Calculate dimensional parameters for the frame, counted in buffer entries
+        entry_interval = self.st.interval * self.entry_samples
+        entry_rate = self.st.sample_rate / self.entry_samples
         self.frame_samples          = math.floor(self.st.time_axis_divisions
                                           * self.st.time_axis_per_division
-                                          / self.st.interval)
+                                          / entry_interval)
         self.pre_trigger_samples    = math.floor(self.st.time_axis_pre_trigger_divisions
                                           * self.st.time_axis_per_division
-                                          / self.st.interval)
+                                          / entry_interval)
         self.post_trigger_samples   = self.frame_samples - self.pre_trigger_samples
         # Set a hold-off threshold (minimum number of samples between triggers) to be
         # slightly less (2ms) than the frame samples.
-        self.sync_holdoff_samples   = self.frame_samples - int(0.002 * self.st.sample_rate)
+        self.sync_holdoff_samples   = self.frame_samples - int(0.002 * entry_rate)
+
+        # The block trigger search looks for the conditions in the trigger settings
+        sync_mode = self.st.trigger_mode in ['sync', 'inrush']
+        self.sync_trigger_slope = self.st.trigger_slope if sync_mode else None
+        self.sync_trigger_channel = self.trigger_channel_index(self.st.trigger_channel, VOLTAGE_INDEX)
+        self.sync_trigger_level = self.st.trigger_level
+        if self.st.trigger_type in TRIGGER_TYPES:
+            self.sync_trigger_type = self.st.trigger_type
+        else:
+            print(f"framer.py, configure_for_new_settings(): trigger type '{self.st.trigger_type}' "
+                  f"isn't one of {TRIGGER_TYPES}, using 'edge'.", file=sys.stderr)
+            self.sync_trigger_type = 'edge'
+        self.sync_trigger_window = abs(self.st.trigger_window)
+        self.pulse_width_samples = self.st.trigger_pulse_width / entry_interval
+        self.pulse_run = 0
+        self.inrush_trigger_enabled = self.st.trigger_mode == 'inrush'
+        self.inrush_trigger_channel = self.trigger_channel_index(self.st.inrush_trigger_channel,
+                                                                 CURRENT_INDEX)
 
         # Setup a composite trigger function and store it in self.trigger_test_fn
         # The logical expressions here help a previous trigger frame to 'latch' correctly
-        # (NB the trigger test function is called for every sample).
-        if self.st.trigger_mode == 'sync' and self.st.trigger_slope == 'rising':
-            self.trigger_test_fn = (lambda s1, s2:
-                    self.frame_triggered
-                    or self.rising_trigger_test(s1, s2, VOLTAGE_INDEX, 0.0))
-        elif self.st.trigger_mode == 'sync' and self.st.trigger_slope == 'falling':
-            self.trigger_test_fn = (lambda s1, s2:
+        # (NB the trigger test function is called for every sample that the block
+        # trigger search picks out).
+        if self.st.trigger_mode == 'sync':
+            self.trigger_test_fn = (lambda crossing, fraction, exceedance:
                     self.frame_triggered
-                    or self.falling_trigger_test(s1, s2, VOLTAGE_INDEX, 0.0))
-        elif self.st.trigger_mode == 'inrush' and self.st.trigger_slope == 'rising':
-            self.trigger_test_fn = (lambda s1, s2:
-                    self.inrush_triggered
-                    or self.inrush_trigger_test(s1, CURRENT_INDEX, self.st.inrush_trigger_level)
-                    or self.frame_triggered
-                    or self.rising_trigger_test(s1, s2, VOLTAGE_INDEX, 0.0))
-        elif self.st.trigger_mode == 'inrush' and self.st.trigger_slope == 'falling':
-            self.trigger_test_fn = (lambda s1, s2:
+                    or self.sync_trigger_test(crossing, fraction))
+        elif self.st.trigger_mode == 'inrush':
+            self.trigger_test_fn = (lambda crossing, fraction, exceedance:
                     self.inrush_triggered
-                    or self.inrush_trigger_test(s1, CURRENT_INDEX, self.st.inrush_trigger_level)
+                    or self.inrush_trigger_test(exceedance)
                     or self.frame_triggered
-                    or self.falling_trigger_test(s1, s2, VOLTAGE_INDEX, 0.0))
+                    or self.sync_trigger_test(crossing, fraction))
         elif self.st.trigger_mode == 'freerun':
-            self.trigger_test_fn = (lambda s1, s2:
+            self.trigger_test_fn = (lambda crossing, fraction, exceedance:
                     self.frame_triggered
                     or self.freerun_trigger())
             self.freerun_interpolation_increment = (self.st.time_axis_divisions
                                                   * self.st.time_axis_per_division / 1000
-                                                  * self.st.sample_rate) % 1
+                                                  * entry_rate) % 1
             # We may need to jump the freerun trigger pointer by catching up on
             # any elapsed frames, eg returning from stopped mode
             # Advance to latest storage minus post trigger samples
-            if self.sp - self.tp > self.frame_samples:
+            # (in stopped mode, the trigger pointer stays with the stopped frame)
+            if self.st.run_mode == 'running' and self.sp - self.tp > self.frame_samples:
                 self.tp = self.sp - self.post_trigger_samples
 
         self.inrush_holdoff_counter = self.pre_trigger_samples
         self.sync_holdoff_counter = self.sync_holdoff_samples
         # Frame boundary can change, even in stopped mode
         self.update_frame_markers()
+        if self.capture and self.st.run_mode == 'running':
+            # The buffer has moved on since the capture was frozen, so drop the stopped
+            # frame and wait for a new trigger
+            self.capture = None
+            self.reprime()
+            self.reframed = False
+        self.select_history_capture()
+
+
+def count_gaps(times, previous_time, interval, step_samples=1):
+    """Counts gaps in a block of sample times, where samples were lost before they
+    reached the framer. The first time is checked against previous_time, the time of
+    the last sample of the previous block, if there was one. For reduced records,
+    each step of interval is step_samples samples. Returns the time of the last
+    sample."""
+    if len(times) == 0:
+        return previous_time
+    times = np.asarray(times)
+    steps = np.rint(np.diff(times, prepend=times[0] if previous_time is None else previous_time)
+                    / interval)
+    for j in np.flatnonzero(steps > 1):
+        missing = (int(steps[j]) - 1) * step_samples
+        stats.gap(missing, f'framer.py, count_gaps(): {missing} samples '
+                  f'missing before time {times[j]:.4f} ms.')
+    return times[-1]
+
+def text_samples(stream, st, buf=None):
+    """Generator that yields blocks of samples from the lines of text from scaler.py,
+    as arrays with the four sample values in each row. Lines are read in blocks,
+    which keeps the cost of the runtime counters and of checking the time field for
+    gaps low. Each reduced record line adds two entries to the block, the minimum
+    and maximum values, and buf is told how many samples each entry stands for."""
+    previous_time = None
+    previous_record_time = None
+    for lines in stats.timed(read_text_blocks(stream, TEXT_BLOCK_SIZE, MAX_LATENCY)):
+        stats.count_in(len(lines))
+        samples = []
+        times = []
+        record_times = []
+        count = 1
+        if buf and lines and not lines[0].startswith(REDUCED_MARKER):
+            buf.set_entry_samples(1.0)
+        split_lines = [ line.split() for line in lines ]
+        # a block of plain sample lines is converted in one step, anything else is
+        # interpreted line by line
+        if all(len(words) == 5 for words in split_lines):
+            try:
+                block = np.array(split_lines, dtype=np.float64).reshape(-1, 5)
+                yield block[:,1:]
+                previous_time = count_gaps(block[:,0], previous_time, st.interval)
+                continue
+            except ValueError:
+                pass
+        for line, words in zip(lines, split_lines):
+            try:
+                if words[0] == REDUCED_MARKER:
+                    # the columns of a record line follow the marker
+                    record = [ float(w) for w in words[1:len(SCALED_COLUMNS)+1] ]
+                    entries = ([ record[V_MIN], record[I_MIN], record[P_MIN], record[L_MIN] ],
+                               [ record[V_MAX], record[I_MAX], record[P_MAX], record[L_MAX] ])
+                    count = int(record[COUNT])
+                    record_times.append(record[TIME])
+                    if buf:
+                        buf.set_entry_samples(count / 2)
+                    samples.extend(entries)
+                    continue
+                sample = [ float(w) for w in words[1:5] ]
+                times.append(float(words[0]))
+                samples.append(sample)
+            except (ValueError, IndexError):
+                stats.parse_failure(f"framer.py, text_samples(): Couldn't interpret '{line}'.")
+                samples.append([0.0, 0.0, 0.0, 0.0])
+        yield np.array(samples, dtype=np.float64).reshape(-1, 4)
+        previous_time = count_gaps(times, previous_time, st.interval)
+        previous_record_time = count_gaps(record_times, previous_record_time,
+                                          st.interval * count, count)
+
+def block_samples(source, st):
+    """Generator that yields blocks of samples from a block source, such as the
+    shared memory ring, as arrays with the four sample values in each row. Samples
+    that the source skipped have been counted as a gap already, so the jump in time
+    after them isn't counted again."""
+    previous_time = None
+    skipped = source.skipped
+    for times, values in stats.timed(source):
+        stats.count_in(times.shape[0])
+        if source.skipped != skipped:
+            skipped = source.skipped
+            previous_time = None
+        previous_time = count_gaps(times, previous_time, st.interval)
+        yield values
+
+
+def output_if_ready(st, buf, mapper):
+    """Output the frame if it is ready, and stop if the inrush trigger has fired."""
+    # Print out the frame if we're ready
+    if buf.ready_for_output():
+        buf.output_frame(mapper)
+        buf.reframed = False
+        # In run mode, reset ready for the next frame
+        if st.run_mode == 'running':
+            buf.reprime()
+    # Stop flag will be raised by the inrush trigger, we send_to_all to
+    # update the UI
+    if buf.stop_flag:
+        st.run_mode = 'stopped'
+        st.send_to_all()
+        buf.stop_flag = False
+
+
+def process_sample(st, buf, mapper, candidates, j):
+    """Test the next stored sample for triggers, and output the frame if it is ready.
+    It is sample j of the block that trigger_candidates() returned candidates for."""
+    # Process the incoming sample with the current trigger settings
+    buf.advance()
+    if st.run_mode == 'running' and not buf.inrush_triggered:
+        # if buf.frame_triggered, we still check because there might
+        # be a subsequent inrush trigger.
+        buf.trigger_test(candidates, j)
+    # Decrement the holdoff counters
+    buf.count_down_holdoff()
+    output_if_ready(st, buf, mapper)
+
+
+def process_samples(blocks, st, buf, mapper):
+    """Store each block of samples, search it for triggers and output frames when they
+    are ready. Samples where nothing can happen are passed over in one step, and the
+    rest go through process_sample(). The trigger tests use the values in the block,
+    which may be more precise than the values stored in the buffer."""
+    # the first sample of each block is tested against the last one stored
+    previous = buf.latest_sample()
+    for block in blocks:
+        n = len(block)
+        if n > 0:
+            buf.store_block(block)
+            candidates = buf.trigger_candidates(block, previous)
+            k = 0
+            while k < n:
+                j = buf.next_event(candidates, k, n)
+                buf.advance(j - k)
+                buf.count_down_holdoff(j - k)
+                if j < n:
+                    process_sample(st, buf, mapper, candidates, j)
+                k = j + 1
+            previous = block[n-1].tolist()
 
 
 def get_command_args():
@@ -339,6 +769,15 @@ def get_command_args():
         'trigger setups, and buffers waveform for re-transmission in stopped mode.')
     cmd_parser.add_argument('--unmapped', default=False, action=argparse.BooleanOptionalAction,
         help='Inhibit mapping of sample values to pixels.')
+    cmd_parser.add_argument('--shm', default=False, action=argparse.BooleanOptionalAction,
+        help='Read samples from the shared memory ring in $TEMP instead of stdin.')
+    cmd_parser.add_argument('--binary_frames', default=False, action=argparse.BooleanOptionalAction,
+        help='Output each frame of pixel coordinates as a binary frame instead of text lines.')
+    cmd_parser.add_argument('--decimate', default=True, action=argparse.BooleanOptionalAction,
+        help='Reduce mapped frames to the minimum and maximum in each pixel column at slow timebases.')
+    cmd_parser.add_argument('--history_seconds', type=float, default=0.0,
+        help='Seconds of samples to keep in a deep memory ring in $TEMP, for scrolling back '
+             'through earlier frames when stopped. Zero turns the history off.')
     program_name = cmd_parser.prog
     args = cmd_parser.parse_args()
     return (program_name, args)
@@ -352,44 +791,34 @@ def main():
     # Make a buffer to temporarily hold a history of samples -- this allows us to output
     # a frame of waveform that includes samples 'before and after the trigger'
     # in 'stopped' mode, it allows us to change the framing (extent of time axis) around the trigger
-    buf = Buffer(st)
+    history = History(args.history_seconds, st.sample_rate) if args.history_seconds > 0 else None
+    buf = Buffer(st, sys.stdout.buffer if args.binary_frames else None, history)
 
     # Mapper object helps us to scale output to pixel values
-    mapper = Mapper(st, output_format='values' if args.unmapped else 'pixels')
+    if args.unmapped:
+        output_format = 'values'
+    elif args.binary_frames:
+        output_format = 'binary'
+    else:
+        output_format = 'pixels'
+    mapper = Mapper(st, output_format, args.decimate)
 
     # When we receive a SIGUSR1 signal, the st object will reconfigure both objects
     st.set_callback_fn(lambda: (buf.configure_for_new_settings(),
                                 mapper.configure_for_new_settings()))
 
+    # Incoming data is either text lines on stdin, or the shared memory ring
+    if args.shm:
+        samples = block_samples(Ring_reader(program_name=program_name, gap_fn=stats.gap), st)
+    else:
+        samples = text_samples(sys.stdin, st, buf)
+
     # Process incoming data
     try:
-        for line in sys.stdin:
-            # Process the incoming line with the current trigger settings
-            buf.build_frame(line.rstrip())
-            if st.run_mode == 'running' and not buf.inrush_triggered:
-                # if buf.frame_triggered, we still check because there might
-                # be a subsequent inrush trigger.
-                buf.trigger_test()
-            # Decrement the holdoff counters
-            buf.sync_holdoff_counter -= 1
-            buf.inrush_holdoff_counter -= 1
-            # Print out the frame if we're ready
-            if buf.ready_for_output():
-                buf.output_frame(mapper)
-                buf.reframed = False
-                # In run mode, reset ready for the next frame
-                if st.run_mode == 'running':
-                    buf.reprime()
-            # Stop flag will be raised by the inrush trigger, we send_to_all to
-            # update the UI
-            if buf.stop_flag:
-                st.run_mode = 'stopped'
-                st.send_to_all()
-                buf.stop_flag = False
-
+        process_samples(samples, st, buf, mapper)
     except ValueError:
         print(
-            f"{program_name}, main(): Failed to read contents of line '{line}'.",
+            f"{program_name}, main(): Failed to process samples.",
             file=sys.stderr)
 
 
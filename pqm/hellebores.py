@@ -19,10 +19,12 @@ import argparse
 import select
 import io
 import json
+import numpy as np
 
 # project imports
 from settings import Settings
 from constants import *
+from block_io import Frame_decoder, FRAME_DTYPE, FRAME_COLUMNS, FRAME_STOPPED, FRAME_INRUSH
 from hellebores_controls import *
 from hellebores_waveform import Waveform
 from hellebores_multimeter import Multimeter
@@ -41,8 +43,8 @@ class UI_groups:
     # this flag helps to reduce workload of screen refresh when there are overlay menus.
     overlay_dialog_active = False
 
-    def __init__(self, st, buffer, datetime, wfs, waveform, multimeter, v_harmonics, \
-                     i_harmonics, app_actions):
+    def __init__(self, st, buffer, datetime, wfs, pipeline_health, waveform, multimeter, \
+                     v_harmonics, i_harmonics, app_actions):
         # make a local reference to app_actions and st
         self.app_actions = app_actions
         self.st = st
@@ -54,6 +56,9 @@ class UI_groups:
         # waveforms-per-second group
         self.elements['wfs'] = wfs
 
+        # pipeline health overlay
+        self.elements['pipeline_health'] = pipeline_health
+
         # waveform group
         self.instruments['waveform'] = waveform
         self.elements['waveform'] = [ waveform.waveform_controls ]
@@ -76,7 +81,7 @@ class UI_groups:
         self.elements['vertical'] = create_vertical(st, app_actions)
         self.elements['horizontal'] = create_horizontal(st, app_actions)
         self.elements['trigger'] = create_trigger(st, waveform, app_actions)
-        self.elements['options'] = create_options(waveform, app_actions)
+        self.elements['options'] = create_options(waveform, pipeline_health, app_actions)
         self.elements['clear'] = create_clear(buffer, app_actions)
 
         for k in ['mode', 'current_sensitivity', 'vertical', 'horizontal', 'trigger', 'options', 'clear']:
@@ -101,6 +106,7 @@ class UI_groups:
         else:
             self.instruments[self.mode].refresh(self.buffer, screen)
             self.elements['datetime'].draw()
+        self.elements['pipeline_health'].draw()
 
 
     def update_annunciators(self):
@@ -176,6 +182,9 @@ class Sample_Buffer:
         # allows 'multitrace' to work
         self.waveforms = [ [] for i in range(SAMPLE_BUFFER_SIZE) ]
         self.frame_completed = False        # flag to track completed frames
+        # number and flags of the last binary frame, see block_io.py
+        self.frame_number = None
+        self.frame_flags = 0
 
     def add_sample(self, sample):
         self.ps[0].append((sample[0], sample[1]))
@@ -209,6 +218,26 @@ class Sample_Buffer:
             return False
 
     def load_waveform(self):
+        if self.data_comms.binary_frames:
+            self.load_binary_waveform()
+        else:
+            self.load_text_waveform()
+
+    def load_binary_waveform(self):
+        """Loads the next binary frame, if one arrives in time. The whole frame is
+        loaded in one step, however many samples it has."""
+        self.frame_completed = False
+        if frame := self.data_comms.get_waveform_frame(0.02):
+            self.frame_number, self.frame_flags, payload = frame
+            points = np.frombuffer(payload, dtype=FRAME_DTYPE).reshape(-1, FRAME_COLUMNS)
+            # each line is an (n, 2) array of (x, y) points, which pygame draws from
+            # directly, without converting to lists first
+            ps = [ points[:,[0, c]] for c in range(1, FRAME_COLUMNS) ]
+            self.frame_completed = True
+            # shift the history buffer along and add the new capture
+            self.waveforms = [ ps, *self.waveforms[1:] ]
+
+    def load_text_waveform(self):
         # the loop will exit if:
         # (a) there is no data currently waiting to be read, 
         # (b) '.' end-of-frame marker in current line
@@ -221,8 +250,6 @@ class Sample_Buffer:
               and (l := self.data_comms.get_waveform_line(0.02)):
             try:
                 # lines beginning with '.' end the frame
-                # in stopped mode, framer will send a larger block of '.' characters in one line
-                # to flush the pipe buffer in the kernel.
                 if l[0] == '.':
                     self.frame_completed = True
                     # shift the history buffer along and add the new capture
@@ -252,10 +279,16 @@ class Data_comms:
     normally use named pipes controlled by a shell script. However the class here
     also supports anonymous pipe from stdin (waveform data only), for convenience
     when interacting with the project in the shell."""
-    def __init__(self, waveform_stream_name, analysis_stream_name):
+    def __init__(self, waveform_stream_name, analysis_stream_name, binary_frames=False):
         self.waveform_stream = None
         self.analysis_stream = None
         self.pipes_ok = False
+        # waveform data is read as bytes, and split up into text lines or binary frames
+        self.binary_frames = binary_frames
+        self.frame_decoder = Frame_decoder('hellebores.py')
+        self.frames = []
+        self.waveform_lines = []
+        self.partial_line = b''
         # open the streams (input data pipe files)
         # if successful, this will flip the pipes_ok flag to true
         self.open_streams(waveform_stream_name, analysis_stream_name)
@@ -325,9 +358,55 @@ class Data_comms:
         except IOError:
             print(f"{sys.argv[0]}: Data_comms.get_line() failed to read from the {source} stream.", file=sys.stderr)
 
+    def read_data(self, source):
+        """Reads the bytes that are waiting in a stream, without buffering, so that
+        peek_data() sees all the data that hasn't been read yet."""
+        if os.name == 'nt' and isinstance(source, Pipe):
+            return source.read()
+        return os.read(source.fileno(), 65536)
+
+    def get_waveform_frame(self, timeout):
+        """Returns the next binary frame from the waveform stream as a tuple of
+        (frame_number, flags, points), or False if a whole frame doesn't arrive within
+        timeout seconds of waiting. If the pipe is broken, will clear the pipes_ok flag."""
+        try:
+            while not self.frames:
+                if not self.peek_data(self.waveform_stream, timeout):
+                    return False
+                data = self.read_data(self.waveform_stream)
+                if data == b'':
+                    print(f'The {self.waveform_stream} pipe was closed.', file=sys.stderr)
+                    self.pipes_ok = False
+                    return False
+                self.frames.extend(self.frame_decoder.decode(data))
+            return self.frames.pop(0)
+        except IOError:
+            print(f"{sys.argv[0]}: Data_comms.get_waveform_frame() failed to read from the "
+                  f"{self.waveform_stream} stream.", file=sys.stderr)
+            return False
+
     def get_waveform_line(self, timeout):
-        """Returns a line of data from the waveform stream, which must be valid."""
-        return self.get_line(self.waveform_stream, timeout)
+        """Returns a line of data from the waveform stream, or False if one doesn't arrive
+        within timeout seconds of waiting. The stream is read without buffering, so a
+        stopped frame is read in full without having to be pushed through by more data.
+        If the pipe is broken, will clear the pipes_ok flag."""
+        try:
+            while not self.waveform_lines:
+                if not self.peek_data(self.waveform_stream, timeout):
+                    return False
+                data = self.read_data(self.waveform_stream)
+                if data == b'':
+                    print(f'The {self.waveform_stream} pipe was closed.', file=sys.stderr)
+                    self.pipes_ok = False
+                    return False
+                lines = (self.partial_line + data).split(b'\n')
+                self.partial_line = lines.pop()
+                self.waveform_lines.extend(lines[::-1])
+            return self.waveform_lines.pop().decode('utf-8', errors='replace')
+        except IOError:
+            print(f"{sys.argv[0]}: Data_comms.get_waveform_line() failed to read from the "
+                  f"{self.waveform_stream} stream.", file=sys.stderr)
+            return False
 
     def get_analysis_line(self, timeout):
         """Returns a line of data from the analysis stream. However, if one isn't set, returns False
@@ -386,12 +465,22 @@ class App_Actions:
         self.former_run_mode = self.st.run_mode
         self.post_draw_controls_event()
 
+    def inrush_stopped(self):
+        """The framer has flagged the frame at which the inrush trigger stopped it. The
+        display is stopped there straight away, without waiting for the settings signal
+        that the framer sends, which would let more frames be drawn over it."""
+        if self.st.run_mode != 'stopped':
+            self.st.run_mode = 'stopped'
+            self.settings_changed()
+
     def start_stop(self, action='flip'):
         former_run_mode = self.st.run_mode
         if (action=='flip' and former_run_mode=='stopped') or action=='run':
             self.st.run_mode = 'running'
         elif (action=='flip' and former_run_mode=='running') or action == 'stop':
             self.st.run_mode = 'stopped'
+        # each stop starts at the stopped frame, not at an earlier one from the history
+        self.st.history_offset = 0
         self.settings_changed()
         self.st.send_to_all()
 
@@ -422,6 +511,8 @@ def get_command_args():
         help='Path of waveform file stream or pipe.')
     cmd_parser.add_argument('--analysis_file', default=None, \
         help='Path of analysis file stream or pipe.')
+    cmd_parser.add_argument('--binary_frames', default=False, action=argparse.BooleanOptionalAction, \
+        help='Read binary waveform frames instead of text lines.')
     program_name = cmd_parser.prog
     args = cmd_parser.parse_args()
     return (program_name, args)
@@ -454,26 +545,27 @@ def main():
 
     # object holding the state of the application and the incoming communication streams
     app_actions  = App_Actions()
-    data_comms   = Data_comms(args.waveform_file, args.analysis_file)
+    data_comms   = Data_comms(args.waveform_file, args.analysis_file, args.binary_frames)
 
     # load configuration settings from settings.json into a settings object 'st'.
     # the list of 'other programs' is used to send signals when we change
     # settings in this program. We call st.send_to_all() and then
     # these programs are each told to re-read the settings file.
     st = Settings(callback_fn = app_actions.settings_changed, \
-                  other_programs = [ 'scaler.py', 'framer.py', 'analyser.py' ], \
+                  other_programs = [ 'scaler.py', 'framer.py', 'analyser.py', 'pipeline.py' ], \
                   reload_on_signal=True)
 
     # objects that hold the data buffers and UI
     buffer       = Sample_Buffer(st, data_comms)
     datetime     = Datetime()
     wfs          = WFS()
+    pipeline_health = Pipeline_health()
     waveform     = Waveform(st, app_actions)
     multimeter   = Multimeter(st, app_actions)
     v_harmonics  = Harmonic(st, app_actions, harmonic_of_what='voltage')
     i_harmonics  = Harmonic(st, app_actions, harmonic_of_what='current')
-    ui           = UI_groups(st, buffer, datetime, wfs, waveform, multimeter, \
-                                 v_harmonics, i_harmonics, app_actions)
+    ui           = UI_groups(st, buffer, datetime, wfs, pipeline_health, waveform, \
+                                 multimeter, v_harmonics, i_harmonics, app_actions)
 
     # tell app_actions how to access the other objects it needs to manipulate
     app_actions.set_other_objects(st, ui, data_comms)
@@ -500,7 +592,13 @@ def main():
             for i in range(app_actions.multi_trace):
                 buffer.load_waveform()
                 if buffer.frame_completed:
-                    wfs.increment()
+                    # frames re-sent from the stopped capture aren't new waveforms, but
+                    # the frame at which the inrush trigger stopped the framer is
+                    if (buffer.frame_flags & (FRAME_STOPPED | FRAME_INRUSH)) != FRAME_STOPPED:
+                        wfs.increment()
+                    if buffer.frame_flags & FRAME_INRUSH:
+                        app_actions.inrush_stopped()
+                        break
             # read new analysis results, if available 
             analysis_updated = buffer.load_analysis()
     
@@ -513,6 +611,8 @@ def main():
                 if st.run_mode=='running':
                     wfs.update()
                     datetime.update(app_actions.update_time)
+                if pipeline_health.visible:
+                    pipeline_health.update()
                 # force controls - including new text - to be re-drawn
                 app_actions.post_draw_controls_event()
     
@@ -529,6 +629,8 @@ def main():
                     app_actions.start_stop('run')
                 elif e.type == pygame.KEYDOWN and e.key == pygame.K_s:     # stop
                     app_actions.start_stop('stop')
+                elif e.type == pygame.KEYDOWN and e.key == pygame.K_h:     # pipeline health
+                    pipeline_health.flip()
                 elif e.type == app_actions.clear_screen_event:
                     # this event is posted when the 'mode' of the software is changed and we
                     # want to clear the screen completely
@@ -4,6 +4,7 @@ import pygame
 import time
 from constants import *
 from version import Version
+from stats import read_all_stats
 
 
 ###
@@ -190,6 +191,44 @@ class WFS:
         self.tt.draw()
 
 
+class Pipeline_health:
+    """Overlay that shows the runtime counters published by each of the pipeline
+    programs. A stage that is falling behind spends little time waiting to read, and
+    the stage before it spends its time waiting to write."""
+
+    def __init__(self):
+        self.visible = False
+        self.create_text_object()
+
+    def flip(self):
+        self.visible = not self.visible
+        if self.visible:
+            self.update()
+
+    def update(self):
+        lines = [ f"{'stage':24s} {'in/s':>7s} {'read':>5s} {'write':>5s} "
+                  f"{'max loop':>9s} {'errors':>6s} {'gaps':>5s} {'ovr':>4s} {'buf':>4s} {'drop':>5s}" ]
+        for s in read_all_stats():
+            # the high-water mark of the internal buffer, for programs that have one
+            capacity = s.get('buffer_capacity', 0)
+            buffer_use = f"{s['buffer_high_water']/capacity*100:3.0f}%" if capacity else '   -'
+            lines.append(f"{s['name'][:24]:24s} {s['samples_in_rate']:7.0f} "
+                         f"{s['read_wait_fraction']*100:4.0f}% {s['write_wait_fraction']*100:4.0f}% "
+                         f"{s['max_loop_time']*1000:7.1f}ms {s['parse_failures']:6d} {s.get('gaps', 0):5d} "
+                         f"{s.get('overruns', 0):4d} {buffer_use} {s.get('dropped_blocks', 0):5d}")
+        self.tt.set_text('\n'.join(lines))
+
+    def create_text_object(self):
+        """Pipeline health display."""
+        self.tt = thorpy.Text('')
+        self.tt.set_font_color(WHITE)
+        self.tt.set_topleft(*PIPELINE_HEALTH_POSITION)
+
+    def draw(self):
+        if self.visible:
+            self.tt.draw()
+
+
 class Datetime:
 
     def __init__(self):
@@ -294,6 +333,16 @@ def create_horizontal(st, app_actions):
         st.time_display_index = times.get_index()
         st.send_to_all()
 
+    def history_text():
+        return 'Latest frame' if st.history_offset == 0 else f'{st.history_offset} frames back'
+
+    def update_history_offset(offset):
+        # earlier frames come from framer.py's history, and are only shown when stopped
+        if st.run_mode == 'stopped':
+            st.history_offset = max(0, st.history_offset + offset)
+            st.send_to_all()
+        history_display.set_text(history_text(), adapt_parent=False)
+
     button_done = configure_button(BUTTON_SIZE, 'Done', lambda: app_actions.ui.set_updater('back'))
 
     times = Range_controller(st.time_display_ranges, st.time_display_index)
@@ -306,6 +355,15 @@ def create_horizontal(st, app_actions):
         BUTTON_SIZE, 'right', 
         lambda: update_time_range(times, 1))
 
+    history_display = thorpy.Text(history_text())
+    history_display.set_size(TEXT_WIDE_SIZE)
+    history_back = configure_arrow_button(
+        BUTTON_SIZE, 'left',
+        lambda: update_history_offset(1))
+    history_forward = configure_arrow_button(
+        BUTTON_SIZE, 'right',
+        lambda: update_history_offset(-1))
+
     horizontal = thorpy.TitleBox(
         text='Horizontal', children=[
             button_done,
@@ -315,6 +373,13 @@ def create_horizontal(st, app_actions):
                     time_down,
                     time_up
                     ],
+                mode='h'),
+            thorpy.Group(
+                elements=[
+                    history_display,
+                    history_back,
+                    history_forward
+                    ],
                 mode='h')
             ])
     for e in horizontal.get_all_descendants():
@@ -495,19 +560,32 @@ def create_trigger(st, waveform, app_actions):
         st.send_to_all()
 
     def update_trigger_status(status):
+        units = { 'voltage': 'V', 'current': 'A', 'power': 'W', 'earth_leakage': 'A' }
         if st.trigger_mode == 'freerun':
             status.set_text(
                 f'Freerun: the trigger is disabled.',
                 adapt_parent=False)
         elif st.trigger_mode == 'sync':
+            channel = st.trigger_channel.replace('_', ' ')
+            unit = units.get(st.trigger_channel, '')
+            if st.trigger_type == 'window':
+                direction = 'leaves' if st.trigger_slope == 'rising' else 'enters'
+                condition = (f'the signal {direction} the window {st.trigger_level}{unit}'
+                             f' +/- {st.trigger_window}{unit}')
+            elif st.trigger_type == 'pulse':
+                condition = (f'a {st.trigger_slope} pulse wider than {st.trigger_pulse_width}ms'
+                             f' ends at magnitude {st.trigger_level}{unit}')
+            else:
+                condition = f'the {st.trigger_slope} edge is at magnitude {st.trigger_level}{unit}'
             status.set_text(
-                f'Sync: the trigger is enabled to find the {st.trigger_slope}'
-                f' edge of the voltage signal at magnitude 0.0V.',
+                f'Sync: the trigger is enabled on the {channel} signal, when {condition}.',
                 adapt_parent=False)
         elif st.trigger_mode == 'inrush':
+            channel = st.inrush_trigger_channel.replace('_', ' ')
+            unit = units.get(st.inrush_trigger_channel, '')
             status.set_text(
-                f'Inrush: the capture will stop when current '
-                f'threshold +/- {st.inrush_trigger_level}A is exceeded. '
+                f'Inrush: the capture will stop when {channel} '
+                f'threshold +/- {st.inrush_trigger_level}{unit} is exceeded. '
                 f'Press Run/Stop to re-prime.',
                 adapt_parent=False)
         else:
@@ -601,7 +679,7 @@ def create_clear(buffer, app_actions):
     return clear
 
 
-def create_options(waveform, app_actions):
+def create_options(waveform, pipeline_health, app_actions):
     """Option controls dialog"""
     def about_box():
         alert = thorpy.Alert(
@@ -632,6 +710,8 @@ def create_options(waveform, app_actions):
         BUTTON_SIZE, 'Lines', lambda: waveform.plot_mode('lines'))
     button_about = configure_button(
         BUTTON_SIZE, 'About...', about_box)
+    button_pipeline_health = configure_button(
+        BUTTON_SIZE, 'Pipeline\nhealth', pipeline_health.flip)
     button_software_update = configure_button(
         BUTTON_SIZE, 'Software\nupdate', lambda: app_actions.exit_application('software_update'))
     button_shutdown = configure_button(
@@ -653,6 +733,7 @@ def create_options(waveform, app_actions):
             thorpy.Group(
                 elements=[
                     button_about,
+                    button_pipeline_health,
                     button_software_update,
                     ], mode='h'),
             thorpy.Group(
@@ -1,6 +1,7 @@
 import sys
 import thorpy
 import pygame
+import numpy as np
 from constants import *
 from hellebores_controls import *
 
@@ -55,7 +56,9 @@ class Waveform:
         pa = pygame.PixelArray(screen)
         for i in range(len(linedata)):
             if display_status[i] == True:
-                for pixel in linedata[i]:
+                # a PixelArray silently ignores numpy integer indexes, so the points of
+                # binary frames are converted to plain integers here
+                for pixel in np.asarray(linedata[i]).tolist():
                     pa[pixel[0], pixel[1]] = SIGNAL_COLOURS[i]
         pa.close()
 
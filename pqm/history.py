@@ -0,0 +1,135 @@
+#  _     _     _
+# | |__ (_)___| |_ ___  _ __ _   _   _ __  _   _
+# | '_ \| / __| __/ _ \| '__| | | | | '_ \| | | |
+# | | | | \__ \ || (_) | |  | |_| |_| |_) | |_| |
+# |_| |_|_|___/\__\___/|_|   \__, (_) .__/ \__, |
+#                            |___/  |_|    |___/
+#
+# Deep memory for framer.py.
+#
+# The framer buffer holds about 8 seconds of samples. With a history, every entry
+# stored in the buffer is also written into a much larger ring in a memory-mapped
+# file in $TEMP (normally on the /run/shm RAM disk), and the trigger position of
+# every frame that is output is recorded. After the framer stops, a frame can
+# then be made at any of the earlier triggers that are still held, which lets the
+# user scroll back through recent history in hellebores.py.
+#
+# The size of the ring is fixed when it is created, from the number of seconds of
+# history and the sample rate, so memory use doesn't grow: 120 seconds is 15 MB
+# at 7.8 kS/s and 30 MB at 15.6 kS/s. The ring stops recording when the framer's
+# stopped frame is frozen, so that the history isn't overwritten while it is
+# being looked at, and starts again when the framer runs again. Entries are held
+# as float32 to halve the size of the ring, so values output of a frame made from
+# the history is rounded to float32, unlike frames from the framer buffer.
+
+import os
+import tempfile
+import numpy as np
+
+
+HISTORY_FILE = 'sample_history'
+MAX_FRAME_RATE = 100                 # frames per second, reached at 1 ms/div in freerun
+CAPTURE_MARGIN = 1024                # entries taken either side of a past frame
+
+
+def history_path():
+    """The history file lives in the same temporary directory as settings.json and
+    the named pipes."""
+    return os.path.join(os.getenv('TEMP', tempfile.gettempdir()), HISTORY_FILE)
+
+
+class Capture:
+    """A frozen stretch of buffer entries around a trigger, from which a frame can be
+    made at any timebase."""
+
+    def __init__(self, samples, first, tp, interpolation_fraction, entry_interval):
+        self.samples = samples                    # array of entries, oldest first
+        self.first = first                        # buffer pointer of the first entry
+        self.tp = tp                              # trigger pointer
+        self.interpolation_fraction = interpolation_fraction
+        self.entry_interval = entry_interval      # time between entries (ms)
+
+    def frame(self, pre_trigger_samples, frame_samples):
+        """Returns the timestamps and samples of a frame around the trigger, with any
+        part that is outside the capture left out. The frame starts in the same place
+        as framer.py's frames do, see Buffer.update_frame_markers()."""
+        if self.interpolation_fraction < 0.5:
+            frame_startp = self.tp - pre_trigger_samples - 1
+        else:
+            frame_startp = self.tp - pre_trigger_samples
+        positions = np.arange(max(frame_startp, self.first),
+                              min(frame_startp + frame_samples, self.first + len(self.samples)))
+        # timestamp = 0.0ms at the trigger position
+        timestamps = self.entry_interval * (positions - (self.tp - 1 + self.interpolation_fraction))
+        return (timestamps, self.samples[positions - self.first])
+
+
+class History:
+    """Memory-mapped ring of buffer entries, with a ring of the triggers of the frames
+    that were output from them. Entries are addressed by the framer's buffer
+    pointers."""
+
+    def __init__(self, seconds, sample_rate, path=None):
+        self.path = path or history_path()
+        self.capacity = max(1, int(seconds * sample_rate))
+        with open(self.path, 'w+b') as f:
+            f.truncate(self.capacity * 4 * 4)
+        self.entries = np.memmap(self.path, dtype=np.float32, mode='r+', shape=(self.capacity, 4))
+        trigger_capacity = max(1, int(seconds * MAX_FRAME_RATE))
+        self.tps = np.zeros(trigger_capacity, dtype=np.int64)
+        self.interpolation_fractions = np.zeros(trigger_capacity, dtype=np.float64)
+        self.entry_intervals = np.zeros(trigger_capacity, dtype=np.float64)
+        self.triggers = 0             # number of triggers recorded
+        self.start = 0                # pointer of the first entry recorded without a break
+        self.end = 0                  # pointer after the last entry recorded
+
+    def write(self, pointer, entries):
+        """Record entries from the buffer, starting at pointer. If entries are missing
+        since the last write, the history starts again."""
+        n = len(entries)
+        if n == 0:
+            return
+        if pointer != self.end:
+            self.start = pointer
+            self.triggers = 0
+        self.end = pointer + n
+        # only the latest entries are kept if there are more than the ring holds
+        entries = entries[-self.capacity:]
+        pointer = self.end - len(entries)
+        # the entries are split in two if they wrap round the end of the ring
+        start = pointer % self.capacity
+        first = min(len(entries), self.capacity - start)
+        self.entries[start:start+first] = entries[:first]
+        self.entries[:len(entries)-first] = entries[first:]
+
+    def oldest(self):
+        """Returns the pointer of the oldest entry that is held."""
+        return max(self.start, self.end - self.capacity)
+
+    def add_trigger(self, tp, interpolation_fraction, entry_interval):
+        """Record the trigger of a frame that was output."""
+        i = self.triggers % len(self.tps)
+        self.tps[i] = tp
+        self.interpolation_fractions[i] = interpolation_fraction
+        self.entry_intervals[i] = entry_interval
+        self.triggers += 1
+
+    def capture(self, back, before, pre_trigger_samples, frame_samples):
+        """Returns a capture around the trigger of the frame that was output back frames
+        before the trigger pointer before, or None if it isn't held. The capture holds
+        a whole frame of frame_samples entries, with pre_trigger_samples of them before
+        the trigger, and CAPTURE_MARGIN more either side, as far as they are held."""
+        held = min(self.triggers, len(self.tps))
+        # ring indexes of the triggers, newest first
+        indexes = (self.triggers - 1 - np.arange(held)) % len(self.tps)
+        tps = self.tps[indexes]
+        indexes = indexes[(tps < before) & (tps > self.oldest())]
+        if not 0 < back <= len(indexes):
+            return None
+        i = indexes[back - 1]
+        tp = int(self.tps[i])
+        start = tp - pre_trigger_samples - 1 - CAPTURE_MARGIN
+        end = tp - pre_trigger_samples + frame_samples + CAPTURE_MARGIN
+        positions = np.arange(max(start, self.oldest()), min(end, self.end))
+        return Capture(self.entries[positions % self.capacity], positions[0], tp,
+                       float(self.interpolation_fractions[i]), float(self.entry_intervals[i]))
@@ -98,6 +98,11 @@ class Pipe:
         return str(received_bytes, encoding='utf-8')
 
 
+    def read(self):
+        _, received_bytes = win32file.ReadFile(self.pfh, 64*1024)
+        return received_bytes
+
+
     def writeline(self, line):
         win32file.WriteFile(self.pfh, str.encode(line))
 
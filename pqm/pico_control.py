@@ -4,6 +4,11 @@
 
 # Controls Pico via communicating with primitive command interface running in 'main.py'
 # on Pico, that implements a limited number of text commands.
+# Each response from main.py ends with a RESPONSE_END line, so that we don't need
+# to wait for the serial port to go quiet. Older versions of main.py don't send
+# it, and then the response ends when nothing more arrives for IDLE_TIMEOUT.
+# With the --update option, files are compared with those on the Pico by their
+# SHA256 checksums and updated if they differ, all in one session.
 
 # On Ubuntu and similar systems, the serial ports have root user permissions.
 # To change this, add ordinary user to the 'dialout' security group.
@@ -12,15 +17,27 @@
 import time
 import sys
 import os
+import hashlib
 import argparse
 import serial
 import serial.tools.list_ports
 
+RESPONSE_END = '\x04'           # line that ends each response from main.py
+IDLE_TIMEOUT = 2.0              # seconds, ends a response without RESPONSE_END
+TRANSFER_FILE = 'transfer_file' # temporary file on the Pico while updating
+# environment variable that names the serial port, instead of searching for it
+SERIAL_PORT_VARIABLE = 'PQM_SERIAL_PORT'
+
 
 def find_serial_device():
     '''Determines the serial port that the Pico is connected to. On Ubuntu/Raspberry
     Pi, serial ports are in the form '/dev/ttyUSBx' or '/dev/ttyACMx', where x is an
-    integer 0-7. On Windows, serial ports are in the form 'COMx' where x is an integer 1-8'''
+    integer 0-7. On Windows, serial ports are in the form 'COMx' where x is an integer 1-8.
+    The PQM_SERIAL_PORT environment variable overrides the search, for example to
+    use the Pico emulator in tools/pico_emulator.py.'''
+    port_name = os.environ.get(SERIAL_PORT_VARIABLE)
+    if port_name:
+        return port_name
     ports = serial.tools.list_ports.comports()
     port_name = None
     for port in ports:
@@ -40,6 +57,8 @@ def get_command_args():
     cmd_parser.add_argument('--command', help='Send a command string to Pico')
     cmd_parser.add_argument('--send_file', help='Send contents of file to Pico')
     cmd_parser.add_argument('--no_response', action='store_true', help='Transmit only, do not attempt to read response from Pico')
+    cmd_parser.add_argument('--update', nargs='+', metavar='FILE', help='Update files on Pico that differ from the local files, verifying each one')
+    cmd_parser.add_argument('--port', help='Serial port of the Pico, instead of searching for it')
     program_name = cmd_parser.prog
     args = cmd_parser.parse_args()
     return (program_name, args)
@@ -89,18 +108,69 @@ def send_file(ser, filename):
         print(f'{program_name}, send_file(): failed to send the contents of {filename}.')
  
 
+def read_response(ser, idle_timeout=IDLE_TIMEOUT):
+    '''Reads lines of response from serial until the RESPONSE_END line, or until
+    nothing more arrives for idle_timeout seconds. Returns the list of lines, the
+    first of which is the echo of the command.'''
+    ser.timeout = idle_timeout
+    lines = []
+    while True:
+        line = ser.readline()
+        # an empty read is a timeout
+        if not line:
+            return lines
+        # We get rid of Pico style CRLF endings
+        line = line.decode('utf-8', errors='replace').strip('\r\n')
+        if line == RESPONSE_END:
+            return lines
+        lines.append(line)
+
+
 def receive_response(ser):
-    '''Receives response from serial. In case of short pauses, we try reading a
-    few times before exiting'''
-    wait_attempts = 20
-    while wait_attempts > 0:
-        while ser.in_waiting:
-            # We get rid of Pico style CRLF endings and add system native line-endings
-            response = ser.readline().decode('utf-8').strip('\r\n')
-            print(response)
-            wait_attempts = 20
-        time.sleep(0.1)
-        wait_attempts -= 1
+    '''Receives response from serial and prints it with system native line-endings.'''
+    for line in read_response(ser):
+        print(line)
+
+
+def command_status(ser, command, data=None):
+    '''Sends the command, followed by data if there is any, and returns the
+    response without the echo of the command.'''
+    send_command(ser, command)
+    if data:
+        ser.write(data)
+    return ' '.join(read_response(ser)[1:])
+
+
+def update_files(ser, filenames):
+    '''Compares each file with the file of the same name on the Pico, and if they
+    differ, copies it to a temporary file on the Pico, checks it and renames it.
+    Returns the number of files that failed to update.'''
+    failures = 0
+    for filename in filenames:
+        pico_file = os.path.basename(filename)
+        try:
+            with open(filename, 'rb') as f:
+                file_contents = f.read()
+        except OSError:
+            print(f'{program_name}, update_files(): failed to read {filename}.', file=sys.stderr)
+            failures += 1
+            continue
+        sha256_local = hashlib.sha256(file_contents).hexdigest()
+        if command_status(ser, f'SHA256 {pico_file}') == sha256_local:
+            print(f'{pico_file}: same version local and Pico, no need to update.')
+            continue
+        print(f'{pico_file}: file versions are different, updating Pico...')
+        # we only overwrite the old file if the temporary file checksum matches
+        # the source
+        if (command_status(ser, f'SAVE {TRANSFER_FILE} {len(file_contents)}', file_contents) == 'OK'
+                and command_status(ser, f'SHA256 {TRANSFER_FILE}') == sha256_local
+                and command_status(ser, f'RENAME {TRANSFER_FILE} {pico_file}') == 'OK'
+                and command_status(ser, f'SHA256 {pico_file}') == sha256_local):
+            print(f'{pico_file}: update succeeded.')
+        else:
+            print(f'{pico_file}: update failed, unfortunately.')
+            failures += 1
+    return failures
 
 
 def main():
@@ -113,7 +183,7 @@ def main():
     if args.hard_reset:
         hard_reset()
         time.sleep(2)
-    port_name = find_serial_device()
+    port_name = args.port or find_serial_device()
     if port_name:
         try:
             # this order of processing allows 'SAVE' command to precede file transfer
@@ -121,11 +191,18 @@ def main():
             ser = serial.Serial(port_name)
             if args.ctrl_c:
                 ser.write(b'\x03')
+            if args.update:
+                # discard anything left over, such as the start up message
+                time.sleep(0.1)
+                ser.reset_input_buffer()
+                if update_files(ser, args.update) > 0:
+                    sys.exit(1)
             if args.command:
                 send_command(ser, args.command)
             if args.send_file:
                 send_file(ser, args.send_file)
-            if not args.no_response:
+            # after an update on its own, there is nothing more to receive
+            if not args.no_response and (args.command or args.send_file or not args.update):
                 receive_response(ser)
         except OSError:
             print(f'{program_name}, main(): Serial comms error.', file=sys.stderr)
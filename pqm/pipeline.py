@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+#        _            _ _
+#  _ __ (_)_ __   ___| (_)_ __   ___   _ __  _   _
+# | '_ \| | '_ \ / _ \ | | '_ \ / _ \ | '_ \| | | |
+# | |_) | | |_) |  __/ | | | | |  __/_| |_) | |_| |
+# | .__/|_| .__/ \___|_|_|_| |_|\___(_) .__/ \__, |
+# |_|     |_|                         |_|    |___/
+#
+# Runs the reader, scaler, framer, analyser and CSV logger stages as threads in a
+# single python process, instead of as separate programs connected by text pipes.
+# Blocks of scaled samples are passed from the scaler to the framer and analyser
+# as numpy arrays through in-memory queues. Waveform frames and analysis results
+# are written to the same files (normally the named pipes) that hellebores.py reads
+# in the multi-process pipeline, so hellebores.py works with either.
+#
+# Samples are read from the Pico serial port directly with the --serial option,
+# otherwise from stdin in the same formats as scaler.py, eg from rain_chooser.py.
+# Reduced records (see reduction.py) are only supported by the separate programs,
+# and are discarded here.
+#
+# Each stage has its own copy of the settings. The settings signal from
+# hellebores.py is handled in the main thread, which only flags the change, and
+# each stage thread reloads the settings and reconfigures itself between blocks,
+# as the separate programs do, so that a block is never processed with settings
+# that are partly applied.
+
+import sys
+import copy
+import time
+import json
+import queue
+import argparse
+import threading
+import numpy as np
+
+# local
+import reader
+import scaler
+import framer
+import analyser
+import analysis_to_csv
+from settings import Settings
+from stats import Stats
+from history import History
+from block_io import MAX_BLOCK_SAMPLES
+from reduction import REDUCED_RECORD
+
+QUEUE_BLOCKS = 256                   # maximum number of blocks waiting for each stage
+
+
+class Stage_settings:
+    """The copy of the settings for one stage thread. The main thread sets changed
+    when the settings signal arrives, and the stage calls update() between blocks,
+    which reloads the settings and then calls configure_fn to reconfigure the stage's
+    objects."""
+
+    def __init__(self, st):
+        self.st = copy.copy(st)
+        self.changed = threading.Event()
+        self.configure_fn = lambda: None
+
+    def update(self):
+        """Reloads the settings if they have changed since the last call."""
+        if self.changed.is_set():
+            # a change that arrives while reloading is picked up next time
+            self.changed.clear()
+            self.st.set_settings(self.st.load_settings())
+            self.configure_fn()
+
+
+class Queue_reader:
+    """Reads blocks of scaled samples, each an (n, 5) array, from a queue. The read()
+    interface is the same as the shared memory Ring_reader, so that the framer and
+    analyser functions can consume either. A block of None marks the end of the
+    input. The stage settings are updated before each read, when the consumer has
+    finished with the previous block."""
+
+    def __init__(self, block_queue, settings):
+        self.block_queue = block_queue
+        self.settings = settings
+        self.block = None
+        self.finished = False
+        self.skipped = 0              # blocks are never skipped, unlike in the ring
+
+    def read(self, max_samples):
+        """Returns a tuple of (times, values) for up to max_samples samples, or None
+        at the end of the input."""
+        self.settings.update()
+        while self.block is None or self.block.shape[0] == 0:
+            if self.finished:
+                return None
+            self.block = self.block_queue.get()
+            if self.block is None:
+                self.finished = True
+                return None
+        block = self.block[:max_samples]
+        self.block = self.block[max_samples:]
+        return (block[:,0], block[:,1:])
+
+    def __iter__(self):
+        """Iterates over blocks of samples until the end of the input."""
+        while (block := self.read(MAX_BLOCK_SAMPLES)) is not None:
+            yield block
+
+
+def serial_stage(raw_queue, framed):
+    """Reads blocks of samples from the Pico and passes them to the scaler. If framed
+    is set, the Pico sends framed pages."""
+    port_name = reader.find_serial_device()
+    if not port_name:
+        print('pipeline.py, serial_stage(): No serial port found, exiting.', file=sys.stderr)
+        raw_queue.put(None)
+        return
+    ser = reader.serial.Serial(port_name)
+    try:
+        # discard anything hanging around in the hardware buffer
+        ser.reset_input_buffer()
+        print('pipeline.py, serial_stage(): Connected.', file=sys.stderr)
+        # the block buffer is re-used by reader.py, so each block is copied
+        read_function = reader.read_pages_and_print if framed else reader.read_and_print
+        read_function(ser, lambda bs, sequence:
+            raw_queue.put((sequence, np.frombuffer(bytes(bs), dtype='>i2').reshape(-1, 4))))
+    finally:
+        ser.close()
+        raw_queue.put(None)
+
+
+def scaler_stage(blocks, block_queues, run_calibrated, settings):
+    """Scales each block of raw samples and passes a reference to the result to every
+    consumer queue. Blocks are tuples of (sequence, samples), as from the scaler
+    input functions. settings are the stage settings of the scaler."""
+    offsets, gains, delays = (scaler.calibrated_constants() if run_calibrated
+                              else scaler.uncalibrated_constants())
+    offsets = np.array(offsets, dtype=np.float64)
+    gains = np.array(gains, dtype=np.float64)
+    delay_line = scaler.Delay_line(delays)
+    stats = scaler.stats
+    i = 0   # sequence number of the next sample
+    try:
+        for sequence, samples in stats.timed(blocks):
+            settings.update()
+            if samples.dtype == REDUCED_RECORD:
+                stats.parse_failure('pipeline.py, scaler_stage(): Reduced records are not '
+                                    'supported, discarding.')
+                continue
+            n = samples.shape[0]
+            stats.count_in(n)
+            i = scaler.check_sequence(sequence, i)
+            if n == 0:
+                continue
+            output = scaler.scale_block(i, samples, delay_line, offsets, gains)
+            # time blocked on a full queue is the equivalent of waiting on a pipe
+            t0 = time.perf_counter()
+            for block_queue in block_queues:
+                block_queue.put(output)
+            stats.add_write_wait(time.perf_counter() - t0)
+            stats.count_out(n)
+            i += n
+    finally:
+        for block_queue in block_queues:
+            block_queue.put(None)
+
+
+def framer_stage(st, buf, mapper, source, waveform_file):
+    """Frames the samples and writes the waveform to waveform_file."""
+    with open(waveform_file, 'wb' if mapper.output_format == 'binary' else 'w') as f:
+        buf.output_file = f
+        framer.process_samples(framer.block_samples(source, st), st, buf, mapper)
+
+
+def analyser_stage(st, analysis, source, analysis_file, csv_queue):
+    """Analyses the samples and writes the results to analysis_file, and to the CSV
+    logger if there is one."""
+    # the cache and output interval are set up in the same way as analyser.py
+    output_interval = int(st.sample_rate)
+    cache = analyser.Sample_cache(int(st.sample_rate*2))
+    read_fn = lambda n, cache: analyser.read_blocks(n, cache, source)
+    with open(analysis_file, 'w') as f:
+        def output_fn(results):
+            line = json.dumps(results)
+            print(line, file=f)
+            f.flush()
+            if csv_queue:
+                csv_queue.put(line)
+        try:
+            read_fn(cache.size, cache)
+            analyser.read_analyse_output(cache, analysis, output_interval, read_fn, output_fn)
+        finally:
+            if csv_queue:
+                csv_queue.put(None)
+
+
+def csv_stage(csv_queue, csv_file):
+    """Writes analysis results to the CSV log file, one row per line."""
+    with open(csv_file, 'w', buffering=1) as f:
+        analysis_to_csv.write_csv(iter(csv_queue.get, None), f, 'pipeline.py')
+
+
+def run_stage(stage_failed, function, *args):
+    """Thread target that runs a stage, and raises the stage_failed flag if it exits
+    with an error. A broken pipe means that hellebores.py has closed its end."""
+    try:
+        function(*args)
+    except BrokenPipeError:
+        stage_failed.set()
+    except Exception as e:
+        print(f'pipeline.py, run_stage(): {function.__name__} failed, {e}.', file=sys.stderr)
+        stage_failed.set()
+
+
+def get_command_args():
+    """Process command line arguments for input source and output files."""
+    cmd_parser = argparse.ArgumentParser(description='Runs the sample processing pipeline '
+        'in a single process, writing waveforms and analysis results to files.')
+    cmd_parser.add_argument('--serial', default=False, action=argparse.BooleanOptionalAction,
+        help='Read samples from the Pico serial port instead of stdin.')
+    cmd_parser.add_argument('--framed', default=False, action=argparse.BooleanOptionalAction,
+        help="With --serial, read framed pages from the Pico, which must be streaming with "
+             "the 'framed' or 'delta' option.")
+    cmd_parser.add_argument('--binary', default=False, action=argparse.BooleanOptionalAction,
+        help='Read binary blocks from stdin instead of hexadecimal text.')
+    cmd_parser.add_argument('--uncalibrated', default=False, action=argparse.BooleanOptionalAction,
+        help='Apply hardware scale factors only, without calibration constants.')
+    cmd_parser.add_argument('--block_size', type=int, default=scaler.BLOCK_SIZE,
+        help=f'Number of lines of text input processed together (1-{MAX_BLOCK_SAMPLES}).')
+    cmd_parser.add_argument('--max_latency', type=float, default=scaler.MAX_LATENCY,
+        help='Time in milliseconds after which a partial block of text input is processed '
+             'if the input stalls.')
+    cmd_parser.add_argument('--waveform_file', required=True,
+        help='File or pipe to write waveform frames to.')
+    cmd_parser.add_argument('--binary_frames', default=False, action=argparse.BooleanOptionalAction,
+        help='Write each waveform frame as a binary frame instead of text lines.')
+    cmd_parser.add_argument('--history_seconds', type=float, default=0.0,
+        help='Seconds of samples to keep in a deep memory ring in $TEMP, for scrolling back '
+             'through earlier frames when stopped. Zero turns the history off.')
+    cmd_parser.add_argument('--analysis_file', required=True,
+        help='File or pipe to write analysis results to.')
+    cmd_parser.add_argument('--csv_file', default=None,
+        help='File to log analysis results to in CSV format.')
+    program_name = cmd_parser.prog
+    args = cmd_parser.parse_args()
+    if not 1 <= args.block_size <= MAX_BLOCK_SAMPLES:
+        cmd_parser.error(f'block_size must be in the range 1-{MAX_BLOCK_SAMPLES}.')
+    return (program_name, args)
+
+
+def main():
+    program_name, args = get_command_args()
+
+    # each stage publishes its runtime counters under its own name
+    for module in [ reader, scaler, framer, analyser, analysis_to_csv ]:
+        module.stats = Stats(f'pipeline.py-{module.__name__}')
+
+    # The main settings object receives the settings signal. Each stage works from
+    # its own copy, and the framer uses its copy to let the GUI know when an inrush
+    # trigger has stopped the display.
+    st = Settings(other_programs = [ 'hellebores.py' ])
+    scaler_settings, framer_settings, analyser_settings = [ Stage_settings(st) for i in range(3) ]
+    scaler.st = scaler_settings.st
+    scaler.set_current_channel()
+    scaler_settings.configure_fn = scaler.set_current_channel
+    history = History(args.history_seconds, st.sample_rate) if args.history_seconds > 0 else None
+    buf = framer.Buffer(framer_settings.st, history=history)
+    mapper = framer.Mapper(framer_settings.st,
+                           output_format='binary' if args.binary_frames else 'pixels')
+    framer_settings.configure_fn = lambda: (buf.configure_for_new_settings(),
+                                            mapper.configure_for_new_settings())
+    analysis = analyser.Analyser()
+    analysis.st = analyser_settings.st
+    analyser_settings.configure_fn = analysis.check_updated_settings
+
+    # When we receive a SIGUSR1 signal, the st object tells every stage to reconfigure
+    # itself between blocks
+    st.set_callback_fn(lambda: [ settings.changed.set()
+                                 for settings in (scaler_settings, framer_settings,
+                                                  analyser_settings) ])
+
+    framer_queue = queue.Queue(QUEUE_BLOCKS)
+    analyser_queue = queue.Queue(QUEUE_BLOCKS)
+    csv_queue = queue.Queue() if args.csv_file else None
+    stage_failed = threading.Event()
+    threads = []
+    def start(function, *stage_args):
+        thread = threading.Thread(target=run_stage, args=(stage_failed, function, *stage_args),
+                                  daemon=True)
+        thread.start()
+        threads.append(thread)
+        return thread
+
+    # input stages
+    if args.serial:
+        raw_queue = queue.Queue(QUEUE_BLOCKS)
+        start(serial_stage, raw_queue, args.framed)
+        blocks = iter(raw_queue.get, None)
+    elif args.binary:
+        blocks = scaler.binary_blocks(sys.stdin.buffer)
+    else:
+        blocks = scaler.text_blocks(sys.stdin, args.block_size, args.max_latency / 1000)
+    start(scaler_stage, blocks, [ framer_queue, analyser_queue ], not args.uncalibrated,
+          scaler_settings)
+
+    # output stages
+    output_threads = [
+        start(framer_stage, framer_settings.st, buf, mapper,
+              Queue_reader(framer_queue, framer_settings), args.waveform_file),
+        start(analyser_stage, analyser_settings.st, analysis,
+              Queue_reader(analyser_queue, analyser_settings), args.analysis_file, csv_queue) ]
+    if args.csv_file:
+        output_threads.append(start(csv_stage, csv_queue, args.csv_file))
+
+    # Wait here, with the main thread free to handle settings signals, until the input
+    # has been fully processed or a stage has failed. Threads that are still blocked
+    # are stopped when the process exits.
+    while not stage_failed.is_set() and any(t.is_alive() for t in output_threads):
+        stage_failed.wait(0.5)
+
+
+if __name__ == '__main__':
+    main()
@@ -59,9 +59,11 @@ def generate_samples(parameters):
     n = int((new_time_mark - time_zero)/st.interval) - sample_index
 
     # to avoid stalling or hanging the process, don't attempt to print more
-    # than 1000 samples in one go: drop them and return early instead
+    # than 1000 samples in one go: drop them and return early instead, with a
+    # sequence marker so that the gap can be detected
     if n > 1000:
         sample_index = sample_index + n 
+        print(f"@{sample_index:x}")
 
     else:
         # retrieve the sample generating coefficients from the current parameters
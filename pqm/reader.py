@@ -10,19 +10,72 @@
 # 
 # Read incoming binary block from stdin and write out in hexadecimal text format
 # Incremental index number then one sample for each channel, per line
+# If samples are lost, the next line is a sequence marker, '@' followed by the
+# sample number of the next sample in hexadecimal, so that later programs can
+# detect the gap
+# Alternatively, with the --binary option, write out the binary blocks unchanged
+# apart from a small header (see block_io.py)
+# With the --framed option, the Pico sends each page with a header and checksum,
+# which allows lost or corrupted data to be detected and skipped. Pages may also
+# be delta encoded, to reduce the data rate at high sample rates. Pages that the
+# Pico had to skip because its buffer overran are counted as overruns in the stats
+# When the Pico sends reduced records instead of samples (the 'reduce=N' option
+# of stream.py), each record is written out as a text line, see reduction.py
+# With the --threaded option, one thread drains the serial port into a bounded
+# ring of blocks and another writes them out, so that a short stall downstream
+# doesn't hold up reading and make the Pico buffer overrun. If the ring fills up,
+# blocks are dropped and show as a gap in the output, and the high-water mark of
+# the ring and the drops are counted in the stats
 
+import os
 import sys
+import time
+import argparse
+import threading
+import numpy as np
 import serial
 import serial.tools.list_ports
 
+# local
+from block_io import (binary_block, Page_decoder, PAGE_HEADER, PAGE_SAMPLES, PAGE_DELTA,
+                      PAGE_REDUCED, PAGE_OVERRUN, RECORD_SIZE)
+from reduction import REDUCED_RECORD, format_records
+from stats import Stats
+
 BUFFER_SIZE = 128
 BLOCK_SIZE = BUFFER_SIZE * 8
+# framed pages from the Pico normally hold 64 samples, each serial read is one
+# page, or part of one if the Pico was started with a larger page size
+PAGE_READ_SIZE = PAGE_HEADER.size + 64 * RECORD_SIZE
+# blocks held between the reading and writing threads with --threaded, about two
+# seconds of samples at the default sample rate
+RING_BLOCKS = 128
+
+# ascii codes used to build the hexadecimal text output
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+NIBBLE_SHIFTS = np.array([12, 8, 4, 0], dtype=np.uint16)
+# each line of text is four groups of four hex digits, each group followed by a
+# space, or a newline at the end of the line
+LINE_TEMPLATE = np.frombuffer(b'     ' * 3 + b'    \n', dtype=np.uint8).reshape(4, 5)
+# environment variable that names the serial port, instead of searching for it
+SERIAL_PORT_VARIABLE = 'PQM_SERIAL_PORT'
+# sample number expected at the start of the next block of text output
+next_sequence = 0
+
+# runtime counters, published to the stats directory
+stats = Stats('reader.py')
  
  
 def find_serial_device():
     '''determines the serial port that the Pico is connected to. On Ubuntu/Raspberry
     Pi, serial ports are in the form '/dev/ttyUSBx' where x is an integer 0-7.
-    On Windows, serial ports are in the form 'COMx' where x is an integer 1-8'''
+    On Windows, serial ports are in the form 'COMx' where x is an integer 1-8.
+    The PQM_SERIAL_PORT environment variable overrides the search, for example to
+    use the Pico emulator in tools/pico_emulator.py.'''
+    port_name = os.environ.get(SERIAL_PORT_VARIABLE)
+    if port_name:
+        print(f'Using {port_name} from {SERIAL_PORT_VARIABLE}.', file=sys.stderr)
+        return port_name
     ports = serial.tools.list_ports.comports()
     port_name = None
     for port in ports:
@@ -34,34 +87,301 @@ def find_serial_device():
     return port_name
  
 
-def read_and_print(ser):
+def format_hex(bs):
+    '''Formats the block as lines of hexadecimal text, one sample per line, and
+    returns the text as a bytes object. The whole block is processed in one pass
+    with array operations.'''
+    # view the block as an array of samples with four 16 bit big-endian readings
+    readings = np.frombuffer(bs, dtype='>u2').reshape(-1, 4)
+    lines = np.empty((readings.shape[0], 4, 5), dtype=np.uint8)
+    lines[:] = LINE_TEMPLATE
+    # split each reading into four nibbles, most significant first, and look up
+    # the corresponding hex digits
+    lines[:,:,:4] = HEX_DIGITS[(readings[:,:,np.newaxis] >> NIBBLE_SHIFTS) & 0xf]
+    return lines.tobytes()
+
+
+def delta_decode(payload):
+    '''Decodes a delta encoded page (see block_io.py) back into sample records, and
+    returns them as a bytes object. The varints are decoded in one pass with array
+    operations. Raises ValueError if the page is malformed.'''
+    bs = np.frombuffer(payload, dtype=np.uint8)
+    if bs.size == 0 or bs[-1] & 0x80:
+        raise ValueError
+    # the last byte of each varint has the top bit clear
+    ends = (bs & 0x80) == 0
+    value_index = np.cumsum(ends) - ends
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    position = np.arange(bs.size) - starts[value_index]
+    if position.max() > 2:
+        raise ValueError
+    # each value is the sum of its 7 bit groups, weights are exact in float64
+    z = np.bincount(value_index, weights=(bs & 0x7f).astype(np.int64) << (7 * position))
+    z = z.astype(np.int64)
+    deltas = (z >> 1) ^ -(z & 1)
+    # undo the differences channel by channel, reshape raises ValueError if the
+    # number of readings isn't a whole number of samples
+    readings = np.cumsum(deltas.reshape(-1, 4), axis=0) & 0xffff
+    return readings.astype('>u2').tobytes()
+
+
+def write_out(bs):
+    '''Writes bytes to stdout. Only the write itself is counted as write wait, not
+    the formatting before it.'''
+    t0 = time.perf_counter()
+    sys.stdout.buffer.write(bs)
+    stats.add_write_wait(time.perf_counter() - t0)
+
+
+def print_hex(bs, sequence):
+    '''Prints the block as lines of hexadecimal text, one sample per line, in a
+    single write. If the block doesn't follow on from the previous one, it is
+    preceded by a sequence marker line.'''
+    global next_sequence
+    text = format_hex(bs)
+    if sequence != next_sequence:
+        text = b'@%x\n' % sequence + text
+    next_sequence = sequence + len(bs) // 8
+    write_out(text)
+
+
+def print_records(payload, sequence):
+    '''Prints a reduced record as a line of text. If the record doesn't follow on
+    from the previous one, it is preceded by a sequence marker line, with the
+    sample number of the first sample in the record.'''
+    global next_sequence
+    records = np.frombuffer(payload, dtype=REDUCED_RECORD)
+    text = format_records(records)
+    if sequence != next_sequence:
+        text = b'@%x\n' % sequence + text
+    next_sequence = sequence + int(records['count'].sum())
+    write_out(text)
+
+
+def write_binary(bs, sequence):
+    '''Writes the block with a binary header to stdout, in a single write.'''
+    block = binary_block(bs, sequence)
+    t0 = time.perf_counter()
+    sys.stdout.buffer.write(block)
+    sys.stdout.buffer.flush()
+    stats.add_write_wait(time.perf_counter() - t0)
+
+
+def read_and_print(ser, output_function=print_hex):
     '''Reads binary data from serial port, and prints as hexadecimal text to stdout.
     Sometimes (rarely) there is a serial read error. This can be caused by the getty
     terminal process trying to read/write the serial port. We allow up to 5 successive
     re-tries before quitting.'''
     bs = bytearray(BLOCK_SIZE)
+    sequence = 0    # sample number of the first sample in the block
     retries = 5
     while retries > 0:    
         try:
             # read exactly BLOCKSIZE bytes into bytearray buffer
+            t0 = time.perf_counter()
             ser.readinto(bs)
-            # process data as lines of 8 bytes, or 16 hex characters
-            hexstr = bs.hex()
-            for i in range(0, BLOCK_SIZE*2, 16):
-                print(f'{hexstr[i:i+4]} {hexstr[i+4:i+8]} {hexstr[i+8:i+12]} {hexstr[i+12:i+16]}')
+            t1 = time.perf_counter()
+            stats.add_read_wait(t1 - t0)
+            stats.count_in(BUFFER_SIZE)
+            output_function(bs, sequence)
+            t2 = time.perf_counter()
+            stats.count_out(BUFFER_SIZE)
+            # stalls on the serial port show in the read wait, not the loop time
+            stats.loop_time(t2 - t1)
+            sequence += BUFFER_SIZE
             retries = 5
 
+        # The raw serial stream doesn't carry sample numbers, so after an error there
+        # is no way to tell how many samples were lost. The gap is counted as one of
+        # unknown length, and the sequence carries on from the samples received,
+        # rather than jumping by a guess. Use --framed for exact gap counts.
         except ValueError:
-            print('reader.py, read_and_print(): The data was not correct or complete.', file=sys.stderr)
+            stats.gap(None, 'reader.py, read_and_print(): The data was not correct or complete, '
+                      'an unknown number of samples were lost.')
         except (IOError, OSError):
-            print('reader.py, read_and_print(): Failed to read from serial port.', file=sys.stderr)
+            stats.gap(None, 'reader.py, read_and_print(): Failed to read from serial port, '
+                      'an unknown number of samples were lost.')
             retries = retries - 1
     print('reader.py, read_and_print(): Read error was persistent, exiting loop.', file=sys.stderr)
 
 
+def read_pages_and_print(ser, output_function=print_hex, record_function=None):
+    '''Reads framed pages from the serial port, and outputs the samples in each
+    page. Delta encoded pages are decoded first. Reduced records are passed to
+    record_function instead. If there is none, because the output is binary blocks,
+    the function reports it and returns at the first record, rather than discarding
+    the whole stream. Lost pages are
+    counted as a gap, and show as a jump in the sequence number passed to the
+    output function. Corrupted pages are skipped, and counted as parse failures.
+    Pages flagged by the Pico after a buffer overrun are counted as overruns.
+    Read errors are handled in the same way as read_and_print().'''
+    decoder = Page_decoder(report=stats.parse_failure)
+    sequence = 0    # sample number of the first sample in the next page
+    expected = 0    # next page number
+    retries = 5
+    while retries > 0:
+        try:
+            t0 = time.perf_counter()
+            data = ser.read(PAGE_READ_SIZE)
+            t1 = time.perf_counter()
+            stats.add_read_wait(t1 - t0)
+            for page_type, flags, page_number, payload in decoder.decode(data):
+                write_function = output_function
+                try:
+                    if page_type == PAGE_DELTA:
+                        payload = delta_decode(payload)
+                        n = len(payload) // RECORD_SIZE
+                    elif page_type == PAGE_SAMPLES:
+                        n = len(payload) // RECORD_SIZE
+                    elif page_type == PAGE_REDUCED:
+                        if not record_function:
+                            print("reader.py, read_pages_and_print(): The Pico is sending reduced "
+                                  "records, which can only be output as text lines, not as "
+                                  "binary blocks. Exiting.", file=sys.stderr)
+                            return
+                        # each page is one record, n is the number of samples in it
+                        n = int(np.frombuffer(payload, dtype=REDUCED_RECORD)['count'].sum())
+                        write_function = record_function
+                    else:
+                        raise ValueError
+                except ValueError:
+                    stats.parse_failure(f"reader.py, read_pages_and_print(): Couldn't decode "
+                                        f"page {page_number} of type {page_type}, discarding.")
+                    continue
+                if flags & PAGE_OVERRUN:
+                    stats.overrun(f'reader.py, read_pages_and_print(): The Pico buffer overran '
+                                  f'before page {page_number}.')
+                if page_number > expected:
+                    # assume that the lost pages were the same size as this one
+                    missing = (page_number - expected) * n
+                    stats.gap(missing, f'reader.py, read_pages_and_print(): {page_number - expected} '
+                              f'pages lost before page {page_number}.')
+                    sequence += missing
+                expected = page_number + 1
+                stats.count_in(n)
+                write_function(payload, sequence)
+                stats.count_out(n)
+                sequence += n
+            t2 = time.perf_counter()
+            stats.loop_time(t2 - t1)
+            retries = 5
+        except (IOError, OSError):
+            print('reader.py, read_pages_and_print(): Failed to read from serial port.', file=sys.stderr)
+            retries = retries - 1
+    print('reader.py, read_pages_and_print(): Read error was persistent, exiting loop.', file=sys.stderr)
+
+
+class Block_ring:
+    '''Bounded ring of blocks passed from the thread that reads the serial port to
+    the thread that writes them out. Adding a block never waits: if the ring is
+    full, the block is dropped and counted in the stats.'''
+
+    def __init__(self, capacity):
+        self.slots = [None] * capacity
+        self.capacity = capacity
+        self.head = 0        # next slot to take a block from
+        self.count = 0       # number of blocks in the ring
+        self.closed = False
+        self.ready = threading.Condition()
+        stats.buffer_level(0, capacity)
+
+    def put(self, item, samples):
+        '''Adds item to the ring, or drops it if the ring is full. samples is the
+        number of samples in the item, for the stats.'''
+        with self.ready:
+            if self.count == self.capacity:
+                stats.drop(samples, f'reader.py, Block_ring.put(): The ring of {self.capacity} '
+                                    f'blocks is full, dropping {samples} samples.')
+                return
+            self.slots[(self.head + self.count) % self.capacity] = item
+            self.count += 1
+            stats.buffer_level(self.count, self.capacity)
+            self.ready.notify()
+
+    def get(self):
+        '''Returns the oldest item in the ring, waiting for one if the ring is empty.
+        Returns None when the ring is empty and has been closed.'''
+        with self.ready:
+            while self.count == 0 and not self.closed:
+                self.ready.wait()
+            if self.count == 0:
+                return None
+            item = self.slots[self.head]
+            self.slots[self.head] = None
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+            return item
+
+    def close(self):
+        '''Tells the writing thread that no more blocks will be added.'''
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+
+def read_threaded(ser, read_function, output_function, record_function=None, ring_blocks=RING_BLOCKS):
+    '''Runs read_function in a separate thread, which passes each block to this
+    thread through a Block_ring instead of writing it out itself, then writes out the
+    blocks with output_function or record_function. A dropped block shows as a jump
+    in the sequence number passed to the output function, in the same way as a lost
+    page. samples_out in the stats counts the samples passed to the ring.'''
+    ring = Block_ring(ring_blocks)
+
+    def enqueue(function, samples):
+        # the read functions reuse their buffers, so each block is copied
+        return lambda bs, sequence: ring.put((function, bytes(bs), sequence), samples(bs))
+
+    def count_samples(bs):
+        return len(bs) // RECORD_SIZE
+
+    def count_records(bs):
+        return int(np.frombuffer(bs, dtype=REDUCED_RECORD)['count'].sum())
+
+    def read():
+        try:
+            if record_function:
+                read_function(ser, enqueue(output_function, count_samples),
+                              enqueue(record_function, count_records))
+            else:
+                read_function(ser, enqueue(output_function, count_samples))
+        finally:
+            ring.close()
+
+    # the reading thread is a daemon, so that the program can exit if the output
+    # is closed while a read is in progress
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        item = ring.get()
+        if item is None:
+            break
+        function, bs, sequence = item
+        function(bs, sequence)
+
+
+def get_command_args():
+    '''Process command line arguments for the input and output formats.'''
+    cmd_parser = argparse.ArgumentParser(description='Reads sample data from the Pico '
+        'serial port and outputs it as hexadecimal text lines or binary blocks.')
+    cmd_parser.add_argument('--binary', default=False, action=argparse.BooleanOptionalAction,
+        help="Output binary blocks instead of hexadecimal text. Reduced records from the "
+             "Pico's 'reduce=N' option can't be output as binary blocks.")
+    cmd_parser.add_argument('--framed', default=False, action=argparse.BooleanOptionalAction,
+        help="Read framed pages from the Pico, which must be streaming with the 'framed' or "
+             "'delta' option.")
+    cmd_parser.add_argument('--threaded', default=False, action=argparse.BooleanOptionalAction,
+        help='Read the serial port and write the output in separate threads, so that short '
+             'stalls in the output are absorbed by a ring of blocks.')
+    cmd_parser.add_argument('--ring_blocks', type=int, default=RING_BLOCKS,
+        help='Number of blocks that the ring holds with --threaded, before blocks are dropped.')
+    program_name = cmd_parser.prog
+    args = cmd_parser.parse_args()
+    return (program_name, args)
+
+
 def main():
     '''This program needs the Pico to have been set into streaming mode by the 
     pico_control.py program first.'''
+    program_name, args = get_command_args()
     port_name = find_serial_device()
     if port_name:
         try:
@@ -69,7 +389,15 @@ def main():
             # discard anything hanging around in the hardware buffer
             ser.reset_input_buffer()
             print(f"reader.py, main(): Connected.", file=sys.stderr)
-            read_and_print(ser)
+            read_function = read_pages_and_print if args.framed else read_and_print
+            output_function = write_binary if args.binary else print_hex
+            record_function = print_records if args.framed and not args.binary else None
+            if args.threaded:
+                read_threaded(ser, read_function, output_function, record_function, args.ring_blocks)
+            elif record_function:
+                read_function(ser, output_function, record_function)
+            else:
+                read_function(ser, output_function)
         except:
             print(f"reader.py, main(): No connection, exiting.", file=sys.stderr)
         finally:
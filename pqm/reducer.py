@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+#               _
+#  _ __ ___  __| |_   _  ___ ___ _ __ _ __  _   _
+# | '__/ _ \/ _` | | | |/ __/ _ \ '__| '_ \| | | |
+# | | |  __/ (_| | |_| | (_|  __/ | _| |_) | |_| |
+# |_|  \___|\__,_|\__,_|\___\___|_|(_) .__/ \__, |
+#                                    |_|    |___/
+#
+# Reduces hexadecimal text samples to reduced records, in the same way as the
+# Pico does when stream.py is started with the 'reduce=N' option, and writes
+# them out in the same text format as reader.py (see reduction.py). This allows
+# the reduced pipeline to be run and tested with simulated samples, for example
+# from rain_chooser.py, without a Pico.
+#
+# Each record covers N samples, starting from a sample number that is a multiple
+# of N. A partial record at the start of the input, or either side of a gap in
+# the sample sequence, is discarded, as on the Pico.
+
+import sys
+import time
+import argparse
+import numpy as np
+
+# local
+import scaler
+from block_io import MAX_BLOCK_SAMPLES
+from reduction import reduce_samples, format_records, MAX_SAMPLES_PER_RECORD
+from stats import Stats
+
+# runtime counters, published to the stats directory
+stats = Stats('reducer.py')
+# sample number that follows the last record written out
+next_sequence = 0
+
+
+def print_records(records, sequence, n):
+    """Prints the records, with a sequence marker line first if they don't follow
+    on from the previous records. sequence is the number of the first sample of
+    the first record, and each record holds n samples."""
+    global next_sequence
+    text = format_records(records)
+    if sequence != next_sequence:
+        text = b'@%x\n' % sequence + text
+    next_sequence = sequence + records.shape[0] * n
+    sys.stdout.buffer.write(text)
+    sys.stdout.buffer.flush()
+
+
+def reduce_blocks(blocks, n, output_function=print_records):
+    """Collects samples from blocks of (sequence, samples), as from
+    scaler.text_blocks(), into records of n samples and passes them to the output
+    function."""
+    i = 0              # sequence number of the next sample
+    pending = []       # samples of the record that is being collected
+    start = 0          # sequence number of the first pending sample
+    for sequence, samples in stats.timed(blocks):
+        stats.count_in(samples.shape[0])
+        if sequence is not None and sequence != i:
+            # samples were lost, so the pending record is incomplete
+            pending = []
+            i = sequence
+        if not pending:
+            # skip forward to the start of the next record
+            skip = min(-i % n, samples.shape[0])
+            samples = samples[skip:]
+            i += skip
+            start = i
+        if samples.shape[0] == 0:
+            continue
+        pending.append(samples)
+        i += samples.shape[0]
+        collected = np.concatenate(pending)
+        k = collected.shape[0] // n
+        if k > 0:
+            t0 = time.perf_counter()
+            output_function(reduce_samples(collected[:k*n], n), start, n)
+            stats.add_write_wait(time.perf_counter() - t0)
+            stats.count_out(k)
+        remainder = collected[k*n:]
+        pending = [ remainder ] if remainder.shape[0] > 0 else []
+        start += k * n
+
+
+def get_command_args():
+    """Process command line arguments for the number of samples in each record."""
+    cmd_parser = argparse.ArgumentParser(description='Reduces hexadecimal text samples to '
+        'reduced records, as the Pico does with the reduce option of stream.py.')
+    cmd_parser.add_argument('--samples', type=int, default=1024,
+        help=f'Number of samples in each record, a power of two (16-{MAX_SAMPLES_PER_RECORD}).')
+    cmd_parser.add_argument('--block_size', type=int, default=scaler.BLOCK_SIZE,
+        help=f'Number of lines of text input processed together (1-{MAX_BLOCK_SAMPLES}).')
+    cmd_parser.add_argument('--max_latency', type=float, default=scaler.MAX_LATENCY,
+        help='Time in milliseconds after which a partial block of text input is processed '
+             'if the input stalls.')
+    program_name = cmd_parser.prog
+    args = cmd_parser.parse_args()
+    n = args.samples
+    if not 16 <= n <= MAX_SAMPLES_PER_RECORD or n & (n - 1):
+        cmd_parser.error(f'samples must be a power of two in the range 16-{MAX_SAMPLES_PER_RECORD}.')
+    if not 1 <= args.block_size <= MAX_BLOCK_SAMPLES:
+        cmd_parser.error(f'block_size must be in the range 1-{MAX_BLOCK_SAMPLES}.')
+    return (program_name, args)
+
+
+def main():
+    program_name, args = get_command_args()
+    # lines that can't be read are counted against this program
+    scaler.stats = stats
+    blocks = scaler.text_blocks(sys.stdin, args.block_size, args.max_latency / 1000)
+    try:
+        reduce_blocks(blocks, args.samples)
+    except BrokenPipeError:
+        pass
+
+
+if __name__ == '__main__':
+    main()
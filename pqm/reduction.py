@@ -0,0 +1,139 @@
+#               _            _   _
+#  _ __ ___  __| |_   _  ___| |_(_) ___  _ __    _ __  _   _
+# | '__/ _ \/ _` | | | |/ __| __| |/ _ \| '_ \  | '_ \| | | |
+# | | |  __/ (_| | |_| | (__| |_| | (_) | | | |_| |_) | |_| |
+# |_|  \___|\__,_|\__,_|\___|\__|_|\___/|_| |_(_) .__/ \__, |
+#                                               |_|    |___/
+#
+# Reduced sample records, for long timebases and low power logging.
+#
+# Instead of every sample, stream.py on the Pico can send one record for each
+# block of N samples, when it is started with the 'reduce=N' option. N is a power
+# of two, and each record covers the samples from a multiple of N. A record holds,
+# for each of the four channels, the minimum, maximum, sum and sum of squares of
+# the readings, and the sums of the products of the voltage reading with each of
+# the other channels, from which the mean power can be found. The mean of each
+# channel is the sum divided by the sample count. All fields are big-endian:
+#
+#   count:   number of samples in the record (uint16)
+#   min:     four channels (int16)
+#   max:     four channels (int16)
+#   sum:     four channels (int32)
+#   sum_sq:  four channels (uint64)
+#   sum_vi:  voltage (channel 3) times channels 0, 1 and 2 (int64)
+#
+# reader.py passes records on as text lines of REDUCED_MARKER followed by the
+# record in hexadecimal, and reducer.py makes the same lines from hexadecimal
+# samples, so that the reduction can be tested without a Pico. scaler.py scales
+# the records into lines of REDUCED_MARKER followed by the time of the first
+# sample, the sample count, and the minimum, maximum, mean and RMS of voltage,
+# current and leakage current, and the bounds and mean of power (see
+# SCALED_COLUMNS), which framer.py and analyser.py understand.
+#
+# Reduced records don't pass through the skew correction delay line in scaler.py,
+# because the individual samples are not available.
+
+import numpy as np
+
+REDUCED_MARKER = '%'
+REDUCED_RECORD = np.dtype([ ('count', '>u2'), ('min', '>i2', 4), ('max', '>i2', 4),
+                            ('sum', '>i4', 4), ('sum_sq', '>u8', 4), ('sum_vi', '>i8', 3) ])
+MAX_SAMPLES_PER_RECORD = 32768       # so that the sums fit in 32 bits
+
+# columns of a scaled record, after the marker
+SCALED_COLUMNS = [ 'time', 'count',
+                   'voltage_min', 'voltage_max', 'voltage_mean', 'voltage_rms',
+                   'current_min', 'current_max', 'current_mean', 'current_rms',
+                   'power_min', 'power_max', 'power_mean',
+                   'leakage_min', 'leakage_max', 'leakage_mean', 'leakage_rms' ]
+(TIME, COUNT, V_MIN, V_MAX, V_MEAN, V_RMS, I_MIN, I_MAX, I_MEAN, I_RMS,
+ P_MIN, P_MAX, P_MEAN, L_MIN, L_MAX, L_MEAN, L_RMS) = range(len(SCALED_COLUMNS))
+SCALED_LINE_FORMAT = (REDUCED_MARKER.replace('%', '%%') + ' %12.4f %6d' + ' %10.3f' * 4 + ' %10.5f' * 4
+                      + ' %10.3f' * 3 + ' %12.7f' * 4 + '\n')
+
+
+def reduce_samples(samples, n):
+    """Reference implementation of the reduction on the Pico. Reduces an (m, 4) array
+    of integer samples, where m is a multiple of n, to m/n records of n samples."""
+    x = np.asarray(samples, dtype=np.int64).reshape(-1, n, 4)
+    records = np.zeros(x.shape[0], dtype=REDUCED_RECORD)
+    records['count'] = n
+    records['min'] = x.min(axis=1)
+    records['max'] = x.max(axis=1)
+    records['sum'] = x.sum(axis=1)
+    records['sum_sq'] = np.square(x).sum(axis=1)
+    records['sum_vi'] = (x[:,:,3:] * x[:,:,:3]).sum(axis=1)
+    return records
+
+
+def format_records(records):
+    """Formats records as lines of text, each the marker followed by the record in
+    hexadecimal, and returns the text as a bytes object."""
+    return b''.join(REDUCED_MARKER.encode() + r.tobytes().hex().encode() + b'\n'
+                    for r in records)
+
+
+def parse_records(lines, report=print):
+    """Converts text lines from format_records() back into an array of records. Lines
+    that can't be read are reported with report(message) and skipped."""
+    data = []
+    for line in lines:
+        try:
+            if not line.startswith(REDUCED_MARKER):
+                raise ValueError
+            bs = bytes.fromhex(line[1:].strip())
+            if len(bs) != REDUCED_RECORD.itemsize:
+                raise ValueError
+            data.append(bs)
+        except ValueError:
+            report(f'reduction.py, parse_records(): Failed to read "{line}".')
+    return np.frombuffer(b''.join(data), dtype=REDUCED_RECORD)
+
+
+def scale_records(records, first_sample, interval, offsets, gains, current_channel):
+    """Applies the calibration offsets and gains to the records, where offsets and
+    gains are per channel, in the same way as scaler.py does to samples. first_sample
+    is the sequence number of the first sample of the first record. Returns an array
+    with one row per record, in the order of SCALED_COLUMNS."""
+    n = records['count'].astype(np.float64)
+    k = n[:,np.newaxis]
+    offsets = np.asarray(offsets, dtype=np.float64)
+    gains = np.asarray(gains, dtype=np.float64)
+    sums = records['sum'].astype(np.float64)
+    # the sums of the scaled values are expanded in terms of the integer sums,
+    # (x + offset) * gain, summed over the samples
+    low = (records['min'] + offsets) * gains
+    high = (records['max'] + offsets) * gains
+    means = (sums / k + offsets) * gains
+    mean_squares = ((records['sum_sq'].astype(np.float64) + 2 * offsets * sums) / k
+                    + offsets ** 2) * gains ** 2
+    rms = np.sqrt(np.maximum(mean_squares, 0.0))
+    v, c = 3, current_channel
+    mean_power = ((records['sum_vi'][:,c].astype(np.float64) + offsets[v] * sums[:,c]
+                   + offsets[c] * sums[:,v]) / n + offsets[v] * offsets[c]) * gains[v] * gains[c]
+    output = np.empty((records.shape[0], len(SCALED_COLUMNS)))
+    output[:,TIME] = interval * (first_sample + np.cumsum(n) - n)
+    output[:,COUNT] = n
+    for columns, channel in [ ((V_MIN, V_MAX, V_MEAN, V_RMS), v),
+                              ((I_MIN, I_MAX, I_MEAN, I_RMS), c),
+                              ((L_MIN, L_MAX, L_MEAN, L_RMS), 0) ]:
+        c_min, c_max, c_mean, c_rms = columns
+        output[:,c_min] = np.minimum(low[:,channel], high[:,channel])
+        output[:,c_max] = np.maximum(low[:,channel], high[:,channel])
+        output[:,c_mean] = means[:,channel]
+        output[:,c_rms] = rms[:,channel]
+    # power is only known to lie between the products of the voltage and current
+    # bounds
+    corners = np.stack([ output[:,V_MIN] * output[:,I_MIN], output[:,V_MIN] * output[:,I_MAX],
+                         output[:,V_MAX] * output[:,I_MIN], output[:,V_MAX] * output[:,I_MAX] ],
+                       axis=1)
+    output[:,P_MIN] = corners.min(axis=1)
+    output[:,P_MAX] = corners.max(axis=1)
+    output[:,P_MEAN] = mean_power
+    return output
+
+
+def format_scaled_records(output):
+    """Formats scaled records from scale_records() as text lines, in one string
+    operation."""
+    return (SCALED_LINE_FORMAT * output.shape[0]) % tuple(output.ravel().tolist())
@@ -10,16 +10,52 @@
 # 
 # Convert incoming integer samples to floating point and apply scaling
 # and calibration factors
+#
+# The time of each sample is calculated from its sequence number, which counts
+# samples from the source. Text input may contain sequence marker lines, '@'
+# followed by the sequence number of the next sample in hexadecimal, and binary
+# blocks carry the sequence number of their first sample in the header. If
+# samples are missing, the gap is counted and shows as a jump in the time column.
+#
+# Text input may also be reduced records, from a Pico streaming with the
+# 'reduce=N' option, which are scaled into lines of the minimum, maximum, mean
+# and RMS of each quantity in the record (see reduction.py).
 
 import sys
+import time
 import signal
+import argparse
+import numpy as np
 
 # local
 from constants import *
 from settings import Settings
+from block_io import read_binary_blocks, read_text_blocks, unwrap_sequence, MAX_BLOCK_SAMPLES
+from reduction import (REDUCED_MARKER, REDUCED_RECORD, parse_records, scale_records,
+                       format_scaled_records)
+from shm_ring import Ring_writer
+from stats import Stats
 
 # delay line length is for the time skew correction and is measured in samples
+# the maximum delay leaves room for the interpolator taps either side
 DELAY_LINE_LENGTH = 64
+MAX_DELAY = DELAY_LINE_LENGTH - 4
+# samples are processed in blocks of this many lines from text input, unless
+# the input stalls for longer than the maximum latency (milliseconds)
+BLOCK_SIZE = 128
+MAX_LATENCY = 50
+# text input line that gives the sequence number of the following sample
+SEQUENCE_MARKER = '@'
+# output format for one sample: time, voltage, current, power, leakage current
+LINE_FORMAT = '%12.4f %10.3f %10.5f %10.3f %12.7f\n'
+# lookup table from ascii code to hex digit value, 0xff for invalid characters
+HEX_VALUES = np.full(256, 0xff, dtype=np.uint16)
+HEX_VALUES[np.frombuffer(b'0123456789abcdef', dtype=np.uint8)] = np.arange(16)
+HEX_VALUES[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = np.arange(10, 16)
+
+# runtime counters, published to the stats directory
+stats = Stats('scaler.py')
+
 
 def from_twos_complement_hex(w):
     """Bit arithmetic on a two's complement, 16 bit number to convert to
@@ -41,9 +77,9 @@ def uncalibrated_constants():
     """Standard scaling constants without calibration adjustment."""
     offsets = [0, 0, 0, 0]
     gains   = HARDWARE_SCALE_FACTORS
-    # delays are measured in sample periods (integer)
-    # where -1 is latest sample in the delay line
-    delays  = [-1, -1, -1, -1]
+    # delays are measured in sample periods, and can be fractional,
+    # where 0.0 is the latest sample in the delay line
+    delays  = [0.0, 0.0, 0.0, 0.0]
     return (offsets, gains, delays)
 
 def calibrated_constants():
@@ -51,9 +87,12 @@ def calibrated_constants():
     try:
         offsets = st.cal_offsets
         gains   = [ h*g for h,g in zip(HARDWARE_SCALE_FACTORS, st.cal_gains) ]
-        delays = [ int(-1 - t // st.interval) for t in st.cal_skew_times ]
+        # skew times are converted to delays with a resolution of 1/1000 of a
+        # sample, which avoids floating point error in the division turning an
+        # exact number of samples into a fractional delay
+        delays = [ round(t / st.interval, 3) for t in st.cal_skew_times ]
         for d in delays:
-            if d < -(DELAY_LINE_LENGTH-1) or d > -1:
+            if d < 0.0 or d > MAX_DELAY:
                 raise ValueError
         return (offsets, gains, delays)
     except (NameError, ZeroDivisionError, TypeError, ValueError):
@@ -61,56 +100,267 @@ def calibrated_constants():
               'switching to uncalibrated.', file=sys.stderr)
         return uncalibrated_constants()
 
-def scale_readings(cs, offsets, gains):
-    """cs contains channel readings in integers"""
-    return [ (cs[i] + offsets[i]) * gains[i] for i in [0,1,2,3] ]
+def lagrange_coefficients(fraction):
+    """Coefficients of a four tap Lagrange interpolator, for taps at delays of 0, 1,
+    2 and 3 samples, which estimate the signal at a delay of 1 + fraction samples.
+    A fraction of 0.0 gives exactly [0, 1, 0, 0]."""
+    p = 1.0 + fraction
+    return [ -(p-1) * (p-2) * (p-3) / 6,
+              p * (p-2) * (p-3) / 2,
+             -p * (p-1) * (p-3) / 2,
+              p * (p-1) * (p-2) / 6 ]
+
+
+class Delay_line:
+    """Circular buffer of integer samples that corrects the timing skew between
+    channels. The buffer is allocated once. Each block of new samples is copied in
+    at the write pointer, and the delayed block is read out with a fixed index
+    offset for each channel.
+    If any delay has a fractional part, every channel is read through a four tap
+    Lagrange interpolator (FIR filter) instead. Channels with a whole number delay
+    get the coefficients [0, 1, 0, 0], which passes the sample through exactly. The
+    interpolator needs one sample either side of the required delay, so if a
+    fractional delay is less than one sample, all channels are delayed by one extra
+    sample."""
+
+    def __init__(self, delays, max_block_size=MAX_BLOCK_SAMPLES):
+        # the ring size is a power of two, so that indices wrap with a bit mask
+        size = 1
+        while size < DELAY_LINE_LENGTH + max_block_size:
+            size *= 2
+        self.mask = size - 1
+        # empty samples are zero, so that the first outputs match a delay line
+        # that is initialised with zeros
+        self.ring = np.zeros((size, 4), dtype=np.int32)
+        self.wp = 0                            # write pointer, next free row
+        self.channels = np.arange(4)
+        # delays are measured in samples, where 0 is the latest sample
+        delays = np.array(delays, dtype=np.float64)
+        whole = np.floor(delays)
+        fractions = delays - whole
+        self.interpolate = bool((fractions > 0.0).any())
+        if self.interpolate:
+            bulk_delay = 1 if (whole[fractions > 0.0] == 0).any() else 0
+            # tap_delays[k, ch] is the delay of tap k for channel ch
+            self.tap_delays = (whole + bulk_delay - 1).astype(np.int64) + np.arange(4)[:,np.newaxis]
+            self.coefficients = np.array([ lagrange_coefficients(f) for f in fractions ]).T
+        else:
+            self.tap_delays = whole.astype(np.int64)
+
+    def process(self, samples):
+        """Store a block of samples, shape (n, 4), and return the block with each
+        channel delayed by the required number of samples."""
+        n = samples.shape[0]
+        positions = np.arange(self.wp, self.wp + n)
+        self.ring[positions & self.mask] = samples
+        self.wp += n
+        # output sample j of channel ch is read from row j - delay[ch]
+        if self.interpolate:
+            indices = (positions[:,np.newaxis,np.newaxis] - self.tap_delays) & self.mask
+            taps = self.ring[indices, self.channels]
+            return np.einsum('nkc,kc->nc', taps, self.coefficients)
+        else:
+            indices = (positions[:,np.newaxis] - self.tap_delays) & self.mask
+            return self.ring[indices, self.channels]
+
+
+def hex_lines_to_samples(lines):
+    """Converts a list of text lines, each with four hex words, into an (n, 4) array
+    of signed integers. Lines in the standard fixed width format are converted in one
+    pass. If any line doesn't match, lines are converted individually and lines that
+    can't be read are reported and skipped."""
+    text = ('\n'.join(lines) + '\n').encode('ascii', errors='replace')
+    if len(text) == 20 * len(lines):
+        chars = np.frombuffer(text, dtype=np.uint8).reshape(-1, 4, 5)
+        digits = HEX_VALUES[chars[:,:,:4]]
+        separators_ok = (chars[:,:3,4] == ord(' ')).all() and (chars[:,3,4] == ord('\n')).all()
+        if separators_ok and (digits < 16).all():
+            values = (digits[:,:,0] << 12) | (digits[:,:,1] << 8) | (digits[:,:,2] << 4) | digits[:,:,3]
+            return values.view(np.int16)
+    samples = []
+    for line in lines:
+        line = line.rstrip()
+        try:
+            # split channel values into an integer array
+            sample = [ from_twos_complement_hex(w) for w in line.split() ]
+            if len(sample) != 4:
+                raise ValueError
+            samples.append(sample)
+        except ValueError:
+            stats.parse_failure(f'scaler.py, hex_lines_to_samples(): Failed to read "{line}".')
+    return np.array(samples, dtype=np.int16).reshape(-1, 4)
+
+def text_lines_to_samples(lines):
+    """Converts a list of text lines into an (n, 4) array of samples, or into an
+    array of reduced records if the lines are reduced records."""
+    if lines and lines[0].startswith(REDUCED_MARKER):
+        return parse_records(lines, report=stats.parse_failure)
+    return hex_lines_to_samples(lines)
+
+def text_blocks(stream, block_size, max_latency):
+    """Generator that yields a tuple of (sequence, samples) for every block_size lines
+    of hexadecimal text in the stream, or fewer lines if the input stalls for longer
+    than max_latency seconds. A block is split at each sequence marker line, and
+    sequence is the number given by the marker for the first sample after it, or None
+    where the samples continue on from the previous block. Blocks of reduced record
+    lines are yielded as arrays of records instead of samples."""
+    for lines in read_text_blocks(stream, block_size, max_latency):
+        markers = [ j for j, line in enumerate(lines) if line.startswith(SEQUENCE_MARKER) ]
+        if not markers:
+            yield (None, text_lines_to_samples(lines))
+            continue
+        if markers[0] > 0:
+            yield (None, text_lines_to_samples(lines[:markers[0]]))
+        for start, end in zip(markers, markers[1:] + [ len(lines) ]):
+            try:
+                sequence = int(lines[start][1:], base=16)
+            except ValueError:
+                stats.parse_failure(f'scaler.py, text_blocks(): Failed to read sequence '
+                                    f'marker "{lines[start]}".')
+                sequence = None
+            yield (sequence, text_lines_to_samples(lines[start+1:end]))
+
+def binary_blocks(stream):
+    """Generator that yields a tuple of (sequence, samples) for each binary block in
+    the stream, where sequence is the number of the first sample in the block."""
+    expected = 0
+    for sequence, records in read_binary_blocks(stream, 'scaler.py'):
+        # each record is four big-endian, two's complement 16 bit integers
+        samples = np.frombuffer(records, dtype='>i2').reshape(-1, 4)
+        # the header holds the low 32 bits of the sequence number
+        sequence = unwrap_sequence(sequence, expected)
+        expected = sequence + samples.shape[0]
+        yield (sequence, samples)
+
+def check_sequence(sequence, expected):
+    """Compares the sequence number of a block with the number expected from the
+    samples received so far, and counts any gap. Returns the sequence number of the
+    first sample in the block."""
+    if sequence is None or sequence == expected:
+        return expected
+    if sequence > expected:
+        stats.gap(sequence - expected, f'scaler.py, check_sequence(): {sequence - expected} '
+                  f'samples missing before sample {sequence}.')
+    else:
+        print(f'scaler.py, check_sequence(): Sequence went back from {expected} to '
+              f'{sequence}, the source has restarted.', file=sys.stderr)
+    return sequence
+
+def scale_block(i, samples, delay_line, offsets, gains):
+    """Corrects timing skew, then applies calibration and scale factors to a block of
+    samples starting at sequence number i. Returns an (n, 5) array of time, voltage,
+    current, power and leakage current."""
+    scaled = (delay_line.process(samples) + offsets) * gains
+    n = samples.shape[0]
+    output = np.empty((n, 5))
+    # calculate time axis position
+    output[:,0] = st.interval * np.arange(i, i+n)
+    # now pick out the individual readings ready for output
+    output[:,1] = scaled[:,3]
+    output[:,2] = scaled[:,current_channel]
+    np.multiply(output[:,1], output[:,2], out=output[:,3])
+    output[:,4] = scaled[:,0]
+    return output
+
+def print_block(output):
+    """Formats the whole block with a single string operation and write. The output is
+    flushed so that a partial block is passed on without waiting for more data."""
+    sys.stdout.write((LINE_FORMAT * output.shape[0]) % tuple(output.ravel().tolist()))
+    sys.stdout.flush()
+
+def print_records(output):
+    """Formats and writes a block of scaled records in the same way as print_block()."""
+    sys.stdout.write(format_scaled_records(output))
+    sys.stdout.flush()
+
+def publish_block(ring, output):
+    """Publishes the block into the shared memory ring, instead of printing it. The
+    time column is stored separately from the four sample values."""
+    ring.write(output[:,0], output[:,1:])
+
+
+def get_command_args():
+    """Process command line arguments for calibration and input format."""
+    cmd_parser = argparse.ArgumentParser(description='Converts integer samples to '
+        'floating point values, applying scaling and calibration factors.')
+    cmd_parser.add_argument('--uncalibrated', default=False, action=argparse.BooleanOptionalAction,
+        help='Apply hardware scale factors only, without calibration constants.')
+    cmd_parser.add_argument('--binary', default=False, action=argparse.BooleanOptionalAction,
+        help='Read binary blocks from reader.py instead of hexadecimal text.')
+    cmd_parser.add_argument('--block_size', type=int, default=BLOCK_SIZE,
+        help=f'Number of lines of text input processed together (1-{MAX_BLOCK_SAMPLES}).')
+    cmd_parser.add_argument('--max_latency', type=float, default=MAX_LATENCY,
+        help='Time in milliseconds after which a partial block of text input is processed '
+             'if the input stalls.')
+    cmd_parser.add_argument('--shm', default=False, action=argparse.BooleanOptionalAction,
+        help='Publish samples into the shared memory ring in $TEMP instead of printing '
+             'them to stdout.')
+    program_name = cmd_parser.prog
+    args = cmd_parser.parse_args()
+    if not 1 <= args.block_size <= MAX_BLOCK_SAMPLES:
+        cmd_parser.error(f'block_size must be in the range 1-{MAX_BLOCK_SAMPLES}.')
+    return (program_name, args)
 
 
 def main():
     global st
 
-    # check for uncalibrated mode
-    if len(sys.argv) == 2 and sys.argv[1] == '--uncalibrated':
-        run_calibrated = False
-    else:
-        run_calibrated = True
+    # check for uncalibrated mode, binary input and shared memory output
+    program_name, args = get_command_args()
+    run_calibrated = not args.uncalibrated
 
     # NB set_current_channel() function will be called automatically when
     # settings are changed
     st = Settings(lambda: set_current_channel())
 
-    # the delay line allows timing skew between channels to be corrected
-    delay_line = [ [0, 0, 0, 0] for i in range(DELAY_LINE_LENGTH) ]
-
-    i = 0   # sample index
+    i = 0   # sequence number of the next sample
     set_current_channel()
     offsets, gains, delays = calibrated_constants() if run_calibrated else uncalibrated_constants()
-    delay_lookup = list(zip([0,1,2,3], delays))
+    offsets = np.array(offsets, dtype=np.float64)
+    gains = np.array(gains, dtype=np.float64)
 
-    # now loop over all the lines of data from stdin
-    for line in sys.stdin:
-        line = line.rstrip()
-        try:
-            # calculate time axis position
-            t = st.interval*i
-            # split channel values into an integer array, removing the index field
-            new_sample = [ from_twos_complement_hex(w) for w in line.split() ]
-            delay_line = delay_line[1:]
-            delay_line.append(new_sample)
-            # use the delay line to correct for channel timing skew
-            # and apply calibration and scale factors to readings
-            scaled = scale_readings([ delay_line[delay][ch] for ch, delay in delay_lookup ],
-                                    offsets, gains)
-            # now pick out the individual readings ready for output
-            voltage = scaled[3]
-            current = scaled[current_channel]
-            power = voltage * current
-            leakage_current = scaled[0]
-            print(f'{t:12.4f} {voltage:10.3f} {current:10.5f} {power:10.3f} {leakage_current:12.7f}')
-            i += 1
+    # the delay line allows timing skew between channels to be corrected
+    delay_line = Delay_line(delays)
 
-        except ValueError:
-            print(f'scaler.py, main(): Failed to read "{line}".', file=sys.stderr)
+    # now loop over all the blocks of samples from stdin
+    if args.binary:
+        blocks = binary_blocks(sys.stdin.buffer)
+    else:
+        blocks = text_blocks(sys.stdin, args.block_size, args.max_latency / 1000)
+    if args.shm:
+        ring = Ring_writer()
+        output_function = lambda output: publish_block(ring, output)
+    else:
+        output_function = print_block
+    try:
+        for sequence, samples in stats.timed(blocks):
+            reduced = samples.dtype == REDUCED_RECORD
+            # n counts samples, including those that make up each reduced record
+            n = int(samples['count'].sum()) if reduced else samples.shape[0]
+            stats.count_in(n)
+            i = check_sequence(sequence, i)
+            if n == 0:
+                continue
+            if reduced and args.shm:
+                stats.parse_failure('scaler.py, main(): Reduced records can not be published '
+                                    'to shared memory, discarding.')
+                i += n
+                continue
+            if reduced:
+                output = scale_records(samples, i, st.interval, offsets, gains, current_channel)
+                write_function = print_records
+            else:
+                output = scale_block(i, samples, delay_line, offsets, gains)
+                write_function = output_function
+            t0 = time.perf_counter()
+            write_function(output)
+            stats.add_write_wait(time.perf_counter() - t0)
+            stats.count_out(n)
+            i += n
+    finally:
+        # let readers of the ring know that there are no more samples
+        if args.shm:
+            ring.close()
 
 
 if __name__ == '__main__':
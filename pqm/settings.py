@@ -84,10 +84,17 @@ class Settings():
         self.earth_leakage_current_display_index       = js['earth_leakage_current_display_index']
         self.earth_leakage_current_display_status      = js['earth_leakage_current_display_status']
         self.trigger_slope                             = js['trigger_slope']
+        self.trigger_channel                           = js['trigger_channel']
+        self.trigger_level                             = js['trigger_level']
+        self.trigger_type                              = js['trigger_type']
+        self.trigger_window                            = js['trigger_window']
+        self.trigger_pulse_width                       = js['trigger_pulse_width']
+        self.inrush_trigger_channel                    = js['inrush_trigger_channel']
         self.inrush_trigger_level                      = js['inrush_trigger_level']
         self.trigger_position                          = js['trigger_position']
         self.trigger_mode                              = js['trigger_mode']
         self.run_mode                                  = js['run_mode']
+        self.history_offset                            = js['history_offset']
         # now settings that are derived from the above
         self.set_derived_settings()
 
@@ -118,10 +125,17 @@ class Settings():
         js['earth_leakage_current_display_index']      = self.earth_leakage_current_display_index
         js['earth_leakage_current_display_status']     = self.earth_leakage_current_display_status
         js['trigger_slope']                            = self.trigger_slope
+        js['trigger_channel']                          = self.trigger_channel
+        js['trigger_level']                            = self.trigger_level
+        js['trigger_type']                             = self.trigger_type
+        js['trigger_window']                           = self.trigger_window
+        js['trigger_pulse_width']                      = self.trigger_pulse_width
+        js['inrush_trigger_channel']                   = self.inrush_trigger_channel
         js['inrush_trigger_level']                     = self.inrush_trigger_level
         js['trigger_position']                         = self.trigger_position
         js['trigger_mode']                             = self.trigger_mode
         js['run_mode']                                 = self.run_mode
+        js['history_offset']                           = self.history_offset
         # return the resulting json dictionary 
         return js 
  
@@ -343,10 +357,17 @@ default_settings = '''
     "earth_leakage_current_display_index": 4,
     "earth_leakage_current_display_status": false,
     "trigger_slope": "rising",
+    "trigger_channel": "voltage",
+    "trigger_level": 0.0,
+    "trigger_type": "edge",
+    "trigger_window": 0.0,
+    "trigger_pulse_width": 0.0,
+    "inrush_trigger_channel": "current",
     "inrush_trigger_level": 0.2,
     "trigger_position": 5,
     "trigger_mode": "sync",
-    "run_mode": "running"
+    "run_mode": "running",
+    "history_offset": 0
 }
 '''
 
@@ -0,0 +1,266 @@
+#      _                        _
+#  ___| |__  _ __ ___      _ __(_)_ __   __ _   _ __  _   _
+# / __| '_ \| '_ ` _ \    | '__| | '_ \ / _` | | '_ \| | | |
+# \__ \ | | | | | | | |   | |  | | | | | (_| |_| |_) | |_| |
+# |___/_| |_|_| |_| |_|___|_|  |_|_| |_|\__, (_) .__/ \__, |
+#                    |_____|            |___/  |_|    |___/
+#
+# Shared memory ring buffer for scaled samples.
+#
+# This is an optional alternative to the text pipe between scaler.py and its
+# consumers. scaler.py publishes each block of scaled samples into a memory-mapped
+# file in $TEMP (normally on the /run/shm RAM disk), and framer.py and analyser.py
+# each read from it independently, copying each block out of the mapped memory.
+# There is no text formatting or parsing, and no need for tee to copy the stream.
+#
+# File layout:
+#
+#   header:  magic (8 bytes), then six uint64 fields: capacity, generation,
+#            write count, writer pid, closed flag, write limit
+#   times:   capacity * float64, sample time in milliseconds
+#   values:  capacity * 4 * float32, voltage, current, power, leakage current
+#
+# The write count is the total number of samples ever written. It is updated
+# after the sample data, so that readers never see samples before they are
+# complete. Sample n is stored at index n % capacity. Each reader keeps its own
+# read count, and if it falls more than one capacity behind the writer, samples
+# have been overwritten and it skips forward.
+#
+# The writer doesn't wait for readers, so it can overwrite a block while a reader
+# is copying it. Before writing, the writer sets the write limit to the write count
+# that the block will take it to. After copying, a reader drops any samples more
+# than one capacity behind the write limit, because they may be mixed with newer
+# ones. Skipped and dropped samples are reported as gaps.
+#
+# The writer always creates a new file and renames it into place, so that a
+# reader never has the file truncated underneath its mapping. The generation is
+# incremented each time, which allows a reader to notice that scaler.py has been
+# restarted and attach to the new ring.
+
+import os
+import sys
+import mmap
+import time
+import tempfile
+import numpy as np
+
+
+RING_MAGIC = b'PQRING01'
+RING_FILE = 'sample_ring'
+RING_CAPACITY = 2**17                # samples, about 16 seconds at 7.8 kHz
+HEADER_SIZE = 64
+CAPACITY, GENERATION, WRITE_COUNT, WRITER_PID, CLOSED, WRITE_LIMIT = range(6)
+POLL_INTERVAL = 0.005                # seconds between checks for new samples
+ATTACH_TIMEOUT = 10.0                # seconds to wait for the writer to start
+
+
+def ring_path():
+    """The ring file lives in the same temporary directory as settings.json and
+    the named pipes."""
+    return os.path.join(os.getenv('TEMP', tempfile.gettempdir()), RING_FILE)
+
+
+def ring_size(capacity):
+    """File size in bytes for a ring of capacity samples."""
+    return HEADER_SIZE + capacity * 8 + capacity * 4 * 4
+
+
+def process_alive(pid):
+    """Checks whether a process exists. Only possible on posix systems, elsewhere
+    the writer is assumed to be alive until it sets the closed flag."""
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _Ring_map:
+    """Numpy views of the header, times and values in a mapped ring file."""
+
+    def __init__(self, mm):
+        self.mm = mm
+        self.header = np.ndarray((6,), dtype=np.uint64, buffer=mm, offset=len(RING_MAGIC))
+        self.capacity = int(self.header[CAPACITY])
+        self.times = np.ndarray((self.capacity,), dtype=np.float64, buffer=mm,
+                                offset=HEADER_SIZE)
+        self.values = np.ndarray((self.capacity, 4), dtype=np.float32, buffer=mm,
+                                 offset=HEADER_SIZE + self.capacity * 8)
+
+    def write_count(self, field=WRITE_COUNT):
+        """On 32 bit platforms, a 64 bit store may not be atomic, so the write count
+        is read until two successive reads agree."""
+        count = int(self.header[field])
+        while True:
+            check = int(self.header[field])
+            if check == count:
+                return count
+            count = check
+
+    def write_limit(self):
+        """The write count that the writer may have reached, including a block that
+        it is part way through writing."""
+        return max(self.write_count(WRITE_LIMIT), self.write_count())
+
+
+class Ring_writer:
+    """Creates the ring file and publishes blocks of samples into it."""
+
+    def __init__(self, path=None, capacity=RING_CAPACITY):
+        self.path = path or ring_path()
+        generation = 1
+        try:
+            with open(self.path, 'rb') as f:
+                old = f.read(HEADER_SIZE)
+            if old[:len(RING_MAGIC)] == RING_MAGIC:
+                generation = int(np.frombuffer(old, dtype=np.uint64, count=6,
+                                               offset=len(RING_MAGIC))[GENERATION]) + 1
+        except (OSError, ValueError):
+            pass
+        # build the new ring under a temporary name, then swap it into place
+        temp_path = f'{self.path}.{os.getpid()}'
+        with open(temp_path, 'w+b') as f:
+            f.truncate(ring_size(capacity))
+            self.mm = mmap.mmap(f.fileno(), ring_size(capacity))
+        self.mm[:len(RING_MAGIC)] = RING_MAGIC
+        header = np.ndarray((6,), dtype=np.uint64, buffer=self.mm, offset=len(RING_MAGIC))
+        header[CAPACITY] = capacity
+        header[GENERATION] = generation
+        header[WRITER_PID] = os.getpid()
+        os.replace(temp_path, self.path)
+        self.ring = _Ring_map(self.mm)
+        self.count = 0
+
+    def write(self, times, values):
+        """Copies a block of n sample times and an (n, 4) array of values into the
+        ring, then advances the write count."""
+        n = times.shape[0]
+        ring = self.ring
+        if n > ring.capacity:
+            times, values = times[-ring.capacity:], values[-ring.capacity:]
+            self.count += n - ring.capacity
+            n = ring.capacity
+        ring.header[WRITE_LIMIT] = self.count + n
+        start = self.count % ring.capacity
+        first = min(n, ring.capacity - start)
+        ring.times[start:start+first] = times[:first]
+        ring.values[start:start+first] = values[:first]
+        if first < n:
+            ring.times[:n-first] = times[first:]
+            ring.values[:n-first] = values[first:]
+        self.count += n
+        ring.header[WRITE_COUNT] = self.count
+
+    def close(self):
+        """Tells readers that there will be no more samples."""
+        self.ring.header[CLOSED] = 1
+
+
+class Ring_reader:
+    """Attaches to the ring file and reads blocks of samples. Samples that are
+    skipped because the reader fell behind are passed to gap_fn(missing, message),
+    normally Stats.gap(), and counted in skipped."""
+
+    def __init__(self, path=None, program_name='shm_ring.py', timeout=ATTACH_TIMEOUT,
+                 gap_fn=None):
+        self.path = path or ring_path()
+        self.program_name = program_name
+        self.gap_fn = gap_fn or (lambda missing, message: print(message, file=sys.stderr))
+        self.skipped = 0
+        self.ring = None
+        self.generation = 0
+        deadline = time.monotonic() + timeout
+        while not self._attach():
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'{program_name}, Ring_reader(): No sample ring '
+                                   f'found at {self.path}.')
+            time.sleep(0.1)
+
+    def _attach(self):
+        """Maps the ring file if it exists, was written by a live process and is a
+        different generation from the one currently attached. Returns True if
+        successful."""
+        try:
+            with open(self.path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        if len(mm) < HEADER_SIZE or mm[:len(RING_MAGIC)] != RING_MAGIC:
+            return False
+        capacity = int(np.frombuffer(mm, dtype=np.uint64, count=1, offset=len(RING_MAGIC))[0])
+        if len(mm) < ring_size(capacity):
+            return False
+        ring = _Ring_map(mm)
+        if (int(ring.header[GENERATION]) == self.generation
+            or ring.header[CLOSED]
+            or not process_alive(int(ring.header[WRITER_PID]))):
+            return False
+        self.ring = ring
+        self.generation = int(ring.header[GENERATION])
+        # start from the first sample if the ring hasn't wrapped yet, so that nothing
+        # is missed when all the programs start together, otherwise from the latest
+        self.count = ring.write_count()
+        if self.count <= ring.capacity:
+            self.count = 0
+        return True
+
+    def _writer_gone(self):
+        """True if the writer has closed the ring or exited, and hasn't been replaced
+        by a new writer."""
+        header = self.ring.header
+        if not header[CLOSED] and process_alive(int(header[WRITER_PID])):
+            return False
+        return not self._attach()
+
+    def _skip(self, skipped, reason):
+        """Counts samples that were skipped, and reports them as a gap."""
+        self.skipped += skipped
+        self.gap_fn(skipped, f'{self.program_name}, Ring_reader.read(): {reason}, skipping '
+                             f'{skipped} samples.')
+
+    def read(self, max_samples):
+        """Waits until at least one new sample is available, then returns a tuple of
+        (times, values) numpy arrays of up to max_samples samples, copied out of the
+        shared memory. Returns None when the writer has finished and all samples have
+        been read."""
+        while True:
+            available = self.ring.write_count() - self.count
+            if available <= 0:
+                if self._writer_gone():
+                    # pick up any samples written just before the writer finished
+                    if self.ring.write_count() > self.count:
+                        continue
+                    return None
+                time.sleep(POLL_INTERVAL)
+                continue
+            capacity = self.ring.capacity
+            if available > capacity:
+                skipped = available - capacity // 2
+                self._skip(skipped, 'Fell behind')
+                self.count += skipped
+                available -= skipped
+            start = self.count % capacity
+            # a single read doesn't cross the end of the ring
+            n = min(available, max_samples, capacity - start)
+            times = self.ring.times[start:start+n].copy()
+            values = self.ring.values[start:start+n].copy()
+            # samples that the writer may have reached while they were copied are
+            # dropped from the front of the block
+            overwritten = min(self.ring.write_limit() - capacity - self.count, n)
+            self.count += n
+            if overwritten > 0:
+                self._skip(overwritten, 'Overwritten while reading')
+                if overwritten == n:
+                    continue
+                times, values = times[overwritten:], values[overwritten:]
+            return (times, values)
+
+    def __iter__(self):
+        """Iterates over blocks of samples until the writer finishes."""
+        while (block := self.read(self.ring.capacity)) is not None:
+            yield block
+
@@ -0,0 +1,237 @@
+#      _        _
+#  ___| |_ __ _| |_ ___   _ __  _   _
+# / __| __/ _` | __/ __| | '_ \| | | |
+# \__ \ || (_| | |_\__ \_| |_) | |_| |
+# |___/\__\__,_|\__|___(_) .__/ \__, |
+#                        |_|    |___/
+#
+# Runtime counters for the pipeline programs.
+#
+# Each program keeps a Stats object, and counts the samples or lines that it
+# reads and writes, input that it can't parse, gaps in the sample sequence, buffer
+# overruns reported by the Pico and the time spent waiting to read and to write.
+# A program that buffers blocks internally also records the high-water mark of
+# its buffer and the blocks that it had to drop because the buffer was full. The
+# processing time of each pass round the main loop is recorded in a histogram.
+# About once a second, the counters are written as JSON to a file named after the
+# program in $TEMP/stats, which hellebores.py reads to show the health of the
+# pipeline. A stage that is falling behind has little read wait, and the stage
+# before it spends its time waiting to write.
+
+import os
+import sys
+import time
+import json
+import bisect
+import tempfile
+
+
+STATS_DIRECTORY = 'stats'
+STATS_INTERVAL = 1.0                  # seconds between updates of the stats file
+# upper bounds of the loop time histogram buckets in seconds, the last bucket
+# counts anything longer
+LOOP_TIME_BUCKETS = [ 0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3 ]
+MAX_REPORTED_FAILURES = 10            # parse failures or gaps after this are counted silently
+
+
+def stats_directory():
+    """The stats files live in the same temporary directory as settings.json."""
+    return os.path.join(os.getenv('TEMP', tempfile.gettempdir()), STATS_DIRECTORY)
+
+
+class Stats:
+    """Counters for one program or pipeline stage. The counting methods are cheap
+    enough to call once per block or line."""
+
+    def __init__(self, name, interval=STATS_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self.path = os.path.join(stats_directory(), f'{name}.json')
+        self.start_time = time.monotonic()
+        self.publish_time = self.start_time
+        self.samples_in = 0
+        self.blocks_in = 0
+        self.samples_out = 0
+        self.blocks_out = 0
+        self.parse_failures = 0
+        self.gaps = 0
+        self.unknown_gaps = 0
+        self.missing_samples = 0
+        self.overruns = 0
+        self.buffer_high_water = 0
+        self.buffer_capacity = 0
+        self.dropped_blocks = 0
+        self.dropped_samples = 0
+        self.read_wait = 0.0
+        self.write_wait = 0.0
+        self.loop_counts = [0] * (len(LOOP_TIME_BUCKETS) + 1)
+        self.max_loop_time = 0.0
+        # totals at the previous update, used to calculate rates
+        self.previous = (0, 0, 0.0, 0.0)
+        self.publish_failed = False
+
+    def count_in(self, samples, blocks=1):
+        self.samples_in += samples
+        self.blocks_in += blocks
+
+    def count_out(self, samples, blocks=1):
+        self.samples_out += samples
+        self.blocks_out += blocks
+
+    def add_read_wait(self, seconds):
+        self.read_wait += seconds
+
+    def add_write_wait(self, seconds):
+        self.write_wait += seconds
+
+    def parse_failure(self, message):
+        """Counts a parse failure. Only the first few messages are printed, so that a
+        stream of bad input doesn't flood the error log."""
+        self.parse_failures += 1
+        if self.parse_failures <= MAX_REPORTED_FAILURES:
+            print(message, file=sys.stderr)
+            if self.parse_failures == MAX_REPORTED_FAILURES:
+                print(f'{self.name}, Stats.parse_failure(): Further failures will be counted '
+                      f'in {self.path} only.', file=sys.stderr)
+
+    def gap(self, missing, message):
+        """Counts a gap of missing samples in the input, or a gap of unknown length if
+        missing is None. Gaps are reported in the same way as parse failures."""
+        self.gaps += 1
+        if missing is None:
+            self.unknown_gaps += 1
+        else:
+            self.missing_samples += missing
+        if self.gaps <= MAX_REPORTED_FAILURES:
+            print(message, file=sys.stderr)
+            if self.gaps == MAX_REPORTED_FAILURES:
+                print(f'{self.name}, Stats.gap(): Further gaps will be counted '
+                      f'in {self.path} only.', file=sys.stderr)
+
+    def overrun(self, message):
+        """Counts a buffer overrun upstream of this program, where samples were
+        skipped because they couldn't be sent in time. Overruns are reported in the
+        same way as parse failures."""
+        self.overruns += 1
+        if self.overruns <= MAX_REPORTED_FAILURES:
+            print(message, file=sys.stderr)
+            if self.overruns == MAX_REPORTED_FAILURES:
+                print(f'{self.name}, Stats.overrun(): Further overruns will be counted '
+                      f'in {self.path} only.', file=sys.stderr)
+
+    def buffer_level(self, blocks, capacity):
+        """Records the number of blocks held in an internal buffer of capacity
+        blocks, keeping the high-water mark."""
+        self.buffer_capacity = capacity
+        if blocks > self.buffer_high_water:
+            self.buffer_high_water = blocks
+
+    def drop(self, samples, message):
+        """Counts a block of samples dropped because an internal buffer was full.
+        Drops are reported in the same way as parse failures."""
+        self.dropped_blocks += 1
+        self.dropped_samples += samples
+        if self.dropped_blocks <= MAX_REPORTED_FAILURES:
+            print(message, file=sys.stderr)
+            if self.dropped_blocks == MAX_REPORTED_FAILURES:
+                print(f'{self.name}, Stats.drop(): Further drops will be counted '
+                      f'in {self.path} only.', file=sys.stderr)
+
+    def loop_time(self, seconds):
+        """Records the processing time of one pass round the main loop, and updates
+        the stats file if it is due."""
+        self.loop_counts[bisect.bisect_left(LOOP_TIME_BUCKETS, seconds)] += 1
+        if seconds > self.max_loop_time:
+            self.max_loop_time = seconds
+        now = time.monotonic()
+        if now - self.publish_time >= self.interval:
+            self.publish(now)
+
+    def timed(self, iterable):
+        """Generator that passes on the items from iterable. The time taken to get
+        each item is counted as read wait, and the time until the next item is
+        requested is recorded as the loop time."""
+        iterator = iter(iterable)
+        t0 = time.perf_counter()
+        for item in iterator:
+            t1 = time.perf_counter()
+            self.read_wait += t1 - t0
+            yield item
+            t0 = time.perf_counter()
+            self.loop_time(t0 - t1)
+        self.read_wait += time.perf_counter() - t0
+        self.publish()
+
+    def get_stats(self, now):
+        """The counters, plus rates and the proportion of time spent waiting since
+        the last update, as a dictionary."""
+        interval = max(now - self.publish_time, 1e-6)
+        samples_in, samples_out, read_wait, write_wait = self.previous
+        return {
+            'name': self.name,
+            'pid': os.getpid(),
+            'time': time.time(),
+            'uptime': now - self.start_time,
+            'samples_in': self.samples_in,
+            'blocks_in': self.blocks_in,
+            'samples_out': self.samples_out,
+            'blocks_out': self.blocks_out,
+            'parse_failures': self.parse_failures,
+            'gaps': self.gaps,
+            'unknown_gaps': self.unknown_gaps,
+            'missing_samples': self.missing_samples,
+            'overruns': self.overruns,
+            'buffer_high_water': self.buffer_high_water,
+            'buffer_capacity': self.buffer_capacity,
+            'dropped_blocks': self.dropped_blocks,
+            'dropped_samples': self.dropped_samples,
+            'read_wait': self.read_wait,
+            'write_wait': self.write_wait,
+            'samples_in_rate': (self.samples_in - samples_in) / interval,
+            'samples_out_rate': (self.samples_out - samples_out) / interval,
+            'read_wait_fraction': (self.read_wait - read_wait) / interval,
+            'write_wait_fraction': (self.write_wait - write_wait) / interval,
+            'loop_time_buckets': LOOP_TIME_BUCKETS,
+            'loop_time_counts': self.loop_counts,
+            'max_loop_time': self.max_loop_time }
+
+    def publish(self, now=None):
+        """Writes the stats file. The file is replaced in one step, so that a reader
+        never sees it partly written. Errors are reported once, and never stop the
+        program."""
+        now = now or time.monotonic()
+        stats = self.get_stats(now)
+        self.publish_time = now
+        self.previous = (self.samples_in, self.samples_out, self.read_wait, self.write_wait)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = f'{self.path}.{os.getpid()}'
+            with open(temp_path, 'w') as f:
+                json.dump(stats, f)
+            os.replace(temp_path, self.path)
+        except OSError:
+            if not self.publish_failed:
+                print(f"{self.name}, Stats.publish(): Couldn't write {self.path}.",
+                      file=sys.stderr)
+                self.publish_failed = True
+
+
+def read_all_stats(max_age=5.0):
+    """Reads the stats files of all programs that have updated them within max_age
+    seconds, and returns a list of dictionaries sorted by name."""
+    all_stats = []
+    try:
+        names = sorted(os.listdir(stats_directory()))
+    except OSError:
+        return all_stats
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(stats_directory(), name)) as f:
+                stats = json.load(f)
+            if time.time() - stats['time'] <= max_age:
+                all_stats.append(stats)
+        except (OSError, ValueError, KeyError):
+            pass
+    return all_stats
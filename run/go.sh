@@ -3,6 +3,50 @@
 # Increase the number of file descriptors that we can have in the current shell
 ulimit -n 2048
 
+# With the --shm option, scaler.py publishes samples into a shared memory ring
+# that framer.py and analyser.py read directly, instead of using text pipes
+# With the --single-process option, pipeline.py runs all the processing stages
+# as threads in one process
+# With the --framed option, the Pico sends each page of samples with a header and
+# checksum, so that reader.py can detect and recover from corrupted serial data
+# With the --delta option, the framed pages are also delta encoded, which reduces
+# the USB data rate
+# The --pages=N and --page_size=N options set the number of pages in the Pico
+# buffer and the number of samples in each page (see pico/stream.py)
+# With the --reduce=N option, for long timebases and low power logging, the Pico
+# sends one reduced record for every N samples instead of the samples themselves
+# (see pqm/reduction.py). Without a Pico, reducer.py reduces the simulated
+# samples. Reduced records are only passed through the text pipes.
+# With the --threaded option, reader.py reads the serial port and writes its
+# output in separate threads, so that short stalls downstream don't make the Pico
+# buffer overrun
+# With the --binary-frames option, framer.py sends each waveform frame to
+# hellebores.py as one binary message instead of lines of text (see block_io.py)
+# With the --history=SECONDS option, framer.py keeps a deep memory of the samples
+# (see history.py), so that earlier frames can be shown when stopped
+use_shm=false
+single_process=false
+framed=false
+page_format="framed"
+buffer_options=""
+reduce_samples=""
+threaded=false
+FRAME_OPTIONS=""
+HISTORY_OPTIONS=""
+for arg in "$@"; do
+    case "$arg" in
+        --shm) use_shm=true ;;
+        --single-process) single_process=true ;;
+        --framed) framed=true ;;
+        --delta) framed=true; page_format="delta" ;;
+        --pages=*|--page_size=*) buffer_options="$buffer_options ${arg#--}" ;;
+        --reduce=*) reduce_samples="${arg#--reduce=}" ;;
+        --threaded) threaded=true ;;
+        --binary-frames) FRAME_OPTIONS="--binary_frames" ;;
+        --history=*) HISTORY_OPTIONS="--history_seconds=${arg#--history=}" ;;
+    esac
+done
+
 # Raspberry Pi running Bookworm or later is enabled for Wayland graphics compositor
 # We set the environment variable to tell the SDL graphics library used by pygame
 # to use the wayland driver rather than X11 (which would have to be translated)
@@ -29,13 +73,49 @@ export PYGAME_HIDE_SUPPORT_PROMPT=hide
 
 # Figure out if we are running on real hardware or not
 grep --ignore-case raspberry '/sys/firmware/devicetree/base/model' &> /dev/null
+# On real hardware, reader.py passes binary blocks to scaler.py, which avoids
+# converting every sample to hexadecimal text and back again
 if [[ $? -eq 0 ]]; then
     real_hardware=true
-    READER="./reader.py"
+    READER="./reader.py --binary"
+    SCALER="./scaler.py --binary"
+    STREAM_OPTIONS="$buffer_options"
+    SERIAL_OPTIONS="--serial"
+    if $framed; then
+        READER="$READER --framed"
+        STREAM_OPTIONS=" $page_format$buffer_options"
+        SERIAL_OPTIONS="--serial --framed"
+    fi
 else
     real_hardware=false
     READER="./rain_chooser.py"
+    SCALER="./scaler.py"
+fi
+# The Pico sends reduced records in framed pages, and reader.py passes them on
+# as text
+REDUCER=""
+if [[ -n "$reduce_samples" ]]; then
+    use_shm=false
+    single_process=false
+    if $real_hardware; then
+        READER="./reader.py --framed"
+        SCALER="./scaler.py"
+        STREAM_OPTIONS="$buffer_options reduce=$reduce_samples"
+    else
+        REDUCER="./reducer.py --samples=$reduce_samples"
+    fi
+fi
+if $real_hardware && $threaded; then
+    READER="$READER --threaded"
 fi
+# Sample source for the text pipes, with reducer.py if it is needed
+read_samples() {
+    if [[ -n "$REDUCER" ]]; then
+        $READER | $REDUCER
+    else
+        $READER
+    fi
+}
 
 # TEMP: settings.json, error.log and named pipes will be stored here
 # /run/shm is preferred, because it is mounted as RAM disk
@@ -68,6 +148,7 @@ WAVEFORM_PIPE="$TEMP/waveform_pipe"
 ANALYSIS_PIPE="$TEMP/analysis_pipe"
 ANALYSIS_LOG_FILE="$TEMP/pqm.$$.csv"
 ERROR_LOG_FILE="$TEMP/error.log"
+SAMPLE_RING="$TEMP/sample_ring"
 
 # Clear old log file
 [[ -e "$ERROR_LOG_FILE" ]] && rm "$ERROR_LOG_FILE"
@@ -93,7 +174,7 @@ done
 # Run the capture and analysis, feeding two pipe files,
 # then pass both pipes as parameters to the GUI
 echo "Starting processing..."
-echo "Measurement source   : $READER"
+echo "Measurement source   : $READER $REDUCER"
 echo "Analysis log file    : $ANALYSIS_LOG_FILE"
 echo "Waveform pipe file   : $WAVEFORM_PIPE"
 echo "Analysis pipe file   : $ANALYSIS_PIPE"
@@ -111,16 +192,37 @@ echo "Analysis pipe file   : $ANALYSIS_PIPE"
 # Reset the Pico and start streaming.
 if $real_hardware; then
     ./pico_control.py --hard_reset
-    ./pico_control.py --command "START stream.py 1x 1x 1x 1x 7.812k" --no_response
+    ./pico_control.py --command "START stream.py 1x 1x 1x 1x 7.812k$STREAM_OPTIONS" --no_response
 fi
 
 # Plumbing, pipe, pipe, pipe...
-"$READER" \
-    | ./scaler.py | tee >(./framer.py > "$WAVEFORM_PIPE") \
-        | ./analyser.py | tee >(./analysis_to_csv.py > "$ANALYSIS_LOG_FILE") > "$ANALYSIS_PIPE" &
+if $single_process; then
+    # pipeline.py reads the Pico directly on real hardware, otherwise it reads the
+    # simulated samples from stdin
+    if $real_hardware; then
+        ./pipeline.py $SERIAL_OPTIONS --waveform_file="$WAVEFORM_PIPE" --analysis_file="$ANALYSIS_PIPE" \
+            --csv_file="$ANALYSIS_LOG_FILE" $FRAME_OPTIONS $HISTORY_OPTIONS &
+    else
+        $READER | ./pipeline.py --waveform_file="$WAVEFORM_PIPE" --analysis_file="$ANALYSIS_PIPE" \
+            --csv_file="$ANALYSIS_LOG_FILE" $FRAME_OPTIONS $HISTORY_OPTIONS &
+    fi
+elif $use_shm; then
+    # Remove any ring left over from a previous run, so that the readers wait for
+    # the new one. framer.py and analyser.py read the ring independently, so tee
+    # isn't needed to split the sample stream.
+    [[ -e "$SAMPLE_RING" ]] && rm "$SAMPLE_RING"
+    $READER | $SCALER --shm &
+    SCALER_PID=$!
+    ./framer.py --shm $FRAME_OPTIONS $HISTORY_OPTIONS > "$WAVEFORM_PIPE" &
+    ./analyser.py --shm | tee >(./analysis_to_csv.py > "$ANALYSIS_LOG_FILE") > "$ANALYSIS_PIPE" &
+else
+    read_samples \
+        | $SCALER | tee >(./framer.py $FRAME_OPTIONS $HISTORY_OPTIONS > "$WAVEFORM_PIPE") \
+            | ./analyser.py | tee >(./analysis_to_csv.py > "$ANALYSIS_LOG_FILE") > "$ANALYSIS_PIPE" &
+fi
 
 # hellebores.py GUI reads from both the waveform and analysis pipes...
-./hellebores.py --waveform_file="$WAVEFORM_PIPE" --analysis_file="$ANALYSIS_PIPE"
+./hellebores.py --waveform_file="$WAVEFORM_PIPE" --analysis_file="$ANALYSIS_PIPE" $FRAME_OPTIONS
 
 # Because hellebores.py is running in the foreground, this script blocks (waits here) until it
 # exits. The reader, scaler, analysis and waveform programs all terminate at the point
@@ -130,6 +232,10 @@ fi
 # We'll check it's status shortly
 exit_code=$?
 
+# In shared memory mode, scaler.py has no pipe to the GUI that would break, so
+# stop it explicitly. reader.py then terminates when its pipe to scaler.py closes.
+[[ -n "$SCALER_PID" ]] && kill $SCALER_PID 2> /dev/null
+
 # Restore stderr file descriptor 2 from saved state on 4, then delete fd 4
 exec 2>&4 4>&-
 
@@ -140,7 +246,7 @@ if [[ $exit_code -eq 2 ]]; then
     echo "Restarting $0 in 5s..."
     sleep 5
     cd "$CWD"
-    exec "$0"
+    exec "$0" "$@"
 
 # 3: Software update
 elif [[ $exit_code -eq 3 ]]; then
@@ -157,7 +263,7 @@ elif [[ $exit_code -eq 3 ]]; then
     echo "Restarting $0 in 5s..."
     sleep 5
     cd "$CWD"
-    exec $0
+    exec $0 "$@"
 
 # 4: Shutdown
 elif [[ $exit_code -eq 4 ]]; then
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+# Faults for testing the framed page stream from the Pico, shared by
+# page_stream_check.py and pico_emulator.py. A USB serial link can lose bytes,
+# add bytes, flip bits or lose whole pages. In an overrun, the Pico skips the page
+# and flags the next one that it sends, so only the sender can emulate it.
+
+FAULTS = [ 'drop byte', 'extra byte', 'flip bit', 'drop page', 'overrun' ]
+LINK_FAULTS = [ fault for fault in FAULTS if fault != 'overrun' ]
+
+
+def damage_page(page, fault, rng):
+    """Returns the encoded page with the fault applied, as bytes. rng is a
+    random.Random object. An overrun loses the page, in the same way as 'drop
+    page'; flagging the next page is left to the sender."""
+    page = bytearray(page)
+    position = rng.randrange(len(page))
+    if fault == 'drop byte':
+        del page[position]
+    elif fault == 'extra byte':
+        page.insert(position, rng.randrange(256))
+    elif fault == 'flip bit':
+        page[position] ^= 1 << rng.randrange(8)
+    elif fault in ('drop page', 'overrun'):
+        page = b''
+    return bytes(page)
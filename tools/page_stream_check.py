@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Emulates the framed page stream that pico/stream.py sends with the 'framed' or
+# 'delta' option, corrupts it in the ways that a USB serial link can (lost bytes,
+# extra bytes, flipped bits and whole pages lost), or that the Pico does when its
+# buffer overruns, and checks that the page decoder used by reader.py recovers.
+# Every page that the decoder returns must match the page that was sent with the
+# same number, no more pages may be lost than were damaged, and every page that
+# follows an overrun must be flagged, unless it was lost itself. Also reports the
+# speed of the decoder against the real time page rate, and the data rate over
+# USB. Exits with an error if recovery fails, so no Pico is needed for testing.
+
+import os
+import sys
+import time
+import random
+import argparse
+
+# reader.py and block_io.py live in the pqm directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'pqm'))
+import reader
+from block_io import encode_sample_page, Page_decoder, PAGE_DELTA, PAGE_OVERRUN, RECORD_SIZE
+from reader_benchmark import make_blocks, SAMPLE_RATE
+from page_faults import FAULTS, damage_page
+
+PAGE_SIZE = 64                       # stream.py sends pages of 64 samples by default
+
+
+def make_pages(n_pages, sample_rate, page_size=PAGE_SIZE):
+    """Splits synthetic sample blocks into page payloads."""
+    page_bytes = page_size * RECORD_SIZE
+    data = b''.join(make_blocks(n_pages * page_bytes // reader.BLOCK_SIZE + 1, sample_rate))
+    return [ data[i*page_bytes:(i+1)*page_bytes] for i in range(n_pages) ]
+
+
+def corrupt_stream(payloads, n_faults, rng, delta=False):
+    """Encodes the pages in the framed format, with faults applied to randomly
+    chosen pages. Returns the stream as bytes, and a dictionary of the fault applied
+    to each damaged page number."""
+    damaged = {}
+    while len(damaged) < min(n_faults, len(payloads) - 1):
+        # the first page is left intact, so that the page numbering starts there
+        damaged[rng.randrange(1, len(payloads))] = rng.choice(FAULTS)
+    stream = bytearray()
+    for sequence, payload in enumerate(payloads):
+        flags = PAGE_OVERRUN if damaged.get(sequence - 1) == 'overrun' else 0
+        page = encode_sample_page(sequence, payload, delta, flags)
+        if sequence in damaged:
+            page = damage_page(page, damaged[sequence], rng)
+        stream += page
+    return (bytes(stream), damaged)
+
+
+def decode_stream(stream, read_size):
+    """Feeds the stream to the decoder in serial reads of read_size bytes, and
+    returns the decoded pages with delta encoded pages converted back to sample
+    records, the decoder and the time taken."""
+    decoder = Page_decoder()
+    pages = []
+    t0 = time.perf_counter()
+    for i in range(0, len(stream), read_size):
+        for page_type, flags, page_number, payload in decoder.decode(stream[i:i+read_size]):
+            if page_type == PAGE_DELTA:
+                payload = reader.delta_decode(payload)
+            pages.append((page_type, flags, page_number, payload))
+    return (pages, decoder, time.perf_counter() - t0)
+
+
+def main():
+    cmd_parser = argparse.ArgumentParser(description='Check recovery and speed of the '
+        'framed page decoder with an emulated, corrupted Pico stream.')
+    cmd_parser.add_argument('--pages', type=int, default=20000,
+        help='Number of pages to send.')
+    cmd_parser.add_argument('--page_size', type=int, default=PAGE_SIZE,
+        help='Number of samples in each page, as set by the stream.py page_size option.')
+    cmd_parser.add_argument('--faults', type=int, default=200,
+        help='Number of pages to damage.')
+    cmd_parser.add_argument('--read_size', type=int, default=reader.PAGE_READ_SIZE,
+        help='Number of bytes in each emulated serial read.')
+    cmd_parser.add_argument('--seed', type=int, default=1,
+        help='Seed for the random choice of faults.')
+    cmd_parser.add_argument('--delta', default=False, action=argparse.BooleanOptionalAction,
+        help='Send delta encoded pages, as stream.py does with the delta option.')
+    cmd_parser.add_argument('--sample_rate', type=float, default=SAMPLE_RATE,
+        help='Sample rate of the synthetic signal and of the real time comparison, in samples/s.')
+    args = cmd_parser.parse_args()
+
+    rng = random.Random(args.seed)
+    payloads = make_pages(args.pages, args.sample_rate, args.page_size)
+    stream, damaged = corrupt_stream(payloads, args.faults, rng, args.delta)
+    overruns = sum(1 for fault in damaged.values() if fault == 'overrun')
+    pages, decoder, elapsed = decode_stream(stream, args.read_size)
+
+    wrong = [ n for _, _, n, payload in pages if n >= len(payloads) or payload != payloads[n] ]
+    received = { n for _, _, n, _ in pages }
+    lost = set(range(len(payloads))) - received
+    unexpected = lost - set(damaged)
+    flagged = { n for _, flags, n, _ in pages if flags & PAGE_OVERRUN }
+    # the page sent after each overrun carries the flag. It can be lost itself, to
+    # another fault or to a second overrun, or there may be no page after the last
+    # overrun, and then the flag is lost with it.
+    should_flag = { n + 1 for n, fault in damaged.items() if fault == 'overrun' }
+    missed = (should_flag & received) - flagged
+    spurious = flagged - should_flag
+    pages_per_second = len(payloads) / elapsed
+    real_time_pages = args.sample_rate / args.page_size
+    usb_rate = len(stream) / len(payloads) * real_time_pages
+
+    print(f'Pages sent            : {len(payloads)}, {len(damaged)} damaged')
+    print(f'Pages decoded         : {len(pages)}, {len(lost)} lost, {len(wrong)} wrong')
+    print(f'Corrupted pages found : {decoder.corrupt_pages}')
+    print(f'Overruns flagged      : {len(flagged)} of {overruns}, '
+          f'{len(should_flag - received)} lost with the flagged page')
+    print(f'Bytes skipped         : {decoder.skipped_bytes}')
+    print(f'Decoder speed         : {pages_per_second:.0f} pages/s, '
+          f'{pages_per_second / real_time_pages:.0f} x real time')
+    print(f'USB data rate         : {usb_rate / 1000:.1f} kB/s, '
+          f'{len(stream) / (len(payloads) * args.page_size * RECORD_SIZE) * 100:.0f}% '
+          f'of raw samples')
+
+    if wrong or unexpected or missed or spurious:
+        print(f'page_stream_check.py: {len(wrong)} pages decoded wrongly, {len(unexpected)} '
+              f'undamaged pages lost, {len(missed)} overruns not flagged, {len(spurious)} '
+              f'pages flagged wrongly.', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
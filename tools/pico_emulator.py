@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+# Stands in for the Pico running pico/main.py, on a pseudo-terminal, so that the
+# programs that control the Pico can be tested without one. Implements the file
+# commands of main.py (LISTDIR, SAVE, SHA256, RENAME, REMOVE, CAT) and the
+# information commands, on the files in a local directory. Commands are echoed
+# and responses are terminated in the same way as main.py, or without the
+# terminator with --legacy, as older versions of main.py do.
+#
+# 'START stream.py ...' streams synthetic samples with the same arguments and in
+# the same formats as pico/stream.py (raw, framed, delta or reduced pages), at
+# the sample rate or --speed times faster, until a CONTROL-C is received. As on
+# the Pico, pages are skipped and the next one is flagged if writing to the port
+# stalls for longer than the buffer lasts. With --error_rate, a fraction of the
+# pages are damaged in the ways listed in page_faults.py, so that
+# serial read errors and resynchronisation can be soak tested.
+#
+# Connect to the port name that is printed, with pico_control.py --port, or for
+# all the programs that use the Pico, by setting the PQM_SERIAL_PORT environment
+# variable. --link makes a fixed name for the port, eg
+#   tools/pico_emulator.py --link /tmp/pico --speed 2 &
+#   export PQM_SERIAL_PORT=/tmp/pico
+#   pqm/pico_control.py --command "START stream.py 1x 1x 1x 1x 7.812k framed" --no_response
+#   pqm/reader.py --framed | pqm/scaler.py > /dev/null
+
+import os
+import sys
+import tty
+import time
+import random
+import select
+import signal
+import hashlib
+import argparse
+import threading
+import numpy as np
+
+# pico_control.py and block_io.py live in the pqm directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'pqm'))
+from pico_control import RESPONSE_END
+from block_io import encode_page, encode_sample_page, PAGE_REDUCED, PAGE_OVERRUN, RECORD_SIZE
+from reduction import reduce_samples
+from constants import HARDWARE_SCALE_FACTORS
+from page_faults import LINK_FAULTS, damage_page
+
+CHUNK = 1024                         # same file chunk size as main.py
+# the options and sample rates of stream.py
+SAMPLE_RATES = { '244': 244.140625, '488': 488.28125, '976': 976.5625, '1.953k': 1953.125,
+                 '3.906k': 3906.25, '7.812k': 7812.5, '15.625k': 15625.0, '31.250k': 31250.0 }
+DEFAULT_SAMPLE_RATE = '7.812k'
+DEFAULT_PAGES = 4
+DEFAULT_PAGE_SIZE = 64
+ALLOWED_PAGES = (4, 8, 16)
+ALLOWED_PAGE_SIZES = (16, 32, 64, 128)
+ALLOWED_REDUCTIONS = tuple(2 ** k for k in range(4, 16))
+
+
+def make_samples(first, n, sample_rate):
+    """Returns n sample records from sample number first, equivalent to the 'Two'
+    preset of rain_chooser.py, as bytes in the Pico format."""
+    t = (first + np.arange(n)) / sample_rate
+    root2 = np.sqrt(2)
+    v = root2 * 230 * np.sin(2 * np.pi * 50.05 * t)
+    c = (root2 * 0.1 * np.sin(2 * np.pi * (50.05 * t - 30 / 360))
+         + root2 * 0.02 * np.sin(2 * np.pi * (150.15 * t - 60 / 360))
+         + root2 * 0.03 * np.sin(2 * np.pi * (250.25 * t + 180 / 360)))
+    el = root2 * 0.0002 * np.sin(2 * np.pi * (50.05 * t + 90 / 360))
+    values = np.stack([ el, c, c, v ], axis=1) / HARDWARE_SCALE_FACTORS
+    return (np.trunc(values).astype(np.int64) & 0xffff).astype('>u2').tobytes()
+
+
+def get_option_value(option, allowed, default):
+    """Returns the integer value of a name=value option, as stream.py does."""
+    try:
+        value = int(option.split('=')[1])
+    except ValueError:
+        return default
+    return value if value in allowed else default
+
+
+class Pico_emulator:
+    """Serves the main.py command set on the master side of a pseudo-terminal. The
+    slave side, port_name, behaves like the Pico USB serial port."""
+
+    def __init__(self, directory, legacy=False, speed=1.0, error_rate=0.0, seed=1):
+        self.directory = directory
+        self.legacy = legacy
+        self.speed = speed
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        # the sample count carries on across restarts of streaming, as on the Pico
+        self.sample_count = 0
+        self.pages_sent = 0
+        self.pages_damaged = 0
+        self.overruns = 0
+        self.master, self.slave = os.openpty()
+        # no echo or line ending translation on the port, as on the Pico, which
+        # does its own echo
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+        self.commands_served = 0
+
+    def start(self):
+        """Serves commands in a background thread."""
+        thread = threading.Thread(target=self.serve, daemon=True)
+        thread.start()
+        return thread
+
+    def write(self, text):
+        """Writes text to the port with Pico style CRLF line endings."""
+        os.write(self.master, text.replace('\n', '\r\n').encode('utf-8'))
+
+    def read_exactly(self, n):
+        """Reads exactly n bytes from the port."""
+        data = bytearray()
+        while len(data) < n:
+            data += os.read(self.master, n - len(data))
+        return bytes(data)
+
+    def read_command(self):
+        """Reads a command line, echoing characters back, as main.py does."""
+        command_string = ''
+        while True:
+            c = os.read(self.master, 1).decode('utf-8', errors='replace')
+            if c == '\r':
+                continue
+            self.write(c)
+            if c == '\n':
+                return command_string
+            command_string += c
+
+    def write_all(self, bs):
+        """Writes all of bs to the port, waiting while the port is full."""
+        view = memoryview(bs)
+        while view:
+            view = view[os.write(self.master, view):]
+
+    def interrupted(self):
+        """Returns True if a CONTROL-C has been received. Anything else sent to the
+        port while streaming is ignored, as on the Pico."""
+        while select.select([ self.master ], [], [], 0)[0]:
+            if b'\x03' in os.read(self.master, 1024):
+                return True
+        return False
+
+    def damage(self, page):
+        """Damages the page in one of the ways that a USB serial link can, and
+        returns it."""
+        self.pages_damaged += 1
+        return damage_page(page, self.rng.choice(LINK_FAULTS), self.rng)
+
+    def stream(self, arguments):
+        """Streams pages in the same way as stream.py, started with the same
+        arguments, until interrupted."""
+        sample_rate = SAMPLE_RATES.get(arguments[5] if len(arguments) > 5 else DEFAULT_SAMPLE_RATE,
+                                       SAMPLE_RATES[DEFAULT_SAMPLE_RATE])
+        page_format = 'raw'
+        n_pages = DEFAULT_PAGES
+        page_size = DEFAULT_PAGE_SIZE
+        record_samples = 0
+        for option in arguments[6:]:
+            if option in ('framed', 'delta'):
+                page_format = option
+            elif option.startswith('pages='):
+                n_pages = get_option_value(option, ALLOWED_PAGES, DEFAULT_PAGES)
+            elif option.startswith('page_size='):
+                page_size = get_option_value(option, ALLOWED_PAGE_SIZES, DEFAULT_PAGE_SIZE)
+            elif option.startswith('reduce='):
+                record_samples = get_option_value(option, ALLOWED_REDUCTIONS, 0)
+        if record_samples:
+            page_format = 'reduced'
+            page_size = min(page_size, record_samples)
+        # the sequence number counts pages, or records
+        sequence_samples = record_samples if record_samples else page_size
+        overrun_lag = (n_pages - 1) * page_size
+        rate = sample_rate * self.speed
+        # start from the beginning of a page
+        sent = self.sample_count - self.sample_count % page_size
+        start = sent
+        t0 = time.perf_counter()
+        flags = 0
+        record = None
+        record_start = 0
+        while not self.interrupted():
+            if self.speed > 0:
+                # the samples that the ADC would have made by now
+                self.sample_count = start + int((time.perf_counter() - t0) * rate)
+                if self.sample_count - sent < page_size:
+                    time.sleep((sent + page_size - self.sample_count) / rate)
+                    continue
+                if self.sample_count - sent >= overrun_lag:
+                    # core 1 has caught up with the pages that weren't sent yet
+                    self.overruns += 1
+                    flags = PAGE_OVERRUN
+                    sent = self.sample_count - self.sample_count % page_size - page_size
+            else:
+                self.sample_count = sent + page_size
+            payload = make_samples(sent, page_size, sample_rate)
+            sequence = (sent // sequence_samples) & 0xffff
+            if page_format == 'raw':
+                page = payload
+            elif page_format == 'reduced':
+                # a record that missed any of its samples is never completed
+                if sent % record_samples == 0:
+                    record = b''
+                    record_start = sent
+                if record is not None and sent == record_start + len(record) // RECORD_SIZE:
+                    record += payload
+                else:
+                    record = None
+                page = b''
+                if record is not None and len(record) == record_samples * RECORD_SIZE:
+                    records = reduce_samples(np.frombuffer(record, dtype='>i2').reshape(-1, 4),
+                                             record_samples)
+                    page = encode_page(PAGE_REDUCED, flags, sequence, records.tobytes())
+                    record = None
+            else:
+                page = encode_sample_page(sequence, payload, page_format == 'delta', flags)
+            if page:
+                if self.rng.random() < self.error_rate:
+                    page = self.damage(page)
+                self.write_all(page)
+                self.pages_sent += 1
+                flags = 0
+            sent += page_size
+        print(f'pico_emulator.py, stream(): {self.pages_sent} pages sent, {self.pages_damaged} '
+              f'damaged, {self.overruns} overruns.', file=sys.stderr)
+        return 'Program stream.py failed to start or quit with an error.'
+
+    def path(self, filename):
+        """Files are kept in the emulator directory, which stands for the Pico
+        flash storage."""
+        return os.path.join(self.directory, os.path.basename(filename))
+
+    def process_command(self, command_string):
+        """Returns the response to a command, in the same way as main.py, or None for
+        a blank line."""
+        words = command_string.split()
+        if len(words) == 0:
+            return None
+        command = words[0]
+        arguments = words[1:]
+        if command == 'SAVE' and len(arguments) == 2:
+            filename, length = arguments
+            try:
+                data = self.read_exactly(int(length))
+                with open(self.path(filename), 'wb') as f:
+                    f.write(data)
+                return 'OK'
+            except (OSError, ValueError):
+                return f'Failed to save {filename}.'
+        elif command == 'SHA256' and len(arguments) == 1:
+            filename = arguments[0]
+            try:
+                sha = hashlib.sha256()
+                with open(self.path(filename), 'rb') as f:
+                    while chunk := f.read(CHUNK):
+                        sha.update(chunk)
+                return sha.hexdigest()
+            except OSError:
+                return f'Failed to determine SHA256 for {filename}.'
+        elif command == 'RENAME' and len(arguments) == 2:
+            try:
+                os.replace(self.path(arguments[0]), self.path(arguments[1]))
+                return 'OK'
+            except OSError:
+                return 'Failed to rename file.'
+        elif command == 'REMOVE' and len(arguments) == 1:
+            try:
+                os.remove(self.path(arguments[0]))
+                return 'OK'
+            except OSError:
+                return 'Failed to remove file.'
+        elif command == 'LISTDIR' and len(arguments) == 0:
+            return str(sorted(os.listdir(self.directory)))
+        elif command == 'CAT' and len(arguments) == 1:
+            try:
+                with open(self.path(arguments[0])) as f:
+                    return f.read()
+            except OSError:
+                return f'Failed to read {arguments[0]}'
+        elif command == 'START' and len(arguments) > 0:
+            if os.path.basename(arguments[0]) == 'stream.py':
+                return self.stream(arguments)
+            return f'Program {arguments[0]} failed to start or quit with an error.'
+        elif command == 'MACHINE' and len(arguments) == 0:
+            return 'Raspberry Pi Pico emulator'
+        elif command == 'VERSION' and len(arguments) == 0:
+            return 'emulator'
+        return f'Error: failed to parse {words}.'
+
+    def respond(self, response):
+        """Writes a response, with the terminator unless emulating older versions
+        of main.py."""
+        self.write(response + '\n')
+        if not self.legacy:
+            self.write(RESPONSE_END + '\n')
+
+    def serve(self):
+        """Reads and responds to commands until the process exits."""
+        self.respond('Control program main.py started on Pico.')
+        while True:
+            response = self.process_command(self.read_command())
+            if response is not None:
+                self.respond(response)
+                self.commands_served += 1
+
+
+def get_command_args():
+    cmd_parser = argparse.ArgumentParser(description='Emulates the command interface of '
+        'main.py on the Pico over a pseudo-terminal.')
+    cmd_parser.add_argument('--directory', default='.',
+        help='Directory that holds the files of the emulated Pico.')
+    cmd_parser.add_argument('--legacy', default=False, action=argparse.BooleanOptionalAction,
+        help='Leave out the response terminator, as older versions of main.py do.')
+    cmd_parser.add_argument('--link', default=None,
+        help='Make a symbolic link with this name to the port, while the emulator runs.')
+    cmd_parser.add_argument('--speed', type=float, default=1.0,
+        help='Rate of streaming as a multiple of the sample rate, or 0 to stream as fast '
+             'as the port is read.')
+    cmd_parser.add_argument('--error_rate', type=float, default=0.0,
+        help='Fraction of the streamed pages to damage.')
+    cmd_parser.add_argument('--seed', type=int, default=1,
+        help='Seed for the random choice of damage.')
+    args = cmd_parser.parse_args()
+    return args
+
+
+def main():
+    args = get_command_args()
+    emulator = Pico_emulator(args.directory, args.legacy, args.speed, args.error_rate, args.seed)
+    print(emulator.port_name, flush=True)
+    if args.link:
+        os.symlink(emulator.port_name, args.link)
+    # exit cleanly when killed, so that the link is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        emulator.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.link:
+            os.remove(args.link)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,23 +10,6 @@ PICO_DIR="$(realpath $SCRIPT_DIR/../pico)"
 PICO_FILES="main.py stream.py"
 
 
-compare_files () {
-    sha256_local=$(shasum -a 256 "$PICO_DIR/$1" | awk '{print $1}')
-    sha256_pico=$("$PROGRAM_DIR/pico_control.py" --command "SHA256 $2" | tr '\n' ' ' | awk '{print $3}')
-    [[ "$sha256_pico" == "$sha256_local" ]]
-}
-
-transfer_file_to_pico () {
-    # $1 name of file to send
-    file_length="$(ls -l $1 | awk '{print $5}')"
-    # transfer the file over to a temporary file
-    "$PROGRAM_DIR/pico_control.py" --command "SAVE transfer_file $file_length" --send_file "$1"
-    # we only actually overwrite the old file if the temporary file checksum matches the source
-    if $(compare_files "$pico_file" transfer_file); then
-        "$PROGRAM_DIR/pico_control.py" --command "RENAME transfer_file $pico_file"
-    fi
-}
-
 # Hard reset Pico, since it may be streaming and unresponsive to commands
 echo "***** UPDATE PICO UTILITY *****"
 echo "Resetting Pico."
@@ -43,23 +26,15 @@ else
     exit 1
 fi
 
-# Now compare local and Pico files, updating if the checksums differ
+# Now compare local and Pico files, updating if the checksums differ. This is
+# done in a single pico_control.py session, which copies each file that differs
+# to a temporary file, checks it and renames it.
 echo "Comparing local versions of files with those currently on Pico..."
+pico_paths=""
 for pico_file in $PICO_FILES; do
-    if $(compare_files "$pico_file" "$pico_file"); then
-        echo "$pico_file: same version local and Pico, no need to update."
-    else
-	echo "$pico_file: file versions are different, updating Pico..."
-	echo "$pico_file: copying new file over..."
-        transfer_file_to_pico "$PICO_DIR/$pico_file"
-	echo "$pico_file: checking if the copied file is good."
-        if $(compare_files "$pico_file" "$pico_file"); then
-            echo "$pico_file: update succeeded."
-	else
-            echo "$pico_file: update failed, unfortunately."
-	fi
-    fi
+    pico_paths="$pico_paths $PICO_DIR/$pico_file"
 done
+"$PROGRAM_DIR/pico_control.py" --update $pico_paths
 
 # Hard reset Pico again, so that we now run the new code
 echo "Resetting Pico."
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Checks pico_control.py --update against the pseudo-terminal stand-in for
+# main.py in pico_emulator.py, so that no Pico is needed. Updates an empty
+# emulated Pico with the files in the pico directory, then runs the update again
+# when the files are the same, and after one of them has changed on the Pico.
+# Every file on the emulated Pico must end up the same as the local file, and the
+# time taken by each update is reported. With --legacy, the emulator leaves out
+# the response terminators, as older versions of main.py do, which shows the
+# time taken when every response waits for the serial port to go quiet.
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import subprocess
+
+from pico_emulator import Pico_emulator
+
+TOOLS_DIR = os.path.dirname(os.path.realpath(__file__))
+PICO_CONTROL = os.path.join(TOOLS_DIR, '..', 'pqm', 'pico_control.py')
+PICO_DIR = os.path.join(TOOLS_DIR, '..', 'pico')
+PICO_FILES = [ 'main.py', 'stream.py' ]
+
+
+def run_update(port_name, paths):
+    """Runs an update session with pico_control.py, and returns the output and the
+    time taken."""
+    t0 = time.perf_counter()
+    result = subprocess.run([ sys.executable, PICO_CONTROL, '--port', port_name, '--update', *paths ],
+                            capture_output=True, text=True)
+    return (result.stdout + result.stderr, result.returncode, time.perf_counter() - t0)
+
+
+def files_match(paths, directory):
+    """Returns the names of files that differ between the local paths and the
+    emulated Pico."""
+    different = []
+    for path in paths:
+        pico_path = os.path.join(directory, os.path.basename(path))
+        with open(path, 'rb') as f:
+            local = f.read()
+        try:
+            with open(pico_path, 'rb') as f:
+                pico = f.read()
+        except OSError:
+            pico = None
+        if local != pico:
+            different.append(os.path.basename(path))
+    return different
+
+
+def main():
+    cmd_parser = argparse.ArgumentParser(description='Check pico_control.py --update against '
+        'an emulated Pico.')
+    cmd_parser.add_argument('--legacy', default=False, action=argparse.BooleanOptionalAction,
+        help='Emulate older versions of main.py, without response terminators.')
+    args = cmd_parser.parse_args()
+
+    paths = [ os.path.join(PICO_DIR, f) for f in PICO_FILES ]
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        emulator = Pico_emulator(directory, args.legacy)
+        emulator.start()
+        # the emulated Pico starts empty, then has the same files, then one of them
+        # is out of date
+        stages = [ ('empty', None), ('same', None),
+                   ('changed', lambda: open(os.path.join(directory, PICO_FILES[-1]), 'ab').write(b'#\n')) ]
+        for name, prepare in stages:
+            if prepare:
+                prepare()
+            output, returncode, elapsed = run_update(emulator.port_name, paths)
+            different = files_match(paths, directory)
+            print(f'Update of {name + " Pico":12s}: {elapsed:.2f} s, exit code {returncode}, '
+                  f'{len(different)} files different afterwards')
+            for line in output.splitlines():
+                print(f'    {line}')
+            if returncode != 0 or different:
+                failed = True
+        print(f'Commands served       : {emulator.commands_served}')
+
+    if failed:
+        print('pico_update_check.py: update did not leave the emulated Pico files the same as '
+              'the local files.', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Compares the speed of the original line-by-line hex text output of reader.py
+# with the vectorised block formatting. Sample blocks are generated in the same
+# shape as rain_chooser.py output (50Hz voltage and current with harmonics,
+# earth leakage) so that no Pico is needed. Output is discarded.
+
+import os
+import sys
+import math
+import time
+import argparse
+
+# reader.py and constants.py live in the pqm directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'pqm'))
+import reader
+from constants import HARDWARE_SCALE_FACTORS
+
+SAMPLE_RATE = 7812.5
+
+
+def make_blocks(n_blocks, sample_rate=SAMPLE_RATE):
+    """Generate n_blocks of binary sample data, equivalent to the 'Two' preset of
+    rain_chooser.py."""
+    root2 = math.sqrt(2)
+    blocks = []
+    i = 0
+    for _ in range(n_blocks):
+        bs = bytearray()
+        for _ in range(reader.BUFFER_SIZE):
+            t = i / sample_rate
+            v = root2 * 230 * math.sin(2 * math.pi * 50.05 * t)
+            c = (root2 * 0.1 * math.sin(2 * math.pi * (50.05 * t - 30 / 360))
+                 + root2 * 0.02 * math.sin(2 * math.pi * (150.15 * t - 60 / 360))
+                 + root2 * 0.03 * math.sin(2 * math.pi * (250.25 * t + 180 / 360)))
+            el = root2 * 0.0002 * math.sin(2 * math.pi * (50.05 * t + 90 / 360))
+            for value, sf in zip([el, c, c, v], HARDWARE_SCALE_FACTORS):
+                bs += (int(value / sf) & 0xffff).to_bytes(2, 'big')
+            i += 1
+        blocks.append(bytes(bs))
+    return blocks
+
+
+def print_hex_per_line(bs, sequence):
+    """The original implementation, one f-string and print() per sample."""
+    hexstr = bs.hex()
+    for i in range(0, reader.BLOCK_SIZE*2, 16):
+        print(f'{hexstr[i:i+4]} {hexstr[i+4:i+8]} {hexstr[i+8:i+12]} {hexstr[i+12:i+16]}')
+
+
+def lines_per_second(output_function, blocks):
+    """Time the output function over all the blocks, writing to the null device."""
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as sys.stdout:
+        t0 = time.perf_counter()
+        for k, bs in enumerate(blocks):
+            output_function(bs, k * reader.BUFFER_SIZE)
+        sys.stdout.flush()
+        elapsed = time.perf_counter() - t0
+    sys.stdout = stdout
+    return len(blocks) * reader.BUFFER_SIZE / elapsed
+
+
+def main():
+    cmd_parser = argparse.ArgumentParser(description='Benchmark reader.py hex text output.')
+    cmd_parser.add_argument('--blocks', type=int, default=2000,
+        help='Number of 128 sample blocks to format.')
+    args = cmd_parser.parse_args()
+
+    blocks = make_blocks(args.blocks)
+    # check that both methods produce identical text before timing them
+    if reader.format_hex(blocks[0]).decode() != ''.join(
+        f'{h[i:i+4]} {h[i+4:i+8]} {h[i+8:i+12]} {h[i+12:i+16]}\n'
+        for h in [blocks[0].hex()] for i in range(0, reader.BLOCK_SIZE*2, 16)):
+        print('reader_benchmark.py: output of format_hex() differs from original.', file=sys.stderr)
+        sys.exit(1)
+
+    before = lines_per_second(print_hex_per_line, blocks)
+    after = lines_per_second(reader.print_hex, blocks)
+    print(f'Real time requirement : {SAMPLE_RATE:12.0f} lines/s')
+    print(f'Per-line print()      : {before:12.0f} lines/s')
+    print(f'Block format_hex()    : {after:12.0f} lines/s')
+    print(f'Speed up              : {after/before:12.1f} x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Compares the throughput of the original per-sample scaler loop with the block
+# engine in scaler.py, and checks that both produce identical output. Input is
+# hex text generated in the same shape as rain_chooser.py output. Output is
+# discarded.
+
+import os
+import sys
+import time
+import argparse
+
+# scaler.py and reader.py live in the pqm directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'pqm'))
+import reader
+import scaler
+from settings import Settings
+from reader_benchmark import make_blocks
+
+
+def per_sample(lines, offsets, gains, delays):
+    """The original implementation: list based delay line, scale_readings() and an
+    f-string for every sample. Delays are rounded to whole samples. Returns the
+    output text."""
+    st = scaler.st
+    delay_line = [ [0, 0, 0, 0] for i in range(scaler.DELAY_LINE_LENGTH) ]
+    # in the original delay line, -1 is the latest sample
+    delay_lookup = list(zip([0,1,2,3], [ -1 - round(d) for d in delays ]))
+    output = []
+    i = 0
+    for line in lines:
+        line = line.rstrip()
+        t = st.interval*i
+        new_sample = [ scaler.from_twos_complement_hex(w) for w in line.split() ]
+        delay_line = delay_line[1:]
+        delay_line.append(new_sample)
+        cs = [ delay_line[delay][ch] for ch, delay in delay_lookup ]
+        scaled = [ (cs[i] + offsets[i]) * gains[i] for i in [0,1,2,3] ]
+        voltage = scaled[3]
+        current = scaled[scaler.current_channel]
+        power = voltage * current
+        leakage_current = scaled[0]
+        output.append(f'{t:12.4f} {voltage:10.3f} {current:10.5f} {power:10.3f} {leakage_current:12.7f}\n')
+        i += 1
+    return ''.join(output)
+
+
+def per_block(lines, offsets, gains, delays):
+    """The block engine of scaler.py. Returns the output text."""
+    delay_line = scaler.Delay_line(delays)
+    offsets = scaler.np.array(offsets, dtype=float)
+    gains = scaler.np.array(gains, dtype=float)
+    output = []
+    i = 0
+    for j in range(0, len(lines), scaler.BLOCK_SIZE):
+        samples = scaler.hex_lines_to_samples(lines[j:j+scaler.BLOCK_SIZE])
+        block = scaler.scale_block(i, samples, delay_line, offsets, gains)
+        output.append((scaler.LINE_FORMAT * block.shape[0]) % tuple(block.ravel().tolist()))
+        i += samples.shape[0]
+    return ''.join(output)
+
+
+def timed(function, *args):
+    t0 = time.perf_counter()
+    result = function(*args)
+    return (result, time.perf_counter() - t0)
+
+
+def main():
+    cmd_parser = argparse.ArgumentParser(description='Benchmark scaler.py sample processing.')
+    cmd_parser.add_argument('--blocks', type=int, default=500,
+        help='Number of 128 sample blocks to process.')
+    cmd_parser.add_argument('--skew', type=float, nargs=4, default=[0.768, 0.0, 0.0, 0.0],
+        help='Calibration skew times in ms for the four channels.')
+    args = cmd_parser.parse_args()
+
+    scaler.st = Settings(reload_on_signal=False)
+    scaler.st.cal_skew_times = args.skew
+    scaler.set_current_channel()
+    offsets, gains, delays = scaler.calibrated_constants()
+
+    text = b''.join(reader.format_hex(bs) for bs in make_blocks(args.blocks)).decode()
+    lines = text.splitlines()
+
+    before, t_before = timed(per_sample, lines, offsets, gains, delays)
+    after, t_after = timed(per_block, lines, offsets, gains, delays)
+    # outputs can only be compared if there are no fractional sample delays,
+    # which the original implementation doesn't support
+    if all(d == round(d) for d in delays):
+        if before != after:
+            print('scaler_benchmark.py: block output differs from per-sample output.', file=sys.stderr)
+            sys.exit(1)
+        comparison = '(outputs identical)'
+    else:
+        comparison = '(fractional delays, outputs not compared)'
+
+    n = len(lines)
+    print(f'Samples processed     : {n:12d} {comparison}')
+    print(f'Real time requirement : {scaler.st.sample_rate:12.0f} samples/s')
+    print(f'Per-sample loop       : {n/t_before:12.0f} samples/s')
+    print(f'Block engine          : {n/t_after:12.0f} samples/s')
+    print(f'Speed up              : {t_before/t_after:12.1f} x')
+
+
+if __name__ == '__main__':
+    main()
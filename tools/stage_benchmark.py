@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# Measures the throughput of each pipeline program on its own, by feeding it a
+# recorded or synthetic sample stream from a file as fast as it will go, with the
+# output discarded. For each stage, reports samples per second, CPU seconds used
+# per second of signal and peak resident memory, and checks the speed against a
+# real time margin at the normal sample rate. The script exits with an error if
+# any stage is below its margin, so it can be used as a regression check.
+# Needs a posix system, but no Pico.
+#
+# Inputs for the downstream stages are prepared by running the upstream programs
+# once, untimed. Stage timings include program start up, as in normal use.
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+# the pipeline programs live in the pqm directory
+PROGRAM_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'pqm'))
+sys.path.insert(0, PROGRAM_DIR)
+import reader
+from block_io import binary_block
+from reader_benchmark import make_blocks, SAMPLE_RATE
+
+# stage name, program and arguments, input file
+STAGES = [
+    ('scaler.py',                [ 'scaler.py' ],                  'hex'),
+    ('scaler.py --binary',       [ 'scaler.py', '--binary' ],      'binary'),
+    ('framer.py',                [ 'framer.py' ],                  'scaled'),
+    ('framer.py --unmapped',     [ 'framer.py', '--unmapped' ],    'scaled'),
+    ('analyser.py',              [ 'analyser.py' ],                'scaled'),
+    ('analysis_to_csv.py',       [ 'analysis_to_csv.py' ],         'analysis'),
+]
+CSV_SECONDS = 3600                   # analysis results are repeated to cover an hour
+
+
+def run_stage(program_args, input_file, output_file=os.devnull):
+    """Runs a program with input from a file, and returns a tuple of wall time,
+    CPU time and peak resident memory in MB."""
+    with open(input_file, 'rb') as fin, open(output_file, 'wb') as fout:
+        t0 = os.times().elapsed
+        p = subprocess.Popen([ sys.executable ] + program_args, cwd=PROGRAM_DIR,
+                             stdin=fin, stdout=fout, stderr=subprocess.PIPE)
+        # wait4() collects the resource usage of this child process alone
+        stderr = p.stderr.read()
+        _, status, usage = os.wait4(p.pid, 0)
+        elapsed = os.times().elapsed - t0
+        p.returncode = os.waitstatus_to_exitcode(status)
+    if p.returncode != 0:
+        print(f'stage_benchmark.py, run_stage(): {" ".join(program_args)} exited with code '
+              f'{p.returncode}.\n{stderr.decode(errors="replace")}', file=sys.stderr)
+        sys.exit(1)
+    # ru_maxrss is measured in kB on Linux
+    return (elapsed, usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024)
+
+
+def prepare_inputs(work_dir, blocks):
+    """Writes the input file for each stage into work_dir, and returns a dictionary
+    of file names and the number of seconds of signal that each contains."""
+    files = { k: os.path.join(work_dir, k) for k in ['hex', 'binary', 'scaled', 'analysis'] }
+    with open(files['hex'], 'wb') as f:
+        for bs in blocks:
+            f.write(reader.format_hex(bs))
+    with open(files['binary'], 'wb') as f:
+        for sequence, bs in enumerate(blocks):
+            f.write(binary_block(bs, sequence * reader.BUFFER_SIZE))
+    run_stage([ 'scaler.py' ], files['hex'], files['scaled'])
+    analysis = os.path.join(work_dir, 'analysis_once')
+    run_stage([ 'analyser.py' ], files['scaled'], analysis)
+    with open(analysis) as f:
+        lines = f.readlines()
+    if not lines:
+        print('stage_benchmark.py, prepare_inputs(): Not enough samples for analyser.py to '
+              'produce results, increase --blocks.', file=sys.stderr)
+        sys.exit(1)
+    with open(files['analysis'], 'w') as f:
+        f.writelines(lines[i % len(lines)] for i in range(CSV_SECONDS))
+    signal_seconds = len(blocks) * reader.BUFFER_SIZE / SAMPLE_RATE
+    durations = { 'hex': signal_seconds, 'binary': signal_seconds, 'scaled': signal_seconds,
+                  'analysis': CSV_SECONDS }
+    return (files, durations)
+
+
+def hex_from_file(input_file):
+    """Converts a recorded file of hexadecimal text lines into binary blocks of
+    samples, discarding any incomplete block at the end."""
+    with open(input_file) as f:
+        data = bytes.fromhex(''.join(line.strip().replace(' ', '') for line in f))
+    return [ data[i:i+reader.BLOCK_SIZE]
+             for i in range(0, len(data) - reader.BLOCK_SIZE + 1, reader.BLOCK_SIZE) ]
+
+
+def main():
+    cmd_parser = argparse.ArgumentParser(description='Benchmark each pipeline program '
+        'against the real time sample rate.')
+    cmd_parser.add_argument('--blocks', type=int, default=2000,
+        help='Number of 128 sample blocks of synthetic signal to process.')
+    cmd_parser.add_argument('--input', default=None,
+        help='Recorded file of hexadecimal text samples, eg reader.py output, to use instead '
+             'of the synthetic signal.')
+    cmd_parser.add_argument('--margin', type=float, default=1.0,
+        help='Minimum speed of every stage, as a multiple of real time.')
+    cmd_parser.add_argument('--thresholds', default=None,
+        help='JSON file of minimum speeds for individual stages, as multiples of real time, '
+             'eg {"framer.py": 1.5}. These override --margin.')
+    args = cmd_parser.parse_args()
+
+    thresholds = {}
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+
+    blocks = hex_from_file(args.input) if args.input else make_blocks(args.blocks)
+    failures = []
+    # each stage has its own settings.json in a temporary directory, so that a
+    # running instance of the meter isn't disturbed
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.environ['TEMP'] = work_dir
+        files, durations = prepare_inputs(work_dir, blocks)
+        print(f'Real time requirement : {SAMPLE_RATE:.1f} samples/s, '
+              f'{durations["hex"]:.1f}s of signal\n')
+        print(f'{"Stage":24s} {"samples/s":>12s} {"x real time":>12s} '
+              f'{"CPU s/s":>10s} {"peak RSS MB":>12s}')
+        for name, program_args, input_kind in STAGES:
+            elapsed, cpu, rss = run_stage(program_args, files[input_kind])
+            seconds = durations[input_kind]
+            real_time_factor = seconds / elapsed
+            required = thresholds.get(name, args.margin)
+            flag = '' if real_time_factor >= required else f'  FAIL (< {required:.2f})'
+            if flag:
+                failures.append(name)
+            print(f'{name:24s} {seconds*SAMPLE_RATE/elapsed:12.0f} {real_time_factor:12.2f} '
+                  f'{cpu/seconds:10.4f} {rss:12.1f}{flag}')
+
+    if failures:
+        print(f'\nstage_benchmark.py: {", ".join(failures)} slower than the required margin.',
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
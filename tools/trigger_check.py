@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+# Checks the block trigger search in framer.py against the per-sample trigger
+# logic, with a synthetic signal. The voltage has a varying frequency and noise, so
+# that it crosses the trigger level several times within the holdoff, the current
+# has bursts that fire the inrush trigger, and the earth leakage current has short
+# spikes. Blocks are of random size, and between blocks the run mode and timebase
+# are changed, as they are from the user interface. For every trigger mode and
+# slope, and for each trigger source and type, the frames output by
+# framer.process_samples() must be the same as the frames output when every sample
+# is tested on its own by a plainly written per-sample reference, independent of the
+# block search, and goes through framer.process_sample(). Reports the time
+# taken by each, with the frame output formatting left out, and exits with an error
+# if any frame differs, so no Pico is needed for testing.
+
+import os
+import io
+import sys
+import time
+import random
+import argparse
+import tempfile
+import numpy as np
+
+# framer.py lives in the pqm directory
+PROGRAM_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'pqm'))
+sys.path.insert(0, PROGRAM_DIR)
+import framer
+from settings import Settings
+
+SAMPLE_RATE = 7812.5
+TRIGGER_MODES = [ 'sync', 'inrush', 'freerun' ]
+TRIGGER_SLOPES = [ 'rising', 'falling' ]
+TIME_DISPLAY_INDEXES = [ 0, 3, 6 ]    # 1, 10 and 100 ms/div with the default settings
+INRUSH_TRIGGER_LEVEL = 1.0            # A
+# the default trigger source, then others that are checked in sync and inrush modes
+DEFAULT_SOURCE = { 'trigger_channel': 'voltage', 'trigger_level': 0.0, 'trigger_type': 'edge',
+                   'trigger_window': 0.0, 'trigger_pulse_width': 0.0,
+                   'inrush_trigger_channel': 'current', 'inrush_trigger_level': INRUSH_TRIGGER_LEVEL }
+OTHER_SOURCES = {
+    'leakage edge':  { 'trigger_channel': 'earth_leakage', 'trigger_level': 0.002,
+                       'inrush_trigger_channel': 'earth_leakage', 'inrush_trigger_level': 0.004 },
+    'voltage window': { 'trigger_level': 50.0, 'trigger_type': 'window', 'trigger_window': 200.0 },
+    'current pulse':  { 'trigger_channel': 'current', 'trigger_level': 0.3, 'trigger_type': 'pulse',
+                        'trigger_pulse_width': 3.0 },
+    # the current is beyond the level for about 5.9 ms each cycle, so that most
+    # pulses are only wide enough if their run is carried on between blocks
+    'current long pulse': { 'trigger_channel': 'current', 'trigger_level': 0.3, 'trigger_type': 'pulse',
+                            'trigger_pulse_width': 5.5 },
+    'power edge':    { 'trigger_channel': 'power', 'trigger_level': 50.0 } }
+
+
+def make_signal(n_samples, rng):
+    """Returns an array of samples with four channels: voltage, current, power and
+    earth leakage current."""
+    t = np.arange(n_samples) / SAMPLE_RATE
+    # the frequency wanders between 48 and 52 Hz
+    frequency = 50.0 + 2.0 * np.sin(2 * np.pi * 0.2 * t)
+    phase = 2 * np.pi * np.cumsum(frequency) / SAMPLE_RATE
+    voltage = 325.0 * np.sin(phase) + rng.normal(0.0, 8.0, n_samples)
+    current = 0.5 * np.sin(phase - 0.3) + rng.normal(0.0, 0.01, n_samples)
+    # bursts of inrush current, 50 ms long
+    burst = int(0.05 * SAMPLE_RATE)
+    for start in rng.integers(0, n_samples - burst, 6):
+        current[start:start+burst] += 5.0 * np.sin(phase[start:start+burst])
+    leakage = rng.normal(0.0, 0.0002, n_samples)
+    # spikes of earth leakage current, two samples long
+    for start in rng.integers(0, n_samples - 2, 40):
+        leakage[start:start+2] += rng.choice([ -1.0, 1.0 ]) * rng.uniform(0.001, 0.006)
+    return np.column_stack((voltage, current, voltage * current, leakage))
+
+
+def split_blocks(samples, rng, max_block):
+    """Splits the samples into blocks of random size."""
+    ends = np.cumsum(rng.integers(1, max_block + 1, len(samples)))
+    ends = ends[ends < len(samples)]
+    return np.split(samples, ends)
+
+
+def plan_actions(n_blocks, rng):
+    """Returns a dictionary of actions to take before some of the blocks, as the
+    user interface does: stopping, running again and changing the timebase."""
+    actions = {}
+    for i in rng.integers(1, n_blocks, 12):
+        actions[int(i)] = rng.choice([ 'stop', 'run', 'timebase' ])
+    return actions
+
+
+class Reference_trigger:
+    """The per-sample trigger conditions, written out plainly for one sample at a
+    time, as an oracle for the block trigger search in framer.py. The edge and inrush
+    tests are those of the original per-sample trigger functions. For the pulse type,
+    the number of entries beyond the level is counted explicitly, sample by sample,
+    so that pulses that carry on from one block into the next are checked too."""
+
+    def __init__(self, st, buf):
+        self.st = st
+        self.buf = buf
+        self.configure_for_new_settings()
+
+    def configure_for_new_settings(self):
+        st = self.st
+        self.sync_enabled = st.trigger_mode in [ 'sync', 'inrush' ]
+        self.inrush_enabled = st.trigger_mode == 'inrush'
+        self.channel = framer.TRIGGER_CHANNELS[st.trigger_channel]
+        self.inrush_channel = framer.TRIGGER_CHANNELS[st.inrush_trigger_channel]
+        self.pulse_width = st.trigger_pulse_width / (st.interval * self.buf.entry_samples)
+        # entries beyond the level up to the previous sample, counted from the last
+        # settings change, as in framer.py
+        self.run = 0
+
+    def i_frac(self, v1, v2, trigger_level):
+        """linear interpolation fraction between two samples"""
+        return (trigger_level - v1) / (v2 - v1) if v1 != v2 else 0.0
+
+    def edge(self, v1, v2):
+        level = self.st.trigger_level
+        if self.st.trigger_slope == 'rising':
+            crossed = v1 <= level and v2 >= level
+        else:
+            crossed = v1 >= level and v2 <= level
+        return (crossed, self.i_frac(v1, v2, level))
+
+    def window(self, v1, v2):
+        level = self.st.trigger_level
+        half_width = abs(self.st.trigger_window)
+        inside1 = abs(v1 - level) <= half_width
+        inside2 = abs(v2 - level) <= half_width
+        if self.st.trigger_slope == 'rising':
+            crossed = inside1 and not inside2
+            outside = v2
+        else:
+            crossed = inside2 and not inside1
+            outside = v1
+        edge = level + half_width if outside > level else level - half_width
+        return (crossed, self.i_frac(v1, v2, edge))
+
+    def pulse(self, v1, v2):
+        level = self.st.trigger_level
+        if self.st.trigger_slope == 'rising':
+            beyond1, beyond2 = v1 > level, v2 > level
+        else:
+            beyond1, beyond2 = v1 < level, v2 < level
+        crossed = beyond1 and not beyond2 and self.run >= self.pulse_width
+        self.run = self.run + 1 if beyond2 else 0
+        return (crossed, self.i_frac(v1, v2, level))
+
+    def candidates(self, previous, sample):
+        """Returns the trigger search results for one sample, in the form of
+        framer.Buffer.trigger_candidates() for a block of one sample."""
+        crossed, fraction = False, 0.0
+        if self.sync_enabled:
+            test = { 'edge': self.edge, 'window': self.window, 'pulse': self.pulse }
+            crossed, fraction = test[self.st.trigger_type](previous[self.channel],
+                                                          sample[self.channel])
+        exceeded = (self.inrush_enabled
+                    and abs(previous[self.inrush_channel]) >= self.st.inrush_trigger_level)
+        return ([ crossed ], [ fraction ], [ exceeded ])
+
+
+def reference_process_samples(blocks, st, buf, mapper, reference):
+    """The per-sample trigger logic: every stored sample is tested for the trigger
+    conditions on its own by the reference, and goes through framer.process_sample()."""
+    previous = buf.latest_sample()
+    for block in blocks:
+        buf.store_block(block)
+        for sample in block.tolist():
+            framer.process_sample(st, buf, mapper, reference.candidates(previous, sample), 0)
+            previous = sample
+
+
+def with_actions(blocks, actions, st, configurables):
+    """Generator that yields the blocks, taking the planned actions between them.
+    configurables are the objects to reconfigure when the settings change."""
+    for i, block in enumerate(blocks):
+        action = actions.get(i)
+        if action == 'stop':
+            st.run_mode = 'stopped'
+        elif action == 'run':
+            st.run_mode = 'running'
+        elif action == 'timebase':
+            st.time_display_index = (st.time_display_index + 1) % len(st.time_display_ranges)
+            st.set_derived_settings()
+        if action:
+            for configurable in configurables:
+                configurable.configure_for_new_settings()
+        yield block
+
+
+class Null_mapper:
+    """Stands in for framer.Mapper when timing, so that the time taken to format the
+    frames doesn't hide the time taken by the trigger logic."""
+    output_format = 'values'
+    output_function = staticmethod(lambda timestamps, samples: '')
+
+    def configure_for_new_settings(self):
+        pass
+
+
+def run(process_function, blocks, actions, mode, slope, time_display_index, source, timing=False):
+    """Frames the blocks with process_function, and returns the output, the number of
+    frames and the time taken. source is a dictionary of trigger settings."""
+    st = Settings(other_programs=[])
+    st.trigger_mode = mode
+    st.trigger_slope = slope
+    st.time_display_index = time_display_index
+    for name, value in { **DEFAULT_SOURCE, **source }.items():
+        setattr(st, name, value)
+    st.run_mode = 'running'
+    st.set_derived_settings()
+    output = io.StringIO()
+    buf = framer.Buffer(st, output)
+    mapper = Null_mapper() if timing else framer.Mapper(st, 'values')
+    configurables = [ buf, mapper ]
+    if process_function == reference_process_samples:
+        reference = Reference_trigger(st, buf)
+        configurables.append(reference)
+        process_function = (lambda blocks, st, buf, mapper:
+                reference_process_samples(blocks, st, buf, mapper, reference))
+    t0 = time.perf_counter()
+    process_function(with_actions(blocks, actions, st, configurables), st, buf, mapper)
+    elapsed = time.perf_counter() - t0
+    text = output.getvalue()
+    frames = sum(1 for line in text.splitlines() if line.startswith('.'))
+    return (text, frames, elapsed)
+
+
+def main():
+    cmd_parser = argparse.ArgumentParser(description='Check the block trigger search in '
+        'framer.py against the per-sample trigger logic.')
+    cmd_parser.add_argument('--seconds', type=float, default=10.0,
+        help='Seconds of synthetic signal for each trigger setting.')
+    cmd_parser.add_argument('--max_block', type=int, default=400,
+        help='Maximum number of samples in each block.')
+    cmd_parser.add_argument('--seed', type=int, default=1,
+        help='Seed for the random noise, bursts, block sizes and actions.')
+    args = cmd_parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    samples = make_signal(int(args.seconds * SAMPLE_RATE), rng)
+    blocks = split_blocks(samples, rng, args.max_block)
+    actions = plan_actions(len(blocks), rng)
+
+    failures = []
+    total_reference = total_block = 0.0
+    # settings.json is saved when the inrush trigger stops the framer, so that it
+    # goes in a temporary directory instead of the configuration directory
+    settings = [ (f'{mode} {slope} {time_display_index}', mode, slope, time_display_index, {})
+                 for mode in TRIGGER_MODES
+                 for slope in TRIGGER_SLOPES
+                 for time_display_index in TIME_DISPLAY_INDEXES ]
+    settings.extend((f'{mode} {slope} {name}', mode, slope, 3, source)
+                    for name, source in OTHER_SOURCES.items()
+                    for mode in TRIGGER_MODES[:2]
+                    for slope in TRIGGER_SLOPES)
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.environ['TEMP'] = work_dir
+        print(f'{"Trigger setting":34s} {"frames":>7s} {"per-sample s":>13s} {"block s":>8s}')
+        for setting, *setup in settings:
+            setup = (blocks, actions, *setup)
+            expected, frames, _ = run(reference_process_samples, *setup)
+            text, block_frames, _ = run(framer.process_samples, *setup)
+            _, _, reference_time = run(reference_process_samples, *setup, timing=True)
+            _, _, block_time = run(framer.process_samples, *setup, timing=True)
+            total_reference += reference_time
+            total_block += block_time
+            flag = ''
+            if text != expected:
+                failures.append(setting)
+                flag = f'  FAIL ({block_frames} frames)'
+            print(f'{setting:34s} {frames:7d} {reference_time:13.3f} {block_time:8.3f}{flag}')
+    print(f'{"Total":34s} {"":7s} {total_reference:13.3f} {total_block:8.3f}')
+
+    if failures:
+        print(f'trigger_check.py: block trigger search output differs for {", ".join(failures)}.',
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()